@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+'''
+下载记录统计：把账本加载为 NumPy 列式表，分组统计全部用向量化运算完成。
+
+- 每个视频一行，行号为 local_id - 1；数值列为 int64 / float64，作者和分级按字典编码为整数
+- Tag 为 (行号, Tag 编号) 两个并列的数组
+- 字段由 SQLite 直接解析 (DownloadLedger.select_fields)，不为每个视频创建 dict
+- 首次加载读取全部记录，之后按账本修订号只读取变化的记录；统计结果按账本版本缓存
+- 列式表保存为快照 (analytics.npz，与账本同目录)，重启后读取快照再补上之后的变化，不需要重新解析全部记录
+
+需要 numpy (可选依赖，未安装时 /stats 返回 503)。
+
+用法: python analytics.py [报表] [--top N] [--days N] [--json]   不带报表名时列出全部报表
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+try:
+    import numpy as np
+except ImportError: # 可选依赖，仅统计需要
+    np = None
+
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+# 报表默认返回的行数 / 天数
+STATS_DEFAULT_TOP = 20
+STATS_DEFAULT_DAYS = 30
+STATS_MAX_TOP = 1000
+STATS_MAX_DAYS = 3650
+# 没有记录分级的条目 (旧版本下载) 归入该分级
+UNKNOWN_RATING = 'unknown'
+
+DAY_SECONDS = 86400
+
+ANALYTICS_SNAPSHOT_NAME = 'analytics.npz'
+ANALYTICS_SNAPSHOT_FORMAT = 1
+# 距上次保存快照累计变化的行数超过该值时重新保存
+SNAPSHOT_MIN_ROWS = 10000
+
+# 从账本读取的字段及缺失时的默认值
+LEDGER_FIELDS = {
+    'avatar_name': '',
+    'video_rating': UNKNOWN_RATING,
+    'video_size_mb': 0.0,
+    'last_update_timestamp': 0.0,
+    'video_createTime': '',
+    'video_numLikes': 0,
+    'video_numViews': 0,
+    'video_numComments': 0,
+}
+
+# 列名 -> 类型
+COLUMN_TYPES = {
+    'present': 'bool', # 该行是否有记录 (local_id 可能不连续)
+    'success': 'bool',
+    'author': 'int32',
+    'rating': 'int8',
+    'size_mb': 'float64',
+    'download_ts': 'int64', # 最后一次下载 (成功或失败) 的时间戳 (秒)
+    'created_ts': 'int64', # 上传时间戳 (秒，UTC)，缺失为 -1
+    'likes': 'int64',
+    'views': 'int64',
+    'comments': 'int64',
+}
+
+class StatsError(ValueError):
+    '''
+    统计参数错误
+    '''
+
+class _Dictionary:
+    '''
+    字符串字典编码: 值 -> 连续的整数编号
+    '''
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = {value: code for code, value in enumerate(self.values)}
+
+    def encode(self, values) -> 'np.ndarray':
+        codes = self.codes
+        encoded = []
+        append = encoded.append
+        for value in values:
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(self.values)
+                self.values.append(value)
+            append(code)
+        return np.array(encoded, dtype=np.int32)
+
+class ArchiveTable:
+    '''
+    账本的列式内存表 (线程安全)
+    '''
+    def __init__(self, ledger, snapshot_path=None):
+        '''
+        :param ledger: DownloadLedger
+        :param snapshot_path: 快照文件路径，None 表示不保存快照
+        '''
+        if np is None:
+            raise RuntimeError("统计需要安装 numpy")
+        self.ledger = ledger
+        self.snapshot_path = snapshot_path
+        self._unsaved = 0 # 上次保存快照之后变化的行数
+        self.version = None
+        self.revision = None # 已同步到的账本修订号，None 表示尚未加载
+        self.size = 0 # 行数 (最大 local_id)
+        self.authors = _Dictionary()
+        self.ratings = _Dictionary()
+        self.tags = _Dictionary()
+        self._columns = {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMN_TYPES.items()}
+        self._tag_rows = np.zeros(0, dtype=np.int32)
+        self._tag_codes = np.zeros(0, dtype=np.int32)
+        self.lock = threading.Lock()
+
+    def column(self, name) -> 'np.ndarray':
+        return self._columns[name][:self.size]
+
+    @property
+    def tag_rows(self) -> 'np.ndarray':
+        return self._tag_rows
+
+    @property
+    def tag_codes(self) -> 'np.ndarray':
+        return self._tag_codes
+
+    @property
+    def nbytes(self) -> int:
+        '''
+        数组占用的内存 (不含字典)
+        '''
+        return sum(column.nbytes for column in self._columns.values()) + self._tag_rows.nbytes + self._tag_codes.nbytes
+
+    def _reserve(self, size):
+        capacity = len(self._columns['present'])
+        if size <= capacity:
+            return
+        capacity = max(size, capacity + capacity // 2) # 增量追加时摊销复制
+        for name, column in self._columns.items():
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:len(column)] = column
+            self._columns[name] = grown
+
+    def refresh(self) -> bool:
+        '''
+        读取账本上次同步之后的变化
+        :return: 账本是否有变化
+        '''
+        version = self.ledger.version()
+        if version == self.version:
+            return False
+        with self.lock:
+            if version == self.version:
+                return False
+            started = time.monotonic()
+            if self.revision is None and self.snapshot_path:
+                self._load_snapshot()
+            rows = self.ledger.select_fields(LEDGER_FIELDS, since=self.revision)
+            if rows:
+                self._apply(rows)
+            self.revision = self.revision or 0
+            self.version = version
+            if rows:
+                logger.debug(f"统计表更新 {len(rows)} 行，耗时 {time.monotonic() - started:.3f} 秒")
+                self._unsaved += len(rows)
+                if self.snapshot_path and self._unsaved >= SNAPSHOT_MIN_ROWS:
+                    self._save_snapshot()
+        return True
+
+    def _save_snapshot(self):
+        meta = {'format': ANALYTICS_SNAPSHOT_FORMAT, 'ledger': os.path.abspath(self.ledger.path), 'revision': self.revision,
+                'size': self.size, 'authors': self.authors.values, 'ratings': self.ratings.values, 'tags': self.tags.values}
+        arrays = {f"column_{name}": self.column(name) for name in COLUMN_TYPES}
+        arrays.update(tag_rows=self._tag_rows, tag_codes=self._tag_codes, meta=np.array(json.dumps(meta, ensure_ascii=False)))
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self.snapshot_path)
+            self._unsaved = 0
+        except OSError as e:
+            logger.warning(f"保存统计快照 {self.snapshot_path} 失败: {e}")
+
+    def _load_snapshot(self):
+        '''
+        读取快照 (不存在、损坏或不属于当前账本时忽略，从账本完整加载)
+        '''
+        try:
+            with np.load(self.snapshot_path) as data:
+                meta = json.loads(str(data['meta']))
+                if (meta['format'] != ANALYTICS_SNAPSHOT_FORMAT or meta['ledger'] != os.path.abspath(self.ledger.path)
+                        or meta['revision'] > self.ledger.revision()):
+                    logger.info(f"统计快照 {self.snapshot_path} 已过期，重新加载")
+                    return
+                columns = {name: data[f"column_{name}"].astype(dtype) for name, dtype in COLUMN_TYPES.items()}
+                tag_rows, tag_codes = data['tag_rows'], data['tag_codes']
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"统计快照 {self.snapshot_path} 无法读取，重新加载: {e}")
+            return
+        self._columns, self._tag_rows, self._tag_codes = columns, tag_rows, tag_codes
+        self.size = meta['size']
+        self.authors, self.ratings, self.tags = _Dictionary(meta['authors']), _Dictionary(meta['ratings']), _Dictionary(meta['tags'])
+        self.revision = meta['revision']
+
+    def _apply(self, rows):
+        revision, local_id, success, author, rating, size_mb, download_ts, created, likes, views, comments = zip(*rows)
+        until = max(revision)
+        index = np.array(local_id, dtype=np.int64) - 1
+        self._reserve(int(index.max()) + 1)
+        self.size = max(self.size, int(index.max()) + 1)
+        columns = self._columns
+        columns['present'][index] = True
+        columns['success'][index] = np.array(success, dtype=np.bool_)
+        columns['author'][index] = self.authors.encode(author)
+        columns['rating'][index] = self.ratings.encode(rating)
+        columns['size_mb'][index] = np.array(size_mb, dtype=np.float64)
+        columns['download_ts'][index] = np.array(download_ts, dtype=np.float64).astype(np.int64)
+        # '2025-04-10T22:02:00.000Z' 截取到秒后按 UTC 解析，空字符串为 NaT
+        created_ts = np.array(created, dtype='U19').astype('datetime64[s]')
+        columns['created_ts'][index] = np.where(np.isnat(created_ts), -1, created_ts.astype(np.int64))
+        columns['likes'][index] = np.array(likes, dtype=np.int64)
+        columns['views'][index] = np.array(views, dtype=np.int64)
+        columns['comments'][index] = np.array(comments, dtype=np.int64)
+
+        items = self.ledger.select_list_items('video_tagList', since=self.revision, until=until)
+        tag_rows, tags = zip(*items) if items else ((), ())
+        tag_rows = np.array(tag_rows, dtype=np.int32) - 1
+        tag_codes = self.tags.encode(tags)
+        if self.revision is not None and len(self._tag_rows):
+            # 修改过的行先删除原来的 Tag
+            keep = ~np.isin(self._tag_rows, index)
+            self._tag_rows = np.concatenate([self._tag_rows[keep], tag_rows])
+            self._tag_codes = np.concatenate([self._tag_codes[keep], tag_codes])
+        else:
+            self._tag_rows, self._tag_codes = tag_rows, tag_codes
+        self.revision = until
+
+def default_snapshot_path(ledger) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(ledger.path)), ANALYTICS_SNAPSHOT_NAME)
+
+def _top(labels, values, top, extra=None) -> list:
+    '''
+    取 values 最大的 top 项
+    :param labels: 编号 -> 名称
+    :param extra: {字段名: 与 values 并列的数组}
+    '''
+    if top < len(values):
+        order = np.argpartition(-values, top)[:top]
+        order = order[np.argsort(-values[order], kind='stable')]
+    else:
+        order = np.argsort(-values, kind='stable')
+    result = []
+    for code in order:
+        if not values[code]:
+            break
+        row = {'name': labels[code], 'value': values[code].item()}
+        for name, column in (extra or {}).items():
+            row[name] = column[code].item()
+        result.append(row)
+    return result
+
+class ArchiveStats:
+    '''
+    统计报表，结果按账本版本缓存
+    '''
+    REPORTS = {
+        'summary': '总数、成功/失败数、总大小',
+        'bytes_per_author': '各作者已下载的总大小 (MB) 与视频数',
+        'tag_frequency': '各 Tag 的视频数 (全部记录)',
+        'downloads_per_day': '最近 N 天每天成功下载的数量与大小 (本地时区)',
+        'failure_rate_per_day': '最近 N 天每天的失败数与失败率 (本地时区)',
+        'size_by_rating': '各分级已下载视频的平均大小与总大小 (MB)',
+        'likes_by_author': '各作者视频的平均点赞数 (至少 3 个视频)',
+    }
+
+    def __init__(self, ledger, snapshot_path=None):
+        self.table = ArchiveTable(ledger, snapshot_path)
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+
+    def report(self, name, top=STATS_DEFAULT_TOP, days=STATS_DEFAULT_DAYS) -> dict:
+        '''
+        :param name: REPORTS 中的报表名
+        :return: {'report', 'version', 'rows' 或报表内容}
+        '''
+        if name not in self.REPORTS:
+            raise StatsError(f"未知的报表: {name}，可选: {', '.join(self.REPORTS)}")
+        if not 1 <= top <= STATS_MAX_TOP:
+            raise StatsError(f"top 必须在 1 到 {STATS_MAX_TOP} 之间")
+        if not 1 <= days <= STATS_MAX_DAYS:
+            raise StatsError(f"days 必须在 1 到 {STATS_MAX_DAYS} 之间")
+        if self.table.refresh():
+            with self._cache_lock:
+                self._cache.clear()
+        version = self.table.version
+        key = (name, top, days)
+        with self._cache_lock:
+            cached = self._cache.get(key)
+        if cached is not None and cached['version'] == version:
+            return cached
+        with self.table.lock:
+            result = getattr(self, f"_{name}")(top=top, days=days)
+        result = dict(result, report=name, version=version)
+        with self._cache_lock:
+            self._cache[key] = result
+        return result
+
+    # --- 报表 (需持有 table.lock) ---
+
+    def _mask(self, success=None):
+        mask = self.table.column('present')
+        if success is not None:
+            mask = mask & (self.table.column('success') == success)
+        return mask
+
+    def _summary(self, **_):
+        present = self._mask()
+        success = self.table.column('success') & present
+        size = self.table.column('size_mb')
+        return {
+            'total': int(present.sum()),
+            'success': int(success.sum()),
+            'failed': int(present.sum() - success.sum()),
+            'size_mb': round(float(size[success].sum()), 1),
+            'authors': int(np.count_nonzero(np.bincount(self.table.column('author')[present]))),
+            'tags': int(np.count_nonzero(np.bincount(self.table.tag_codes[present[self.table.tag_rows]]))),
+            'memory_bytes': self.table.nbytes,
+        }
+
+    def _bytes_per_author(self, top, **_):
+        mask = self._mask(success=True)
+        authors = self.table.column('author')[mask]
+        size = np.bincount(authors, weights=self.table.column('size_mb')[mask], minlength=len(self.table.authors.values))
+        count = np.bincount(authors, minlength=len(self.table.authors.values))
+        return {'rows': [dict(row, value=round(row['value'], 1)) for row in _top(self.table.authors.values, size, top, {'videos': count})]}
+
+    def _tag_frequency(self, top, **_):
+        present = self._mask()
+        codes = self.table.tag_codes[present[self.table.tag_rows]]
+        count = np.bincount(codes, minlength=len(self.table.tags.values))
+        return {'rows': _top(self.table.tags.values, count, top)}
+
+    def _days(self, days, success=None):
+        '''
+        :return: (第一天的本地日期编号, 每行的日期编号 - 第一天, 行掩码)
+        '''
+        utc_offset = -time.altzone if time.localtime().tm_isdst > 0 else -time.timezone
+        mask = self._mask(success)
+        local_day = (self.table.column('download_ts') + utc_offset) // DAY_SECONDS
+        first = (int(time.time()) + utc_offset) // DAY_SECONDS - days + 1
+        mask = mask & (local_day >= first)
+        return first, local_day[mask] - first, mask
+
+    @staticmethod
+    def _day_label(day) -> str:
+        return time.strftime('%Y-%m-%d', time.gmtime(day * DAY_SECONDS))
+
+    def _downloads_per_day(self, days, **_):
+        first, day, mask = self._days(days, success=True)
+        count = np.bincount(day, minlength=days)
+        size = np.bincount(day, weights=self.table.column('size_mb')[mask], minlength=days)
+        return {'rows': [{'date': self._day_label(first + i), 'downloads': int(count[i]), 'size_mb': round(float(size[i]), 1)}
+                         for i in range(days)]}
+
+    def _failure_rate_per_day(self, days, **_):
+        first, day, mask = self._days(days)
+        total = np.bincount(day, minlength=days)
+        failed = np.bincount(day, weights=~self.table.column('success')[mask], minlength=days)
+        rate = np.divide(failed, total, out=np.zeros(days), where=total > 0)
+        return {'rows': [{'date': self._day_label(first + i), 'total': int(total[i]), 'failed': int(failed[i]),
+                          'failure_rate': round(float(rate[i]), 4)} for i in range(days)]}
+
+    def _size_by_rating(self, **_):
+        mask = self._mask(success=True)
+        ratings = self.table.column('rating')[mask]
+        labels = self.table.ratings.values
+        count = np.bincount(ratings, minlength=len(labels))
+        size = np.bincount(ratings, weights=self.table.column('size_mb')[mask], minlength=len(labels))
+        return {'rows': [{'rating': labels[i], 'videos': int(count[i]), 'size_mb': round(float(size[i]), 1),
+                          'avg_size_mb': round(float(size[i] / count[i]), 1)} for i in np.argsort(-count) if count[i]]}
+
+    def _likes_by_author(self, top, **_):
+        mask = self._mask()
+        authors = self.table.column('author')[mask]
+        count = np.bincount(authors, minlength=len(self.table.authors.values))
+        likes = np.bincount(authors, weights=self.table.column('likes')[mask], minlength=len(self.table.authors.values))
+        average = np.divide(likes, count, out=np.zeros(len(count)), where=count >= 3)
+        return {'rows': [dict(row, value=round(row['value'], 1)) for row in _top(self.table.authors.values, average, top, {'videos': count})]}
+
+def _print_report(result):
+    rows = result.get('rows')
+    if rows is None:
+        for key, value in result.items():
+            if key not in ('report', 'version'):
+                print(f"{key:<14} {value}")
+        return
+    if not rows:
+        print("(无数据)")
+        return
+    keys = list(rows[0])
+    widths = [max(len(str(key)), *(len(str(row[key])) for row in rows)) for key in keys]
+    print('  '.join(str(key).ljust(width) for key, width in zip(keys, widths)))
+    for row in rows:
+        print('  '.join(str(row[key]).ljust(width) for key, width in zip(keys, widths)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='下载记录统计')
+    parser.add_argument('report', nargs='?', help='报表名，不指定时列出全部报表')
+    parser.add_argument('--top', type=int, default=STATS_DEFAULT_TOP)
+    parser.add_argument('--days', type=int, default=STATS_DEFAULT_DAYS)
+    parser.add_argument('--json', action='store_true', help='输出 JSON')
+    args = parser.parse_args()
+    if args.report is None:
+        for name, description in ArchiveStats.REPORTS.items():
+            print(f"{name:<22} {description}")
+        sys.exit(0)
+    if np is None:
+        print("统计需要安装 numpy: pip install numpy")
+        sys.exit(1)
+
+    from app import get_ledger
+    try:
+        ledger = get_ledger()
+        result = ArchiveStats(ledger, default_snapshot_path(ledger)).report(args.report, top=args.top, days=args.days)
+    except StatsError as e:
+        print(e)
+        sys.exit(2)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        _print_report(result)
@@ -2,19 +2,59 @@
 from __future__ import annotations
 
 import time
+import json
+import threading
 import requests, hashlib, os
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from credentials import CredentialManager
+from log_config import get_logger, video_logger
+from metrics import DOWNLOADED_BYTES, record_response, record_retry
+from rate_limit import RateLimiter, RATE_LIMIT_RETRIES
+from retry_policy import DOWNLOAD_RETRY, ERROR_TRANSIENT, PermanentError, RetryExhaustedError, classify_error, get_breaker, retry_after
+from integrity import HASH_BLOCK_SIZE, BlockHasher, open_hasher, combine_block_digests
+from partials import PartialIndex
+from storage import ROLE_HOT, STORAGE_LAYOUT, StorageLayout, StorageRoot
+from thumbnails import THUMBNAIL_FRAMES, THUMBNAIL_FRAME_COUNT, THUMBNAIL_FRAME_CONCURRENCY, ThumbnailStore
+from file_sink import BUFFER_POOL, FileSink, iter_response_into, preallocate
 from http.client import IncompleteRead # 引入 IncompleteRead 以便在 app.py 中捕获
 from requests.exceptions import RequestException # 导入 requ
 
 BASE_DATA_DIR = "/srv/video_downloader/data"
 
+# 登录凭证持久化文件 (批量任务与 web 服务共用)
+TOKEN_FILE = os.path.join(BASE_DATA_DIR, "token.json")
+# 请求频率限制的共享状态文件 (批量任务与 web 服务共用同一份额度)
+RATE_LIMIT_FILE = os.path.join(BASE_DATA_DIR, "ratelimit.json")
+
 # 定义下载目录
 DOWNLOAD_DIR = os.path.join(BASE_DATA_DIR, "downloads")
 # 定义缩略图存储目录 (视频目录下的 thumbnails 子目录)
 THUMBNAIL_DIR = os.path.join(DOWNLOAD_DIR, "thumbnails")
-# 最大重试次数
-MAX_RETRIES = 5
+# 视频存储根目录: [(目录, 角色)]，角色为 hot (新下载和未完成下载，例如 SSD) 或 bulk (下载完成的视频，例如 HDD)
+# 第一个 hot 根目录接收新下载；没有 bulk 根目录时视频一直留在 hot 根目录。布局与迁移策略见 storage.py
+STORAGE_ROOTS = [
+    (DOWNLOAD_DIR, ROLE_HOT),
+    # ("/mnt/hdd/video_downloader/downloads", ROLE_BULK),
+]
+# 下载重试次数与等待时间见 retry_policy.DOWNLOAD_RETRY
+
+# 连接池配置 (所有下载线程共享同一个 ApiClient 的连接池)
+POOL_CONNECTIONS = 10 # 缓存的主机连接池数量 (api / files / CDN 节点)
+POOL_MAXSIZE = 32 # 每个主机最多保持的 keep-alive 连接数，应不小于并发线程数
+POOL_RETRIES = 3 # urllib3 层面的连接/状态码重试次数
+POOL_BACKOFF_FACTOR = 0.5 # urllib3 重试退避系数: 0.5, 1, 2 ...
+
+# 分段并行下载
+SEGMENT_COUNT = 4 # 单个文件同时使用的连接数，1 表示关闭分段下载
+SEGMENT_MIN_SIZE = 64 * 1024 * 1024 # 小于该大小的文件仍使用单连接下载
+DOWNLOAD_CHUNK_SIZE = 8192 * 4 # 异步客户端的读取块大小；同步下载使用 file_sink.DOWNLOAD_BUFFER_SIZE 的缓冲区
+
+# 视频信息缓存
+VIDEO_CACHE_TTL = 600 # 视频信息缓存有效期 (秒)
+FILE_URL_EXPIRE_MARGIN = 30 # fileUrl 在 expires 之前多少秒视为失效
 
 # import cloudscraper
 # from requests_html import HTMLSession
@@ -27,20 +67,502 @@ file_url = 'https://files.iwara.tv'
 # 忽略SSH验证
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+logger = get_logger(__name__)
+
+def parse_file_url_expires(url) -> str | None:
+    '''
+    从 fileUrl 的查询参数中解析 expires
+    :param url: fileUrl
+    :return: expires 字符串，解析失败时返回 None
+    '''
+    query_params = urllib3.util.parse_url(url).query
+    if not query_params:
+        return None
+    return dict(p.split('=', 1) for p in query_params.split('&') if '=' in p).get('expires')
+
+def resource_request(video_id, video) -> tuple[str, dict]:
+    '''
+    根据视频信息构造获取下载资源列表的请求 (fileUrl + X-Version 签名)
+    :param video_id: 视频ID
+    :param video: /video/{id} 响应
+    :return: (url, headers)
+    '''
+    url = video.get('fileUrl')
+    file_info = video.get('file')
+    if not url or not file_info or 'id' not in file_info:
+         raise PermanentError(f"视频 {video_id} 信息不完整，缺少 fileUrl 或 file.id")
+
+    file_id = file_info['id']
+    # 解析 expires (更健壮的方式)
+    try:
+        expires = parse_file_url_expires(url)
+        if not expires:
+            raise ValueError("无法从 fileUrl 中解析 expires 参数")
+    except Exception as e:
+         raise PermanentError(f"解析视频 {video_id} 的 fileUrl 出错: {e}")
+
+    SHA_postfix = "_5nFp9kmbNnHdAFhaqMvt"
+    SHA_key = file_id + "_" + expires + SHA_postfix
+    hash_val = hashlib.sha1(SHA_key.encode('utf-8')).hexdigest() # 使用 hash_val 避免覆盖内置函数 hash
+    return url, {"X-Version": hash_val}
+
+def select_download_resource(video_id, resources) -> tuple[str, str]:
+    '''
+    从下载资源列表中选择下载链接，优先 Source 清晰度
+    :param video_id: 视频ID
+    :param resources: 资源列表
+    :return: (下载链接, 文件类型)
+    '''
+    download_link = None
+    file_type = 'mp4' # 默认文件类型
+    # 优先寻找 Source 清晰度
+    for resource in resources:
+        if resource.get('name') == 'Source' and resource.get('src', {}).get('download'):
+            download_link = "https:" + resource['src']['download']
+            if 'type' in resource and '/' in resource['type']:
+                file_type = resource['type'].split('/')[1]
+            break
+
+    # 如果没有 Source，尝试寻找其他可用链接 (这里可以根据需要扩展逻辑，例如选择最高分辨率)
+    if not download_link and resources:
+         # 简单地选择第一个找到的链接作为备选
+         first_resource = resources[0]
+         if first_resource.get('src', {}).get('download'):
+             download_link = "https:" + first_resource['src']['download']
+             if 'type' in first_resource and '/' in first_resource['type']:
+                file_type = first_resource['type'].split('/')[1]
+             logger.warning(f"未找到 {video_id} 的 Source 清晰度，将下载其他可用清晰度。", extra={'video_id': video_id, 'stage': 'resources'})
+
+    if not download_link:
+        raise PermanentError(f"视频 {video_id} 未找到可用的下载链接")
+    return download_link, file_type
+
+def thumbnail_url(video_id, video_info, base_url=file_url, frame=None) -> str | None:
+    '''
+    根据视频信息构造原始缩略图地址
+    :param video_id: 视频id
+    :param video_info: 视频信息 (列表条目或 /video/{id} 响应)
+    :param base_url: 文件服务器地址
+    :param frame: 预览帧序号 (0 ~ THUMBNAIL_FRAME_COUNT-1)，None 表示封面
+    :return: 缩略图 URL，信息不完整时返回 None
+    '''
+    file_id = (video_info.get('file') or {}).get('id')
+    thumbnail_id = video_info.get('thumbnail')
+    if not file_id or thumbnail_id is None: # 检查是否成功获取到必要信息
+        logger.error(f"视频 {video_id} 信息不完整，无法获取缩略图 ID。", extra={'video_id': video_id, 'stage': 'thumbnail'})
+        return None
+    index = thumbnail_id if frame is None else frame
+    return f"{base_url}/image/original/{file_id}/thumbnail-{index:02d}.jpg"
+
+class VideoInfoCache:
+    '''
+    /video/{id} 响应的线程安全缓存。
+    条目在 TTL 到期或 fileUrl 中的 expires 到期时失效；
+    /videos 列表结果可以预先写入 (列表条目不含 fileUrl，只能满足缩略图等需求)。
+    '''
+    def __init__(self, ttl=VIDEO_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {} # video_id -> (video_info, 失效时间戳)
+
+    def _expire_at(self, video_info):
+        expire_at = time.time() + self.ttl
+        url = video_info.get('fileUrl')
+        if url:
+            try:
+                expires = int(parse_file_url_expires(url))
+                if expires > 10 ** 12: # 毫秒时间戳
+                    expires //= 1000
+                expire_at = min(expire_at, expires - FILE_URL_EXPIRE_MARGIN)
+            except (TypeError, ValueError):
+                pass
+        return expire_at
+
+    def get(self, video_id, require_file_url=False) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry is None:
+                return None
+            video_info, expire_at = entry
+            if time.time() >= expire_at:
+                del self._entries[video_id]
+                return None
+        if require_file_url and not video_info.get('fileUrl'):
+            return None
+        return video_info
+
+    def put(self, video_info, overwrite=True):
+        video_id = video_info.get('id')
+        if not video_id:
+            return
+        with self._lock:
+            if not overwrite and video_id in self._entries:
+                return
+            self._entries[video_id] = (video_info, self._expire_at(video_info))
+
+    def invalidate(self, video_id):
+        with self._lock:
+            self._entries.pop(video_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
 class BearerAuth(requests.auth.AuthBase):
     '''
     Bearer Authentication
-    身份验证
+    身份验证。传入 CredentialManager 时每次请求使用最新的 token，收到 401 时重新登录并重发一次请求
     '''
     def __init__(self, token):
+        '''
+        :param token: token 字符串或 CredentialManager
+        '''
         self.token = token
 
     def __call__(self, r):
-        r.headers['Authorization'] = 'Bearer ' + self.token
+        if isinstance(self.token, CredentialManager):
+            r.headers['Authorization'] = 'Bearer ' + self.token.get_token()
+            r.register_hook('response', self.handle_401)
+        else:
+            r.headers['Authorization'] = 'Bearer ' + self.token
         return r
 
+    def handle_401(self, r, **kwargs):
+        if r.status_code != 401 or getattr(r.request, '_bearer_retried', False):
+            return r
+        failed_token = r.request.headers.get('Authorization', '')[len('Bearer '):]
+        logger.warning(f"登录凭证被拒绝 (401)，重新登录: {r.request.url}")
+        token = self.token.refresh(failed_token)
+        r.content # 读完响应体，连接才能放回连接池
+        r.close()
+        prep = r.request.copy()
+        prep.headers['Authorization'] = 'Bearer ' + token
+        prep._bearer_retried = True
+        _r = r.connection.send(prep, **kwargs)
+        _r.history.append(r)
+        _r.request = prep
+        return _r
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+def get_rate_limiter() -> RateLimiter:
+    '''
+    进程内共享的请求限速器 (状态保存在 RATE_LIMIT_FILE，与其他进程共享)
+    '''
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter(state_file=RATE_LIMIT_FILE)
+        return _rate_limiter
+
+_storage_layout = None
+_storage_layout_lock = threading.Lock()
+
+def get_storage_layout() -> StorageLayout:
+    '''
+    进程内共享的存储布局 (STORAGE_ROOTS)，其中的磁盘空间预留由调度器的视频阶段使用
+    '''
+    global _storage_layout
+    with _storage_layout_lock:
+        if _storage_layout is None:
+            _storage_layout = StorageLayout([StorageRoot(path, role) for path, role in STORAGE_ROOTS], layout=STORAGE_LAYOUT)
+        return _storage_layout
+
+_partial_index = None
+_partial_index_lock = threading.Lock()
+
+def get_partial_index() -> PartialIndex:
+    '''
+    进程内共享的未完成下载索引 (首次调用时扫描 hot 存储根目录)
+    '''
+    global _partial_index
+    with _partial_index_lock:
+        if _partial_index is None:
+            _partial_index = PartialIndex.load(get_storage_layout().partial_dir)
+        return _partial_index
+
+_thumbnail_store = None
+_thumbnail_store_lock = threading.Lock()
+
+def get_thumbnail_store() -> ThumbnailStore:
+    '''
+    进程内共享的缩略图存储 (THUMBNAIL_DIR)
+    '''
+    global _thumbnail_store
+    with _thumbnail_store_lock:
+        if _thumbnail_store is None:
+            _thumbnail_store = ThumbnailStore(THUMBNAIL_DIR)
+        return _thumbnail_store
+
+class RemoteFileChanged(RequestException):
+    '''
+    续传时服务器上的文件已经变化 (If-Range 不匹配)，已下载的部分不能再使用
+    '''
+
+class RateLimitedAdapter(HTTPAdapter):
+    '''
+    发送请求前经过限速器；收到 429 时通知限速器降速，GET/HEAD 请求等待后重发
+    '''
+    def __init__(self, *args, rate_limiter=None, **kwargs):
+        self.rate_limiter = rate_limiter
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if self.rate_limiter is None:
+            return super().send(request, **kwargs)
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            self.rate_limiter.wait(request.url, request.headers)
+            response = super().send(request, **kwargs)
+            self.rate_limiter.observe(request.url, request.headers, response.status_code, response.headers)
+            if response.status_code != 429 or request.method not in ('GET', 'HEAD') or attempt == RATE_LIMIT_RETRIES:
+                return response
+            response.close() # 下一次 wait() 会等到限流结束
+        return response
+
+def create_session(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=POOL_RETRIES, backoff_factor=POOL_BACKOFF_FACTOR, rate_limiter=None) -> requests.Session:
+    '''
+    创建带连接池的 requests.Session，按主机复用 keep-alive 连接，避免每次请求都重新进行 TCP+TLS 握手。
+    :param pool_connections: 缓存的主机连接池数量
+    :param pool_maxsize: 每个主机连接池的最大连接数
+    :param max_retries: urllib3 层面的重试次数 (连接错误、5xx；429 由限速器处理)
+    :param backoff_factor: 重试退避系数
+    :param rate_limiter: 请求限速器，None 表示不限速
+    :return: requests.Session 会话对象
+    '''
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries,
+        status=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(500, 502, 503, 504) if rate_limiter is not None else (429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD']), # 登录等 POST 请求不自动重试
+        respect_retry_after_header=rate_limiter is None, # 否则 urllib3 会自行等待并重试 429，限速器无法感知
+        raise_on_status=False, # 交给 raise_for_status 处理
+    )
+    adapter = RateLimitedAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry, pool_block=False,
+                                 rate_limiter=rate_limiter)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    session.hooks['response'].append(record_response) # 按端点统计响应耗时与状态码
+    return session
+
+# --- 下载引擎的共用步骤 (ApiClient 与 async_client.AsyncApiClient 共用，只有网络 I/O 各自实现) ---
+
+def range_headers(pos, end=None, if_range=None) -> dict:
+    '''
+    下载请求头：从 pos 开始 (到 end 为止) 的 Range，已下载部分的 If-Range (服务器上的文件已变化时返回完整内容)
+    '''
+    headers = {'User-Agent': 'Mozilla/5.0'} # 添加 User-Agent 可能有助于避免某些服务器阻止
+    if pos > 0 or end is not None:
+        headers['Range'] = f"bytes={pos}-{'' if end is None else end}"
+        if if_range:
+            headers['If-Range'] = if_range
+    return headers
+
+def response_total_size(status, headers) -> int | None:
+    '''
+    由响应头得到文件总大小：Content-Range 中的总大小 (206)，或 200 响应的 Content-Length
+    '''
+    if 'Content-Range' in headers:
+        total = headers['Content-Range'].split('/')[-1]
+        return int(total) if total.isdigit() else None
+    if status == 200 and headers.get('Content-Length', '').isdigit():
+        return int(headers['Content-Length'])
+    return None
+
+def unsatisfiable_total(headers, partial) -> int | None:
+    '''
+    416 响应后服务器上文件的总大小：响应的 Content-Range (bytes */总大小)，没有时使用未完成下载记录的总大小
+    :return: 仍然无法得知时为 None (调用方再用 bytes=0-0 探测)
+    '''
+    content_range = headers.get('Content-Range', '')
+    if content_range.startswith('bytes */') and content_range[8:].isdigit() and int(content_range[8:]) > 0:
+        return int(content_range[8:])
+    return partial.total_size
+
+def settle_unsatisfiable(partial, total_size) -> bool:
+    '''
+    处理 416：本地已下载的字节数与服务器上的文件大小相等时文件已完整；
+    大小不符或无法得知时不认为文件已完整，丢弃未完成下载从头下载
+    :return: 文件是否已完整 (调用方随后调用 complete_partial)
+    '''
+    log = video_logger(logger, partial.video_id, 'download')
+    local_size = partial.size
+    if total_size and local_size == total_size:
+        log.info(f"文件 {partial.path} 已完整 (本地 {local_size} = 服务器 {total_size})。")
+        return True
+    if total_size:
+        log.info(f"文件不完整 (本地 {local_size}，服务器 {total_size})，将重新下载。删除本地文件...")
+    else:
+        log.warning(f"无法得知服务器上的文件大小，不能确认本地 {local_size} bytes 是否完整，将重新下载。删除本地文件...")
+    partial.restart()
+    return False
+
+def begin_stream(partial, download_link, status, headers, resume_byte_pos) -> tuple[str, int | None, BlockHasher]:
+    '''
+    单连接下载收到数据响应后：决定续传还是覆盖写入，记录总大小与校验信息 (中断后无需探测即可续传)，
+    并从记录的块摘要恢复哈希器 (续传时最多重新读取最后一个不完整的块)
+    :return: (写入模式 'ab' / 'wb', 总大小或 None, BlockHasher)
+    '''
+    log = video_logger(logger, partial.video_id, 'download')
+    total_size = response_total_size(status, headers)
+    if total_size:
+        log.info(f"文件: {partial.video_file_name}, 预期总大小: {total_size / 1024:.1f} KB ({total_size / 1024 / 1024:.1f} MB)")
+    else:
+        log.info(f"文件: {partial.video_file_name}, 未能从响应头获取准确总大小。")
+    mode = 'ab' if resume_byte_pos > 0 and status == 206 else 'wb' # 只有在续传成功时才用 'ab'
+    if mode == 'wb': # 重新下载 (或 If-Range 不匹配，服务器返回了完整内容)，重置状态
+        partial.reset()
+    partial.record_response(download_link, headers, total_size)
+    partial.save()
+    hasher = open_hasher(partial.path if mode == 'ab' else None, resume_byte_pos, partial.block_digests)
+    return mode, total_size, hasher
+
+def write_blocks(sink, partial, hasher, data):
+    '''
+    单连接下载：顺序写入一批数据并更新摘要，有块完成时保存已完成块的摘要
+    (FileSink 没有用户态缓冲，写入后数据已在页缓存中，记录的块摘要不会超前于文件内容)
+    '''
+    DOWNLOADED_BYTES.inc(len(data))
+    sink.write(data)
+    if hasher.update(data):
+        partial.save_blocks(hasher.block_digests)
+
+def complete_stream(partials, partial, total_size, hasher) -> tuple[str, int, str] | None:
+    '''
+    单连接下载的响应读完后：大小与总大小相符 (或总大小未知) 时完成下载
+    :return: (视频文件路径, 文件大小bytes, 文件摘要)；数据不完整时为 None (调用方从已写入的位置续传)
+    '''
+    log = video_logger(logger, partial.video_id, 'download')
+    final_file_size = partial.size
+    if total_size is not None and final_file_size < total_size:
+        log.warning(f"下载 {partial.video_id} 可能不完整：预期 {total_size} 字节，实际 {final_file_size} 字节。将在下次重试继续。")
+        record_retry('download', 'IncompleteRead')
+        return None
+    video_file_name = partials.complete(partial) # 原子重命名为最终文件名
+    if total_size is not None:
+        log.info(f"视频 {partial.video_id} 下载完成并校验大小成功，保存为 {video_file_name}")
+    else:
+        log.info(f"视频 {partial.video_id} 下载完成 (未进行大小校验)，保存为 {video_file_name}")
+    return video_file_name, final_file_size, hasher.hexdigest()
+
+def complete_partial(partials, partial) -> tuple[str, int, str]:
+    '''
+    数据已全部写入的未完成下载：由记录的块摘要得到文件摘要，原子重命名为最终文件名
+    :return: (视频文件路径, 文件大小bytes, 文件摘要)
+    '''
+    size = partial.size
+    segments = partial.meta.get('segments')
+    if segments is not None:
+        count = -(-size // segments['segment_size'])
+        digest = combine_block_digests(d for index in range(count) for d in segments['blocks'][str(index)])
+    else:
+        digest = open_hasher(partial.path, size, partial.block_digests).hexdigest() # 最多重新读取最后一个不完整的块
+    video_file_name = partials.complete(partial)
+    logger.info(f"视频 {partial.video_id} 下载完成，保存为 {video_file_name}", extra={'video_id': partial.video_id, 'stage': 'download'})
+    return video_file_name, size, digest
+
+def write_segment(fd, data, pos, end, hasher, on_bytes=None) -> int:
+    '''
+    分段下载：把数据写入 fd 的 pos 偏移 (超出分段末尾 end 的部分丢弃) 并更新该分段的摘要
+    :param on_bytes: 写入后的回调 on_bytes(字节数)
+    :return: 新的写入位置
+    '''
+    data = data[:end + 1 - pos]
+    DOWNLOADED_BYTES.inc(len(data))
+    written = 0
+    while written < len(data):
+        written += os.pwrite(fd, data[written:], pos + written)
+    hasher.update(data)
+    if on_bytes is not None:
+        on_bytes(written)
+    return pos + written
+
+class SegmentPlan:
+    '''
+    分段并行下载的计划与状态。文件按字节范围切成若干段 (分段大小对齐到摘要块，每个分段独立计算块摘要)，
+    各分段按偏移直接写入预分配的 .part 文件；已完成的分段记录在未完成下载的元数据中，中断后只需重新下载其余分段。
+    方法是线程安全的。
+    '''
+    def __init__(self, partial, total_size, state):
+        self.partial = partial
+        self.total_size = total_size
+        self.state = state
+        segment_size = state['segment_size']
+        self.ranges = [(i, i * segment_size, min(total_size, (i + 1) * segment_size) - 1)
+                       for i in range(-(-total_size // segment_size))]
+        done = set(state['done'])
+        self.pending = [r for r in self.ranges if r[0] not in done]
+        self.downloaded = sum(end - start + 1 for index, start, end in self.ranges if index in done)
+        self.if_range = partial.if_range()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def resume(cls, partial) -> SegmentPlan | None:
+        '''
+        已有的分段记录；记录与文件不符时丢弃未完成下载
+        :return: 没有 (可用的) 分段记录时为 None
+        '''
+        state = partial.meta.get('segments')
+        if state is None:
+            return None
+        if state.get('block_size') != HASH_BLOCK_SIZE or not partial.total_size or partial.size != partial.total_size:
+            logger.warning(f"分段记录 {partial.meta_path} 与文件不符，重新下载", extra={'video_id': partial.video_id, 'stage': 'segment'})
+            partial.restart()
+            return None
+        return cls(partial, partial.total_size, state)
+
+    @classmethod
+    def create(cls, partial, total_size, segments) -> SegmentPlan:
+        segment_size = -(-total_size // segments)
+        segment_size = -(-segment_size // HASH_BLOCK_SIZE) * HASH_BLOCK_SIZE
+        state = partial.meta['segments'] = {'segment_size': segment_size, 'block_size': HASH_BLOCK_SIZE, 'done': [], 'blocks': {}}
+        return cls(partial, total_size, state)
+
+    def open(self) -> int:
+        '''
+        打开 .part 文件 (首次时预分配磁盘空间并扩展到总大小) 并保存分段记录
+        :return: 文件描述符 (调用方关闭)
+        '''
+        fd = os.open(self.partial.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != self.total_size:
+                # 预分配磁盘空间，减少碎片
+                preallocate(fd, 0, self.total_size)
+                os.ftruncate(fd, self.total_size)
+            with self._lock:
+                self.partial.save()
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    def add_progress(self, nbytes) -> int:
+        '''
+        :return: 所有分段合计的已下载字节数
+        '''
+        with self._lock:
+            self.downloaded += nbytes
+            return self.downloaded
+
+    def mark_done(self, fd, index, block_digests):
+        '''
+        先落盘分段数据再标记完成
+        '''
+        os.fsync(fd)
+        with self._lock:
+            self.state['done'].append(index)
+            self.state['blocks'][str(index)] = block_digests
+            self.partial.save()
+
 class ApiClient:
-    def __init__(self, email, password):
+    def __init__(self, email, password, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=POOL_RETRIES, backoff_factor=POOL_BACKOFF_FACTOR, video_cache_ttl=VIDEO_CACHE_TTL,
+                 segments=SEGMENT_COUNT, segment_min_size=SEGMENT_MIN_SIZE, token_file=TOKEN_FILE, rate_limiter=None, partials=None,
+                 thumbnails=None, thumbnail_frames=THUMBNAIL_FRAMES, storage=None):
         self.email = email
         self.password = password
 
@@ -50,37 +572,106 @@ class ApiClient:
         self.timeout = 30
         # self.max_retries = 5 # 内部重试在下载方法中处理
         self.download_timeout = 300 # 单次下载请求的超时时间
-        self.token = None
+        # 登录凭证: 按需登录，到期前刷新，401 时重新登录，token 保存在 token_file 中
+        self.credentials = CredentialManager(email, password, self._login_request, token_file)
+        self.auth = BearerAuth(self.credentials)
+
+        # 请求限速: 默认使用进程内共享、跨进程同步的限速器
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        # 共享的连接池会话: urllib3 按主机维护连接池，api.iwara.tv 与 files.iwara.tv 各自复用连接
+        self.session = create_session(pool_connections, pool_maxsize, max_retries, backoff_factor, rate_limiter=self.rate_limiter)
+        # 视频信息缓存，缩略图与视频下载共用，避免重复请求 /video/{id}
+        self.video_cache = VideoInfoCache(ttl=video_cache_ttl)
+        # 全局带宽限速器 (由调度器设置，None 表示不限速)
+        self.bandwidth_limiter = None
+        # 分段并行下载配置
+        self.segments = segments
+        self.segment_min_size = segment_min_size
+        # 未完成下载 (.part 文件) 索引
+        self.partials = partials if partials is not None else get_partial_index()
+        # 缩略图存储 (按内容寻址，生成预览图)；thumbnail_frames 为 True 时下载全部预览帧
+        self.thumbnails = thumbnails or get_thumbnail_store()
+        self.thumbnail_frames = thumbnail_frames
+        # 存储布局 (视频文件保存位置)
+        self.storage = storage or get_storage_layout()
+
+    def close(self):
+        '''
+        关闭会话，释放连接池中的所有连接
+        '''
+        self.session.close()
 
-    def login(self) -> requests.Response:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def token(self) -> str | None:
+        return self.credentials.token
+
+    def login(self) -> str:
+        '''
+        确保已登录：保存的 token 仍然有效时直接使用，否则请求登录接口
+        :return: token
+        '''
+        return self.credentials.get_token()
+
+    def _login_request(self, email, password) -> str:
         url = self.api_url + '/user/login'
-        json = {'email': self.email, 'password': self.password}
+        json = {'email': email, 'password': password}
         try:
-            r = requests.post(url, json=json, timeout=self.timeout)
+            r = self.session.post(url, json=json, timeout=self.timeout)
             r.raise_for_status() # 检查HTTP错误
-            self.token = r.json()['token']
-            print('API 登录成功， '+self.token)
+            token = r.json()['token']
+            logger.info('API 登录成功')
         except requests.exceptions.RequestException as e:
-            print(f'API 登录失败: {e}')
+            logger.error(f'API 登录失败: {e}')
             # 如果登录失败，可能需要抛出异常或采取其他措施
             raise ConnectionError(f"API登录失败: {e}") # 抛出异常阻止后续操作
         except Exception as e:
-            print(f'API 登录失败，解析响应错误: {e}')
+            logger.error(f'API 登录失败，解析响应错误: {e}')
             raise ConnectionError(f"API登录失败，解析响应错误: {e}") # 抛出异常
 
-        return r # 即使失败也可能需要返回响应对象，但上面已改为抛异常
+        return token
 
     def get_video(self, video_id) -> requests.Response:
         url = self.api_url + '/video/' + video_id
         try:
-            r = requests.get(url, auth=BearerAuth(self.token), timeout=self.timeout) if self.token else requests.get(url, timeout=self.timeout)
+            r = self.session.get(url, auth=self.auth, timeout=self.timeout)
             r.raise_for_status() # 检查HTTP错误
-            print(f"[DEBUG] get_video {video_id} 响应: {r.status_code}")
+            logger.debug("get_video %s 响应: %s", video_id, r.status_code, extra={'video_id': video_id, 'stage': 'metadata'})
         except requests.exceptions.RequestException as e:
-            print(f"[错误] 获取视频信息 {video_id} 失败: {e}")
+            logger.error(f"获取视频信息 {video_id} 失败: {e}", extra={'video_id': video_id, 'stage': 'metadata'})
             raise # 将异常向上抛出，以便调用者处理
+        try:
+            self.video_cache.put(r.json())
+        except ValueError:
+            pass # 响应不是 JSON，不缓存
         return r
 
+    def get_video_info(self, video_id, require_file_url=False) -> dict:
+        '''
+        获取视频信息，优先使用缓存
+        :param video_id: 视频id
+        :param require_file_url: 是否需要 fileUrl (列表预存的条目不含 fileUrl，此时会请求 /video/{id})
+        :return: 视频信息 dict
+        '''
+        video_info = self.video_cache.get(video_id, require_file_url=require_file_url)
+        if video_info is not None:
+            return video_info
+        return self.get_video(video_id).json()
+
+    def seed_video_cache(self, videos):
+        '''
+        使用 /videos 列表结果预先填充视频信息缓存，已有的 (可能含 fileUrl 的) 条目不会被覆盖
+        :param videos: get_videos 响应中的 results 列表
+        '''
+        for video in videos:
+            if isinstance(video, dict):
+                self.video_cache.put(video, overwrite=False)
+
     # def check_videos(self,videos_response):
     #     try:
     #         videos = videos_response.json().get('results', [])  # 安全获取 results
@@ -114,16 +705,11 @@ class ApiClient:
                   'subscribed': 'true' if subscribed else 'false',
                   }
         try:
-            if self.token is None:
-                # 尝试在没有token的情况下获取，如果API需要则可能失败
-                print("[警告] 尝试在未登录状态下获取视频列表")
-                r = requests.get(url, params=params, timeout=self.timeout)
-            else:
-                r = requests.get(url, params=params, auth=BearerAuth(self.token), timeout=self.timeout)
+            r = self.session.get(url, params=params, auth=self.auth, timeout=self.timeout)
             r.raise_for_status() # 检查HTTP错误
-            print(f"[DEBUG] get_videos 响应: {r.status_code}")
+            logger.debug("get_videos 响应: %s", r.status_code)
         except requests.exceptions.RequestException as e:
-            print(f"[错误] 获取视频列表失败: {e}")
+            logger.error(f"获取视频列表失败: {e}")
             raise # 将异常向上抛出
 
         # r = self.check_videos(r)
@@ -137,280 +723,314 @@ class ApiClient:
         :param video_id: 视频id
         :return: 缩略图文件的完整路径，如果下载失败则返回 None
         '''
+        log = video_logger(logger, video_id, 'thumbnail')
         thumbnail_path = None # 初始化返回路径
         try:
-            video_info = self.get_video(video_id).json()
-
-            file_id = video_info.get('file', {}).get('id')
-            thumbnail_id = video_info.get('thumbnail')
-
-            if not file_id or thumbnail_id is None: # 检查是否成功获取到必要信息
-                 print(f"[错误] 视频 {video_id} 信息不完整，无法获取缩略图 ID。")
-                 return None
-
-            url = f"{self.file_url}/image/original/{file_id}/thumbnail-{thumbnail_id:02d}.jpg"
+            video_info = self.get_video_info(video_id)
+            url = thumbnail_url(video_id, video_info, self.file_url)
+            if url is None:
+                return None
 
             # 确保缩略图目录存在
             os.makedirs(THUMBNAIL_DIR, exist_ok=True)
 
-            # 定义缩略图文件名和完整路径
-            thumbnail_file_name = f"{video_id}.jpg"
-            thumbnail_path = os.path.join(THUMBNAIL_DIR, thumbnail_file_name)
-
-            if (os.path.exists(thumbnail_path)):
-                print(f"视频 {video_id} 的缩略图已存在于 {thumbnail_path}，跳过下载。")
-                return thumbnail_path
-
-            print(f"开始下载视频 {video_id} 的缩略图...")
-            with requests.get(url, stream=True, timeout=self.timeout, verify=False) as r_thumb:
-                r_thumb.raise_for_status() # 检查下载请求是否成功
-                with open(thumbnail_path, "wb") as f:
-                    for chunk in r_thumb.iter_content(chunk_size=8192): # 使用更大的块大小
-                        if chunk:
-                            f.write(chunk)
-                            # f.flush() # 通常不需要手动 flush
-            print(f"视频 {video_id} 的缩略图下载完成，保存至 {thumbnail_path}")
+            # 已有缩略图时跳过 (旧版本平铺的缩略图移到分片目录)
+            existing_path = self.thumbnails.relocate(video_id)
+            if existing_path is not None:
+                log.info(f"视频 {video_id} 的缩略图已存在于 {existing_path}，跳过下载。")
+                return existing_path
+            thumbnail_path = self.thumbnails.legacy_path(video_id)
+
+            log.info(f"开始下载视频 {video_id} 的缩略图...")
+            # 缩略图很小，一次读入；不使用 stream，读完后连接可以放回连接池
+            r_thumb = self.session.get(url, timeout=self.timeout, verify=False)
+            r_thumb.raise_for_status() # 检查下载请求是否成功
+            frames = []
+            if self.thumbnail_frames:
+                frame_urls = [thumbnail_url(video_id, video_info, self.file_url, frame=i) for i in range(THUMBNAIL_FRAME_COUNT)]
+                with ThreadPoolExecutor(max_workers=THUMBNAIL_FRAME_CONCURRENCY) as pool:
+                    frames = [data for data in pool.map(self._fetch_thumbnail_frame, frame_urls) if data]
+            # 按内容保存 (相同图片只存一份)，在后台进程中生成预览图
+            thumbnail_path = self.thumbnails.add(video_id, r_thumb.content, frames)
+            log.info(f"视频 {video_id} 的缩略图下载完成，保存至 {thumbnail_path}" + (f" (预览帧 {len(frames)} 张)" if frames else ""))
             return thumbnail_path
 
         except requests.exceptions.RequestException as e:
-            print(f"[错误] 下载视频 {video_id} 的缩略图失败 (请求错误): {e}")
+            log.error(f"下载视频 {video_id} 的缩略图失败 (请求错误): {e}")
             # 如果下载失败，尝试删除可能已创建的不完整文件
             if thumbnail_path and os.path.exists(thumbnail_path):
                 try:
                     os.remove(thumbnail_path)
                 except OSError as oe:
-                    print(f"[警告] 删除不完整的缩略图文件 {thumbnail_path} 失败: {oe}")
+                    log.warning(f"删除不完整的缩略图文件 {thumbnail_path} 失败: {oe}")
             return None # 返回 None 表示失败
         except KeyError as e:
-            print(f"[错误] 解析视频 {video_id} 信息以下载缩略图时出错 (缺少键: {e})")
+            log.error(f"解析视频 {video_id} 信息以下载缩略图时出错 (缺少键: {e})")
             return None
         except Exception as e:
-            print(f"[错误] 下载视频 {video_id} 的缩略图时发生未知错误: {e}")
+            log.error(f"下载视频 {video_id} 的缩略图时发生未知错误: {e}")
              # 同上，尝试删除不完整文件
             if thumbnail_path and os.path.exists(thumbnail_path):
                 try:
                     os.remove(thumbnail_path)
                 except OSError as oe:
-                    print(f"[警告] 删除不完整的缩略图文件 {thumbnail_path} 失败: {oe}")
+                    log.warning(f"删除不完整的缩略图文件 {thumbnail_path} 失败: {oe}")
             return None
 
-    def download_video_byAi_timeoutRetransmission_queue(self, video_id) -> tuple[str, int] | None:
+    def _fetch_thumbnail_frame(self, url) -> bytes | None:
+        '''
+        下载一张预览帧，失败时返回 None (预览帧缺失不影响封面)
+        '''
+        try:
+            r = self.session.get(url, timeout=self.timeout, verify=False)
+            r.raise_for_status()
+            return r.content
+        except requests.exceptions.RequestException as e:
+            logger.debug("下载预览帧 %s 失败: %s", url, e)
+            return None
+
+    def download_video_byAi_timeoutRetransmission_queue(self, video_id, progress_callback=None) -> tuple[str, int] | None:
         '''
         从iwara.tv下载视频，拥有超时重传和队列存储功能（队列功能在app.py实现）。
         :param video_id: 视频ID
-        :return: 成功时返回包含 (视频文件路径, 文件大小bytes) 的元组，失败时返回 None 或抛出异常。
+        :param progress_callback: 进度回调 callback(已下载字节数, 总字节数或None)
+        :return: 成功时返回包含 (视频文件路径, 文件大小bytes, 文件摘要) 的元组，失败时返回 None 或抛出异常。
         '''
+        log = video_logger(logger, video_id, 'download')
+        partial = self.partials.get(video_id)
+        if partial is not None and partial.is_complete():
+            # 数据已全部写入但上次没来得及完成 (重命名前中断)，不需要任何网络请求
+            return complete_partial(self.partials, partial)
         try:
-            video = self.get_video(video_id).json() # 获取视频信息
+            video = self.get_video_info(video_id, require_file_url=True) # 获取视频信息 (命中缓存时不请求 API)
         except Exception as e:
             # 注意：这里抛出的异常应该在调用处（如 download_worker）被捕获
-            raise Exception(f"无法获取视频 {video_id} 的信息，错误: {e}")
+            raise Exception(f"无法获取视频 {video_id} 的信息，错误: {e}") from e
 
-        url = video.get('fileUrl')
-        file_info = video.get('file')
-        if not url or not file_info or 'id' not in file_info:
-             raise Exception(f"视频 {video_id} 信息不完整，缺少 fileUrl 或 file.id")
-
-        file_id = file_info['id']
-        # 解析 expires (更健壮的方式)
-        try:
-            query_params = urllib3.util.parse_url(url).query
-            expires = dict(p.split('=') for p in query_params.split('&')).get('expires')
-            if not expires:
-                raise ValueError("无法从 fileUrl 中解析 expires 参数")
-        except Exception as e:
-             raise Exception(f"解析视频 {video_id} 的 fileUrl 出错: {e}")
-
-        SHA_postfix = "_5nFp9kmbNnHdAFhaqMvt"
-        SHA_key = file_id + "_" + expires + SHA_postfix
-        hash_val = hashlib.sha1(SHA_key.encode('utf-8')).hexdigest() # 使用 hash_val 避免覆盖内置函数 hash
-        headers = {"X-Version": hash_val}
+        url, headers = resource_request(video_id, video)
 
+        resources_breaker = get_breaker(url)
+        resources_breaker.wait()
         try:
             # 获取下载资源链接
-            resources_resp = requests.get(url, headers=headers, auth=BearerAuth(self.token), timeout=self.timeout)
+            resources_resp = self.session.get(url, headers=headers, auth=self.auth, timeout=self.timeout)
             resources_resp.raise_for_status()
+            resources_breaker.record_success()
             resources = resources_resp.json()
         except requests.exceptions.RequestException as e:
-            raise Exception(f"获取视频 {video_id} 下载资源链接失败: {e}")
+            self.video_cache.invalidate(video_id) # fileUrl 可能已失效，下次重试重新获取
+            resources_breaker.record_failure(classify_error(e), retry_after(e))
+            raise Exception(f"获取视频 {video_id} 下载资源链接失败: {e}") from e
         except Exception as e: # 包括 JSONDecodeError
-            raise Exception(f"解析视频 {video_id} 下载资源响应失败: {e}")
-
-        download_link = None
-        file_type = 'mp4' # 默认文件类型
-        # 优先寻找 Source 清晰度
-        for resource in resources:
-            if resource.get('name') == 'Source' and resource.get('src', {}).get('download'):
-                download_link = "https:" + resource['src']['download']
-                if 'type' in resource and '/' in resource['type']:
-                    file_type = resource['type'].split('/')[1]
-                break
-
-        # 如果没有 Source，尝试寻找其他可用链接 (这里可以根据需要扩展逻辑，例如选择最高分辨率)
-        if not download_link and resources:
-             # 简单地选择第一个找到的链接作为备选
-             first_resource = resources[0]
-             if first_resource.get('src', {}).get('download'):
-                 download_link = "https:" + first_resource['src']['download']
-                 if 'type' in first_resource and '/' in first_resource['type']:
-                    file_type = first_resource['type'].split('/')[1]
-                 print(f"[警告] 未找到 {video_id} 的 Source 清晰度，将下载其他可用清晰度。")
-
-        if not download_link:
-            raise Exception(f"视频 {video_id} 未找到可用的下载链接")
-
-        # 使用 DOWNLOAD_DIR 拼接完整文件路径
-        video_file_name = os.path.join(DOWNLOAD_DIR, f"{video_id}.{file_type}")
-
-        print(f"[DEBUG] 视频 {video_id} 下载链接: {download_link}")
-        print(f"[DEBUG] 视频 {video_id} 保存路径: {video_file_name}")
-
-        # 确保下载目录存在
-        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+            self.video_cache.invalidate(video_id)
+            raise Exception(f"解析视频 {video_id} 下载资源响应失败: {e}") from e
 
-        # --- 断点续传和下载逻辑 ---
-        resume_byte_pos = 0
-        if os.path.exists(video_file_name):
-            resume_byte_pos = os.path.getsize(video_file_name)
-            print(f"文件 {video_file_name} 已存在，大小: {resume_byte_pos} bytes。尝试断点续传。")
+        download_link, file_type = select_download_resource(video_id, resources)
+
+        # 按存储布局确定完整文件路径 (hot 根目录中的分片目录，目录不存在时创建)
+        video_file_name = self.storage.video_path(video_id, file_type)
+
+        log.debug("视频 %s 下载链接: %s", video_id, download_link)
+        log.debug("视频 %s 保存路径: %s", video_id, video_file_name)
 
-        headers_download = {'Range': f'bytes={resume_byte_pos}-'} if resume_byte_pos > 0 else {}
-        headers_download['User-Agent'] = 'Mozilla/5.0' # 添加 User-Agent 可能有助于避免某些服务器阻止
+        # 数据写入 hot 根目录中的 {视频文件名}.part，完成后才重命名为最终文件名
+        partial = self.partials.open(video_id, video_file_name)
+        if partial.is_complete():
+            return complete_partial(self.partials, partial)
 
-        max_retries = MAX_RETRIES # 下载重试次数
-        downloaded_size = resume_byte_pos # 初始化已下载大小
-        total_size = None # 初始化总大小
+        # --- 分段并行下载 (文件大小已知且足够大时，或续传分段下载留下的记录) ---
+        if self.segments > 1 or 'segments' in partial.meta:
+            result = self.download_segmented(video_id, download_link, partial, progress_callback=progress_callback)
+            if result is not None:
+                return result
+
+        # --- 断点续传和下载逻辑 ---
+        if partial.size > 0:
+            log.info(f"未完成下载 {partial.path} 已有 {partial.size} bytes。尝试断点续传。")
+
+        policy = DOWNLOAD_RETRY
+        max_retries = policy.max_attempts # 下载重试次数
+        breaker = get_breaker(download_link) # CDN 节点熔断期间在这里等待，不消耗重试次数
 
         for attempt in range(max_retries):
-            print(f"尝试下载视频 {video_id}，第 {attempt + 1}/{max_retries} 次...")
+            breaker.wait()
+            log.info(f"尝试下载视频 {video_id}，第 {attempt + 1}/{max_retries} 次...")
+            resume_byte_pos = partial.size # 从已写入的数据之后继续
+            headers_download = range_headers(resume_byte_pos, if_range=partial.if_range())
             try:
-                with requests.get(download_link, headers=headers_download, stream=True, timeout=self.download_timeout, verify=False) as response:
+                with self.session.get(download_link, headers=headers_download, stream=True, timeout=self.download_timeout, verify=False) as response:
 
-                    # 处理 416 Range Not Satisfiable
+                    # 处理 416 Range Not Satisfiable：确认本地文件是否已完整，否则从头下载
                     if response.status_code == 416:
-                        print(f"收到 416 状态码，服务器不支持请求的范围 (可能文件已完整或 Range={resume_byte_pos}- 无效)")
-                        # 检查文件是否真的完整
-                        try:
-                            head_resp = requests.head(download_link, timeout=self.timeout, verify=False, allow_redirects=True)
-                            server_total_size = int(head_resp.headers.get('Content-Length', 0))
-                            if server_total_size > 0 and resume_byte_pos >= server_total_size or server_total_size == 0:
-                                print(f"文件 {video_file_name} 已完整 (本地 {resume_byte_pos} >= 服务器 {server_total_size})。")
-                                return video_file_name, resume_byte_pos # 返回现有文件路径和大小
-                            else:
-                                print(f"文件不完整或服务器报告大小为0/未知，将重新下载。删除本地文件...")
-                                os.remove(video_file_name)
-                                resume_byte_pos = 0
-                                downloaded_size = 0
-                                headers_download = {'User-Agent': 'Mozilla/5.0'} # 重置 headers
-                                continue # 进入下一次尝试（无 Range）
-                        except Exception as head_err:
-                             print(f"[警告] 检查文件总大小失败: {head_err}。假设文件已完成。")
-                             return video_file_name, resume_byte_pos # 乐观地假设完成
+                        log.info(f"收到 416 状态码，服务器不支持请求的范围 (可能文件已完整或 Range={resume_byte_pos}- 无效)")
+                        total_size = unsatisfiable_total(response.headers, partial) or self.probe_file_size(download_link)
+                        if settle_unsatisfiable(partial, total_size):
+                            return complete_partial(self.partials, partial)
+                        continue # 进入下一次尝试（无 Range）
 
                     # 检查其他错误状态码
                     response.raise_for_status() # Raises HTTPError for bad responses (4xx or 5xx)
+                    breaker.record_success()
+
+                    mode, total_size, hasher = begin_stream(partial, download_link, response.status_code, response.headers, resume_byte_pos)
+                    downloaded_size = resume_byte_pos if mode == 'ab' else 0
+
+                    last_print_time = time.time()
+                    # 响应体直接读入池中的缓冲区并写入文件 (无用户态写缓冲)，按总大小预分配剩余空间
+                    with BUFFER_POOL.borrow() as buffer, FileSink(partial.path, mode, total_size=total_size) as sink:
+                        for chunk in iter_response_into(response, buffer):
+                            nbytes = len(chunk)
+                            if self.bandwidth_limiter is not None:
+                                self.bandwidth_limiter.consume(nbytes, video_id)
+                            write_blocks(sink, partial, hasher, chunk)
+                            downloaded_size += nbytes
+                            if progress_callback is not None:
+                                progress_callback(downloaded_size, total_size)
+                            # 简单的进度显示 (每 60 秒打印一次)
+                            current_time = time.time()
+                            if current_time - last_print_time > 60:
+                                if total_size:
+                                    progress = (downloaded_size / total_size) * 100
+                                    log.info(f"  下载中 {video_id}: {downloaded_size / 1024 / 1024:.1f} / {total_size / 1024 / 1024:.1f} MB ({progress:.1f}%)")
+                                else:
+                                    log.info(f"  下载中 {video_id}: {downloaded_size / 1024 / 1024:.1f} MB")
+                                last_print_time = current_time
+                        sink.finish() # 按 FSYNC_POLICY 落盘
 
-                    # 尝试获取总大小 (Content-Range 优先于 Content-Length for 206 Partial Content)
-                    if 'Content-Range' in response.headers:
-                        try:
-                            total_size = int(response.headers['Content-Range'].split('/')[-1])
-                        except:
-                            print("[警告] 无法从 Content-Range 解析总大小。")
-                            total_size = None
-                    elif 'Content-Length' in response.headers and response.status_code == 200: # 只有 200 状态码的 CL 才代表完整文件大小
-                        total_size = int(response.headers.get('Content-Length', 0))
+                # 下载循环结束后检查完整性；不完整时等待后从已写入的位置续传
+                result = complete_stream(self.partials, partial, total_size, hasher)
+                if result is not None:
+                    return result
+                time.sleep(policy.delay(attempt))
 
-                    if total_size:
-                         print(f"文件: {video_file_name}, 预期总大小: {total_size / 1024:.1f} KB ({total_size / 1024 / 1024:.1f} MB)")
-                    else:
-                        print(f"文件: {video_file_name}, 未能从响应头获取准确总大小。")
+            except Exception as e:
+                # 按错误分类决定是否原地重试：网络错误、429、5xx 重试；404、签名过期等直接抛出交给上层
+                time.sleep(policy.next_delay(e, attempt, f"下载视频 {video_id}", breaker=breaker, log=log))
 
+        # 如果循环结束仍未成功返回，则表示所有重试都失败了 (最后一次为下载不完整)
+        raise RetryExhaustedError(f"视频 {video_id} 下载失败，已达到最大重试次数 ({max_retries}次)。", ERROR_TRANSIENT)
 
-                    mode = "ab" if resume_byte_pos > 0 and response.status_code == 206 else "wb" # 只有在续传成功时才用 'ab'
-                    if mode == "wb": # 如果是重新下载，重置 downloaded_size
-                        downloaded_size = 0
+    def probe_file_size(self, download_link, partial=None) -> int | None:
+        '''
+        获取远端文件总大小 (请求 bytes=0-0，从 Content-Range 中解析)
+        :param download_link: 下载链接
+        :param partial: PartialDownload，给出时同时记录服务器的校验信息 (ETag / Last-Modified)
+        :return: 文件大小 bytes，服务器不支持 Range 或无法得知时返回 None
+        '''
+        with self.session.get(download_link, headers=range_headers(0, 0), stream=True, timeout=self.timeout, verify=False) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                return None
+            total_size = response_total_size(r.status_code, r.headers)
+            if partial is not None:
+                partial.record_response(download_link, r.headers, total_size)
+            return total_size
 
-                    chunk_count = 0
-                    last_print_time = time.time()
-                    with open(video_file_name, mode) as f:
-                        for chunk in response.iter_content(chunk_size=8192 * 4): # 增加 chunk 大小
-                            if chunk:
-                                f.write(chunk)
-                                downloaded_size += len(chunk)
-                                chunk_count += 1
-                                # 简单的进度显示 (可选, 每秒或每下载一定量数据打印一次)
-                                current_time = time.time()
-                                if current_time - last_print_time > 60: # 每 60 秒打印一次进度
-                                    if total_size:
-                                        progress = (downloaded_size / total_size) * 100
-                                        print(f"  下载中 {video_id}: {downloaded_size / 1024 / 1024:.1f} / {total_size / 1024 / 1024:.1f} MB ({progress:.1f}%)")
-                                    else:
-                                        print(f"  下载中 {video_id}: {downloaded_size / 1024 / 1024:.1f} MB")
-                                    last_print_time = current_time
-                                # f.flush() # 通常不需要手动 flush
-
-                    # 下载循环结束后检查完整性
-                    # 获取最终文件大小
-                    final_file_size = os.path.getsize(video_file_name)
-                    if total_size is not None:
-                        if final_file_size < total_size:
-                            # 注意：这里不应该直接 raise Exception，因为这会阻止重试
-                            print(f"[警告] 下载 {video_id} 可能不完整：预期 {total_size} 字节，实际 {final_file_size} 字节。将在下次重试继续。")
-                            # 更新续传位置，准备下一次重试
-                            resume_byte_pos = final_file_size
-                            headers_download['Range'] = f'bytes={resume_byte_pos}-'
-                            time.sleep(2) # 等待一下再重试
-                            continue # 继续到下一个 attempt
-                        else:
-                            print(f"视频 {video_id} 下载完成并校验大小成功，保存为 {video_file_name}")
-                            return video_file_name, final_file_size # 成功返回
-                    else:
-                        # 如果无法获取总大小，则认为下载循环无异常即成功
-                        print(f"视频 {video_id} 下载完成 (未进行大小校验)，保存为 {video_file_name}")
-                        return video_file_name, final_file_size # 成功返回
-
-            except IncompleteRead as e:
-                 # IncompleteRead 通常发生在连接意外关闭时，适合重试
-                 print(f"[错误] 下载视频 {video_id} 时发生 IncompleteRead (尝试 {attempt + 1}/{max_retries}): {e}")
-                 print(f"  部分数据可能已下载 ({e.partial} bytes). 等待后重试...")
-                 # 更新续传位置
-                 if os.path.exists(video_file_name):
-                      resume_byte_pos = os.path.getsize(video_file_name)
-                 else:
-                      resume_byte_pos = 0 # 如果文件不存在，从头开始
-                 downloaded_size = resume_byte_pos # 更新已下载大小计数器
-                 headers_download['Range'] = f'bytes={resume_byte_pos}-'
-                 time.sleep(5 * (attempt + 1)) # 增加等待时间重试
-
-            except requests.exceptions.RequestException as e:
-                print(f"[错误] 下载视频 {video_id} 时发生网络或HTTP错误 (尝试 {attempt + 1}/{max_retries}): {e}")
-                # 更新续传位置
-                if os.path.exists(video_file_name):
-                    resume_byte_pos = os.path.getsize(video_file_name)
-                else:
-                    resume_byte_pos = 0
-                downloaded_size = resume_byte_pos
-                headers_download['Range'] = f'bytes={resume_byte_pos}-'
-                time.sleep(5) # 等待后重试
+    def download_segmented(self, video_id, download_link, partial, progress_callback=None) -> tuple[str, int] | None:
+        '''
+        分段并行下载 (见 SegmentPlan)：self.segments 个连接同时下载，按偏移直接写入预分配的 .part 文件。
+        已完成的分段记录在未完成下载的元数据中，中断后只需重新下载未完成的分段，且不需要再次探测文件大小。
+        :param video_id: 视频ID
+        :param download_link: 下载链接
+        :param partial: 视频的 PartialDownload
+        :param progress_callback: 进度回调 callback(已下载字节数, 总字节数)
+        :return: 成功时返回 (视频文件路径, 文件大小bytes, 文件摘要)；不适合分段下载时返回 None (由调用方使用单连接下载)
+        '''
+        log = video_logger(logger, video_id, 'segment')
+        plan = SegmentPlan.resume(partial)
+        if plan is None:
+            if partial.size > 0 or self.segments <= 1:
+                return None # 单连接下载留下的部分文件，继续按原方式续传
+            try:
+                total_size = self.probe_file_size(download_link, partial)
+            except (RequestException, ValueError) as e:
+                log.warning(f"获取视频 {video_id} 文件大小失败，使用单连接下载: {e}")
+                return None
+            if total_size is None or total_size < self.segment_min_size:
+                return None
+            plan = SegmentPlan.create(partial, total_size, self.segments)
+        log.info(f"视频 {video_id} 分段下载: {len(plan.ranges)} 段，每段 {plan.state['segment_size'] / 1024 / 1024:.1f} MB，剩余 {len(plan.pending)} 段")
 
-            except Exception as e:
-                # 其他未知错误，可能不适合重试，直接抛出让上层处理
-                print(f"[严重错误] 下载视频 {video_id} 时发生未知错误 (尝试 {attempt + 1}/{max_retries}): {e}")
-                # 检查是否是特定可重试的消息
-                if "需稍后重试" in str(e) and attempt < max_retries - 1:
-                     print("检测到“需稍后重试”消息，将进行重试...")
-                     time.sleep(10) # 等待较长时间
-                     # 更新续传位置
-                     if os.path.exists(video_file_name):
-                        resume_byte_pos = os.path.getsize(video_file_name)
-                     else:
-                        resume_byte_pos = 0
-                     downloaded_size = resume_byte_pos
-                     headers_download['Range'] = f'bytes={resume_byte_pos}-'
-                     continue # 继续下一次重试
-                else:
-                    # 对于其他未知错误或达到最大重试次数，向上抛出
-                    raise Exception(f"视频 {video_id} 下载失败，发生未知错误或达到最大重试次数: {e}")
-
-        # 如果循环结束仍未成功返回，则表示所有重试都失败了
-        raise Exception(f"视频 {video_id} 下载失败，已达到最大重试次数 ({max_retries}次)。")
\ No newline at end of file
+        def on_bytes(nbytes):
+            current = plan.add_progress(nbytes)
+            if progress_callback is not None:
+                progress_callback(current, plan.total_size)
+
+        try:
+            fd = plan.open()
+            try:
+                stop = threading.Event() # 任一分段最终失败时通知其他分段停止
+
+                def fetch(segment):
+                    index, start, end = segment
+                    block_digests = self._download_segment(video_id, download_link, fd, start, end, on_bytes=on_bytes, if_range=plan.if_range, stop=stop)
+                    if block_digests is not None: # 因其他分段失败而中止时不标记完成
+                        plan.mark_done(fd, index, block_digests)
+
+                with ThreadPoolExecutor(max_workers=max(1, self.segments)) as pool:
+                    futures = [pool.submit(fetch, segment) for segment in plan.pending]
+                    wait(futures, return_when=FIRST_EXCEPTION)
+                    failed = next((f for f in futures if f.done() and not f.cancelled() and f.exception() is not None), None)
+                    if failed is not None:
+                        # 任一分段最终失败：取消尚未开始的分段并让正在下载的分段尽快停止，立即抛出异常；
+                        # 已完成的分段保留在记录中，续传时只下载其余分段
+                        stop.set()
+                        for future in futures:
+                            future.cancel()
+                        failed.result()
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except RemoteFileChanged as e:
+            log.warning(f"视频 {video_id} 在服务器上已变化，丢弃已下载的分段，使用单连接重新下载: {e}")
+            partial.restart()
+            return None
+
+        return complete_partial(self.partials, partial)
+
+    def _download_segment(self, video_id, download_link, fd, start, end, on_bytes=None, if_range=None, stop=None):
+        '''
+        下载 [start, end] 字节范围并写入 fd 的对应偏移，失败时从已写入的位置继续重试
+        :param on_bytes: 每写入一块数据后的回调 on_bytes(字节数)
+        :param if_range: 已下载部分对应的 ETag / Last-Modified，服务器上的文件变化时抛出 RemoteFileChanged
+        :param stop: threading.Event，被设置时尽快停止 (其他分段已失败)
+        :return: 该分段的块摘要列表 (start 需对齐到 HASH_BLOCK_SIZE)；被 stop 中止时为 None
+        '''
+        log = video_logger(logger, video_id, 'segment')
+        policy = DOWNLOAD_RETRY
+        breaker = get_breaker(download_link)
+        hasher = BlockHasher()
+        stop = stop or threading.Event()
+        pos = start
+        for attempt in range(policy.max_attempts):
+            breaker.wait()
+            if stop.is_set():
+                return None
+            try:
+                with self.session.get(download_link, headers=range_headers(pos, end, if_range), stream=True, timeout=self.download_timeout, verify=False) as response:
+                    response.raise_for_status()
+                    if response.status_code == 200 and if_range:
+                        raise RemoteFileChanged(f"If-Range {if_range} 不匹配")
+                    if response.status_code != 206:
+                        raise RequestException(f"服务器未返回分段内容 (状态码 {response.status_code})")
+                    breaker.record_success()
+                    with BUFFER_POOL.borrow() as buffer:
+                        for chunk in iter_response_into(response, buffer):
+                            if self.bandwidth_limiter is not None:
+                                self.bandwidth_limiter.consume(len(chunk), video_id) # 同一视频的各分段共用一份带宽
+                            pos = write_segment(fd, chunk, pos, end, hasher, on_bytes)
+                            if stop.is_set():
+                                return None
+                            if pos > end:
+                                break
+                if pos > end:
+                    return hasher.block_list() # 只有最后一个分段可能包含不完整的块
+                log.warning(f"视频 {video_id} 分段 {start}-{end} 不完整，已写入至 {pos}，将继续重试。")
+                record_retry('segment', 'IncompleteRead')
+            except RemoteFileChanged:
+                raise
+            except (IncompleteRead, RequestException, TimeoutError) as e: # 直接读取底层连接时超时不经过 requests 包装
+                delay = policy.next_delay(e, attempt, f"下载视频 {video_id} 分段 {start}-{end}", breaker=breaker, log=log, stage='segment')
+                if stop.wait(delay):
+                    return None
+        raise RetryExhaustedError(f"视频 {video_id} 分段 {start}-{end} 下载失败，已达到最大重试次数 ({policy.max_attempts}次)。", ERROR_TRANSIENT)
@@ -3,16 +3,36 @@ import os
 import time
 import queue
 import json
+import sqlite3
 import threading # 导入 threading
 
-from threading import Thread
-
-from api_client import ApiClient, DOWNLOAD_DIR, THUMBNAIL_DIR # 导入ApiClient和目录常量
-from http.client import IncompleteRead
+from api_client import ApiClient, BASE_DATA_DIR, DOWNLOAD_DIR, THUMBNAIL_DIR, get_storage_layout, get_thumbnail_store # 导入ApiClient和目录常量
+from scheduler import DownloadScheduler, video_priority, video_expected_size
+from ledger import DownloadLedger, LEDGER_FILE_NAME, LEGACY_LOG_FILE_NAME
+from archive_index import CompletedIndex
+from crawl_planner import CrawlSource, CrawlPlanner
+from inflight import InflightRegistry
+from log_config import get_logger, video_logger, setup_logging
+from metrics import DOWNLOAD_TRACKER, LEDGER_WRITE_SECONDS, record_retry
+from static_export import StaticExporter
+from storage import StorageMigrator
+from job_queue import JobQueue, JOBS_FILE_NAME, JOB_PRIORITY_BATCH, JOB_PRIORITY_SUBSCRIBED
+from retry_policy import JOB_RETRY, ERROR_AUTH, ERROR_MALFORMED, classify_error
 from requests.exceptions import RequestException # 导入 requests 的异常
 
 # 定义日志文件名
-LOG_FILE = "download_log.json"
+logger = get_logger(__name__)
+
+LOG_FILE = "download_log.json" # 旧版 JSON 日志，仅用于首次迁移到账本
+LEDGER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), LEDGER_FILE_NAME)
+# 下载中视频的锁文件目录 (批量任务与 web 服务共用)
+INFLIGHT_DIR = os.path.join(DOWNLOAD_DIR, ".inflight")
+# 持久化下载任务队列 (web 服务与批量任务共用)
+JOBS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), JOBS_FILE_NAME)
+# 下载记录的静态导出目录 (由静态文件服务器提供，见 static_export.py)
+STATIC_EXPORT_DIR = os.path.join(BASE_DATA_DIR, "static")
+# download_video_stage 的返回值：视频已由其他任务下载，本次没有下载 (结果由正在下载的任务记录)
+DOWNLOAD_ATTACHED = "attached"
 config_path = ""
 
 email = "your_email@example.com"  # 替换为你的邮箱
@@ -24,30 +44,139 @@ def json_read():
     global LOG_FILE
 
     base_path = os.path.dirname(os.path.abspath(__file__))
-    print(f"base_path: {base_path}")
+    logger.debug("base_path: %s", base_path)
     config_path = os.path.join(base_path, 'config.json')
-    print(f"config_path: {config_path}")
+    logger.debug("config_path: %s", config_path)
     LOG_FILE = os.path.join(base_path, 'download_log.json')
-    print(f"LOG_FILE: {LOG_FILE}")
+    logger.debug("LOG_FILE: %s", LOG_FILE)
 
     try:
         with open(config_path, 'r') as f:
             data = json.load(f)
         return data
     except FileNotFoundError:
-        print("config.json not found")
+        logger.error("config.json not found")
     except json.JSONDecodeError as e:
-        print(f"config.json 格式错误:{e}")
+        logger.error(f"config.json 格式错误:{e}")
     return None
 
-# --- 新增：JSON 日志记录函数 ---
-def log_download_info(lock, video_id,avatar_name,video_title,video_numComments,video_numLikes,video_numViews,video_tagList,video_createTime,timestamp, video_path, thumbnail_path,  video_size_bytes, success):
+# --- 下载账本 ---
+_ledger = None
+_ledger_init_lock = threading.RLock()
+
+def get_ledger():
+    """
+    获取进程内共享的下载账本 (首次调用时打开，并从旧的 download_log.json 迁移)。
+
+    Returns:
+        DownloadLedger: 下载账本。
+    """
+    global _ledger
+    if _ledger is None:
+        with _ledger_init_lock:
+            if _ledger is None:
+                base_path = os.path.dirname(os.path.abspath(__file__))
+                _ledger = DownloadLedger(LEDGER_FILE, legacy_json_path=os.path.join(base_path, LEGACY_LOG_FILE_NAME))
+    return _ledger
+
+_completed_index = None
+
+def get_completed_index():
+    """
+    获取已完成视频索引 (首次调用时从账本和各存储根目录加载)。
+
+    Returns:
+        CompletedIndex: 已完成视频索引。
+    """
+    global _completed_index
+    if _completed_index is None:
+        with _ledger_init_lock:
+            if _completed_index is None:
+                roots = [root.path for root in get_storage_layout().roots]
+                _completed_index = CompletedIndex.load(get_ledger(), roots, exclude=[THUMBNAIL_DIR])
+    return _completed_index
+
+_inflight_registry = None
+
+def get_inflight_registry():
+    """
+    获取下载中视频登记表，用于防止同一视频被多个线程/进程同时下载。
+
+    Returns:
+        InflightRegistry: 下载中视频登记表。
+    """
+    global _inflight_registry
+    if _inflight_registry is None:
+        with _ledger_init_lock:
+            if _inflight_registry is None:
+                _inflight_registry = InflightRegistry(INFLIGHT_DIR)
+    return _inflight_registry
+
+_job_queue = None
+
+def get_job_queue():
+    """
+    获取持久化下载任务队列。
+
+    Returns:
+        JobQueue: 下载任务队列。
+    """
+    global _job_queue
+    if _job_queue is None:
+        with _ledger_init_lock:
+            if _job_queue is None:
+                _job_queue = JobQueue(JOBS_FILE)
+    return _job_queue
+
+_static_exporter = None
+
+def get_static_exporter():
+    """
+    获取下载记录的静态导出器。
+
+    Returns:
+        StaticExporter: 静态导出器。
+    """
+    global _static_exporter
+    if _static_exporter is None:
+        with _ledger_init_lock:
+            if _static_exporter is None:
+                _static_exporter = StaticExporter(get_ledger(), STATIC_EXPORT_DIR)
+    return _static_exporter
+
+_storage_migrator = None
+
+def get_storage_migrator():
+    """
+    获取存储迁移器 (把视频移到存储布局规定的位置，并更新账本中的路径)。
+
+    Returns:
+        StorageMigrator: 存储迁移器。
+    """
+    global _storage_migrator
+    if _storage_migrator is None:
+        with _ledger_init_lock:
+            if _storage_migrator is None:
+                _storage_migrator = StorageMigrator(get_storage_layout(), get_ledger(), get_completed_index(), get_thumbnail_store(),
+                                                    is_active=get_inflight_registry().is_active)
+    return _storage_migrator
+
+def export_static():
     """
-    记录视频下载信息到 JSON 文件。
-    使用锁来确保线程安全。
+    增量更新静态导出 (账本没有变化时不做任何事)，失败只记录日志。
+    """
+    try:
+        get_static_exporter().export()
+    except (OSError, sqlite3.Error) as e:
+        logger.error(f"静态导出失败: {e}")
+
+def log_download_info(lock, video_id,avatar_name,video_title,video_numComments,video_numLikes,video_numViews,video_tagList,video_createTime,timestamp, video_path, thumbnail_path,  video_size_bytes, success, video_digest=None, video_rating=None):
+    """
+    记录视频下载信息到下载账本。
+    账本每次只写入一条记录，并自行保证线程/进程安全。
 
     Args:
-        lock (threading.Lock): 用于文件访问的锁。
+        lock (threading.Lock): 保留参数，兼容旧调用 (账本内部已加锁)。
         video_id (str): 视频ID。
         avatar_name: 视频作者
         video_title: 视频名称
@@ -61,138 +190,240 @@ def log_download_info(lock, video_id,avatar_name,video_title,video_numComments,v
         thumbnail_path (str | None): 缩略图文件存储路径 (可能为 None)。
         video_size_bytes (int): 视频文件大小 (bytes)，失败时为 0。
         success (bool): 下载是否成功。
-        local_id: 本地序列号
+        video_digest (str | None): 视频文件摘要 (见 integrity.py)，失败时为 None。
+        video_rating (str | None): 视频分级 (general / ecchi)。
     """
-    with lock: # 获取锁，保证只有一个线程能写入文件
-        try:
-            # 读取现有日志数据
-            if os.path.exists(LOG_FILE):
-                with open(LOG_FILE, 'r', encoding='utf-8') as f:
-                    try:
-                        log_data = json.load(f)
-                    except json.JSONDecodeError:
-                        print(f"[警告] 日志文件 {LOG_FILE} 格式错误，将创建新的日志。")
-                        log_data = {} # 如果文件损坏，则重置
-            else:
-                log_data = {} # 文件不存在，创建空字典
-
-            # 如果查不到此条目则说明是新的条目，总数+1, 本地序列号为最新序列号
-            # 如果查得到，则本地序列号不变
-            if not log_data.get(video_id):
-                log_data['total']['number'] += 1
-                local_id = log_data['total']['number']
-            else:
-                local_id = log_data[video_id]['local_id']
-                # 如果查得到本地序列号，则判断视频是否已经下载完成
-                # 如果视频已经下载完成则直接退出
-                if log_data[video_id]['success']:
-                    print("视频已经下载完成，修改json文件失败")
-                    return
-
-                # 如果查得到是本地序列号，说明条目已存在，查询是否已经曾下载完成
-                # 如果视频已经下载完成则直接退出
-                if log_data[video_id]['success']:
-                    return
-
-            # 准备新的日志条目
-            video_size_mb = round(video_size_bytes / (1024 * 1024), 1) if video_size_bytes else 0.0
-            log_entry = {
-                "video_id": video_id,
-                "avatar_name": avatar_name,
-                "video_title": video_title,
-                "video_numComments": video_numComments,
-                "video_numLikes": video_numLikes,
-                "video_numViews": video_numViews,
-                "video_tagList": video_tagList,
-                "video_createTime": video_createTime,
-                "download_time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
-                "video_path": video_path,
-                "thumbnail_path": thumbnail_path,
-                "video_size_mb": video_size_mb,
-                "success": success,
-                "local_id": local_id,
-                "last_update_timestamp": timestamp # 添加原始时间戳以备将来排序或比较
-            }
-
-            # 更新或添加条目 (使用 video_id 作为 key)
-            log_data[video_id] = log_entry
-            print(f"[日志] 更新视频 {video_id} 的下载状态: {'成功' if success else '失败'}")
-
-            # 写回 JSON 文件
-            with open(LOG_FILE, 'w', encoding='utf-8') as f:
-                json.dump(log_data, f, ensure_ascii=False, indent=4) # indent 参数使 JSON 文件更易读
-
-        except IOError as e:
-            print(f"[严重错误] 无法写入日志文件 {LOG_FILE}: {e}")
-        except Exception as e:
-            print(f"[严重错误] 记录日志时发生未知错误: {e}")
+    log = video_logger(logger, video_id, 'ledger')
+    # 准备新的日志条目 (local_id 由账本分配: 新条目为最新序列号，已有条目不变)
+    video_size_mb = round(video_size_bytes / (1024 * 1024), 1) if video_size_bytes else 0.0
+    log_entry = {
+        "video_id": video_id,
+        "avatar_name": avatar_name,
+        "video_title": video_title,
+        "video_numComments": video_numComments,
+        "video_numLikes": video_numLikes,
+        "video_numViews": video_numViews,
+        "video_tagList": video_tagList,
+        "video_createTime": video_createTime,
+        "video_rating": video_rating,
+        "download_time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+        "video_path": video_path,
+        "thumbnail_path": thumbnail_path,
+        "video_size_mb": video_size_mb,
+        "video_digest": video_digest,
+        "success": success,
+        "last_update_timestamp": timestamp # 添加原始时间戳以备将来排序或比较
+    }
 
-# --- 修改：下载工作线程函数 ---
-def download_worker(client, video_id, failed_queue, log_lock,avatar_name,video_title,video_numComments,video_numLikes,video_numViews,video_tagList,video_createTime):
+    try:
+        with LEDGER_WRITE_SECONDS.time():
+            local_id = get_ledger().record(log_entry)
+        if success:
+            get_completed_index().add(video_id, video_path, video_size_bytes)
+        if local_id is None:
+            # 如果视频已经下载完成则不修改记录
+            log.warning("视频已经下载完成，修改json文件失败")
+            return
+        log.info(f"更新视频 {video_id} 的下载状态: {'成功' if success else '失败'}")
+    except sqlite3.Error as e:
+        log.error(f"无法写入下载账本 {LEDGER_FILE}: {e}")
+    except Exception as e:
+        log.error(f"记录日志时发生未知错误: {e}")
+
+def extract_video_meta(video):
     """
-    单个视频的下载工作线程，包括缩略图下载、视频下载、重试和日志记录。
+    从视频信息 (列表条目或 /video/{id} 响应) 中提取日志需要的字段。
+
+    Args:
+        video (dict): 视频信息。
+
+    Returns:
+        tuple: (avatar_name, video_title, video_numComments, video_numLikes, video_numViews, video_tagList, video_createTime, video_rating)
+    """
+    avatar_name = (video.get('user') or {}).get('name')
+    video_title = video.get('title')
+    video_numComments = video.get('numComments')
+    video_numLikes = video.get('numLikes')
+    video_numViews = video.get('numViews')
+    video_tagList = [tag['id'] for tag in video.get('tags') or []]
+    video_createTime = video.get('createdAt')
+    video_rating = video.get('rating')
+    return avatar_name, video_title, video_numComments, video_numLikes, video_numViews, video_tagList, video_createTime, video_rating
+
+def download_thumbnail_stage(client, video_id):
+    """
+    下载缩略图 (不影响视频下载流程，但记录结果)。
+
+    Args:
+        client (ApiClient): API 客户端实例。
+        video_id (str): 视频ID。
+
+    Returns:
+        str | None: 缩略图路径，失败时为 None。
+    """
+    log = video_logger(logger, video_id, 'thumbnail')
+    thumbnail_path = None
+    try:
+        thumbnail_path = client.download_video_thumbnail(video_id)
+        if thumbnail_path:
+            log.info(f"缩略图 {video_id} 下载成功: {thumbnail_path}")
+        else:
+            log.info(f"缩略图 {video_id} 下载失败或已跳过")
+    except Exception as thumb_e:
+        # 即使缩略图下载失败，也继续尝试下载视频
+        log.error(f"下载缩略图 {video_id} 时发生异常: {thumb_e}")
+    return thumbnail_path
+
+def job_retry_delay(client, video_id, error, attempt) -> float | None:
+    """
+    外部重试的决定 (线程版 download_video_stage 与 async_client 的批量下载共用)：
+    按错误分类 (见 retry_policy)，网络错误、429/5xx、下载链接签名过期、响应内容不完整可以稍后重试；
+    404、缺少下载链接等不再重试，每个视频最多执行 JOB_RETRY.max_attempts 次。
+
+    Args:
+        client (ApiClient | AsyncApiClient): 客户端实例，重试前需要时清除其视频信息缓存。
+        attempt (int): 第几次外部重试 (从 0 开始)。
+
+    Returns:
+        float | None: 重试前等待的秒数；不再重试时返回 None (已记录最终失败的日志)。
+    """
+    log = video_logger(logger, video_id, 'download')
+    error_class = classify_error(error)
+    if error_class not in JOB_RETRY.retryable or attempt + 1 >= JOB_RETRY.max_attempts:
+        log.error(f"下载视频 {video_id} 最终失败 ({error_class}，共 {attempt + 1} 次): {error}")
+        return None
+    if error_class in (ERROR_AUTH, ERROR_MALFORMED):
+        client.video_cache.invalidate(video_id) # 重试时重新获取视频信息 (fileUrl / 下载链接)
+    delay = JOB_RETRY.delay(attempt, error)
+    log.warning(f"下载视频 {video_id} 失败 ({error_class})，{delay:.0f} 秒后重试: {error}")
+    record_retry('job', error)
+    return delay
+
+def download_video_stage(client, video_id, failed_queue, log_lock, thumbnail_path,avatar_name,video_title,video_numComments,video_numLikes,video_numViews,video_tagList,video_createTime, video_rating=None, attempt=0):
+    """
+    下载视频 (包含内部重试逻辑)，并记录日志。
 
     Args:
         client (ApiClient): API 客户端实例。
         video_id (str): 要下载的视频ID。
-        failed_queue (queue.Queue): 用于存放需要外部重试的任务。
+        failed_queue (queue.Queue): 用于存放需要外部重试的任务，元素为 (视频ID, 重试时间, 错误信息)。
         log_lock (threading.Lock): 用于日志文件写入的锁。
+        thumbnail_path (str | None): 缩略图阶段的结果。
+        attempt (int): 第几次外部重试 (从 0 开始)，决定重试等待时间；次数上限由调用方控制。
+
+    Returns:
+        bool | str: 下载是否成功；视频正由其他任务下载时返回 DOWNLOAD_ATTACHED。
     """
-    thumbnail_path = None # 初始化缩略图路径
+    log = video_logger(logger, video_id, 'download')
+    # 同一视频已在其他线程或进程中下载时不再重复下载，由正在下载的任务负责记录日志
+    inflight_lock = get_inflight_registry().try_acquire(video_id)
+    if inflight_lock is None:
+        log.info(f"视频 {video_id} 正在由其他任务下载，附加到该下载，不重复下载: {get_inflight_registry().progress(video_id)}")
+        return DOWNLOAD_ATTACHED
+
     video_path = None     # 初始化视频路径
     video_size_bytes = 0  # 初始化视频大小
+    video_digest = None   # 初始化视频摘要
     success = False       # 初始化成功状态
+    progress = DOWNLOAD_TRACKER.start(video_id) # 本进程的下载进度 (/progress, /metrics)
+
+    def on_progress(downloaded, total=None):
+        inflight_lock.update_progress(downloaded, total)
+        progress.update(downloaded, total)
 
     try:
-        # 1. 尝试下载缩略图 (不影响视频下载流程，但记录结果)
-        try:
-            thumbnail_path = client.download_video_thumbnail(video_id)
-            if thumbnail_path:
-                print(f"缩略图 {video_id} 下载成功: {thumbnail_path}")
-            else:
-                print(f"缩略图 {video_id} 下载失败或已跳过")
-        except Exception as thumb_e:
-            # 即使缩略图下载失败，也继续尝试下载视频
-            print(f"[错误] 下载缩略图 {video_id} 时发生异常: {thumb_e}")
-
-        # 2. 尝试下载视频 (包含内部重试逻辑)
-        # 注意：download_video_byAi... 现在返回 (路径, 大小) 或抛出异常
-        download_result = client.download_video_byAi_timeoutRetransmission_queue(video_id)
+        # 注意：download_video_byAi... 现在返回 (路径, 大小, 摘要) 或抛出异常
+        download_result = client.download_video_byAi_timeoutRetransmission_queue(video_id, progress_callback=on_progress)
 
         # 如果下载函数成功返回 (没有抛出异常)
-        video_path, video_size_bytes = download_result
-        print(f"视频 {video_id} 下载成功，大小: {video_size_bytes} bytes")
+        video_path, video_size_bytes, video_digest = download_result
+        log.info(f"视频 {video_id} 下载成功，大小: {video_size_bytes} bytes")
         success = True
 
-    except (IncompleteRead, RequestException, ConnectionError) as e: # 处理预期的网络和请求错误
-        # 这些错误通常是临时的，适合放入外部重试队列
-        print(f"下载视频 {video_id} 失败 (可重试错误): {e}")
-        # 加入外部重试队列，10秒后重试
-        print(f"下载视频 {video_id} 失败，加入外部重试队列")
-        failed_queue.put((video_id, time.time() + 10))
-        success = False # 标记为失败，稍后记录日志
-
     except Exception as e:
-        # 处理 download_video... 内部重试失败后抛出的最终异常
-        # 或者其他意外错误 (如获取视频信息失败、无下载链接等)
-        print(f"下载视频 {video_id} 最终失败: {e}")
-        # 检查是否包含特定可重试消息 (虽然内部已重试，但有时API会要求更长时间等待)
-        if "需稍后重试" in str(e):
-            print(f"检测到“需稍后重试”，加入外部重试队列")
-            failed_queue.put((video_id, time.time() + 10)) # 放入外部队列进行更长时间的等待
-        # 对于其他最终失败情况，不再放入队列
-        success = False # 标记为失败
+        delay = job_retry_delay(client, video_id, e, attempt)
+        if delay is not None:
+            failed_queue.put((video_id, time.time() + delay, f"{classify_error(e)}: {e}"))
+        success = False # 标记为失败，稍后记录日志
 
     finally:
-        # 3. 记录日志 (无论成功还是失败)
-        # 只有在确定最终状态后才记录日志
+        # 记录日志 (无论成功还是失败)
         # 如果 success 为 True，则 video_path 和 video_size_bytes 应该有值
         # 如果 success 为 False，则 video_path 为 None, video_size_bytes 为 0
-        log_download_info(log_lock, video_id,avatar_name,video_title,video_numComments,video_numLikes,video_numViews,video_tagList,video_createTime,time.time(), video_path, thumbnail_path,  video_size_bytes, success)
+        log_download_info(log_lock, video_id,avatar_name,video_title,video_numComments,video_numLikes,video_numViews,video_tagList,video_createTime,time.time(), video_path, thumbnail_path,  video_size_bytes, success, video_digest, video_rating)
+        progress.finish(success)
+        inflight_lock.release()
+    return success
+
+# --- 下载工作线程函数 (不经过调度器时使用) ---
+def download_worker(client, video_id, failed_queue, log_lock,avatar_name,video_title,video_numComments,video_numLikes,video_numViews,video_tagList,video_createTime):
+    """
+    单个视频的下载工作线程，包括缩略图下载、视频下载、重试和日志记录。
 
+    Args:
+        client (ApiClient): API 客户端实例。
+        video_id (str): 要下载的视频ID。
+        failed_queue (queue.Queue): 用于存放需要外部重试的任务。
+        log_lock (threading.Lock): 用于日志文件写入的锁。
+    """
+    # 1. 尝试下载缩略图
+    thumbnail_path = download_thumbnail_stage(client, video_id)
+    # 2. 下载视频并记录日志
+    download_video_stage(client, video_id, failed_queue, log_lock, thumbnail_path,avatar_name,video_title,video_numComments,video_numLikes,video_numViews,video_tagList,video_createTime)
 
-# --- 修改：批量下载主函数 ---
-def batch_download_videos(client,email, password, sort='date', rating='all', page=0, limit=32, subscribed=False):
+def schedule_download(scheduler, client, video_id, failed_queue, log_lock, video_meta, priority=(0,), size=0, delay=0, on_done=None, attempt=0):
+    """
+    把一个视频的下载拆成 缩略图 -> 元数据 -> 视频 三个阶段提交到调度器，
+    每个阶段受各自的并发限制，视频阶段额外受在途字节数限制。
+
+    Args:
+        scheduler (DownloadScheduler): 调度器。
+        client (ApiClient): API 客户端实例。
+        video_id (str): 视频ID。
+        failed_queue (queue.Queue): 用于存放需要外部重试的任务。
+        log_lock (threading.Lock): 用于日志文件写入的锁。
+        video_meta (tuple): extract_video_meta 的结果。
+        priority (tuple): 调度优先级。
+        size (int): 预计视频大小 (bytes)。
+        delay (float): 延迟多少秒后开始 (用于重试)。
+        on_done (callable | None): 视频阶段结束 (无论成功与否) 后调用，参数为 download_video_stage 的返回值
+            (视频阶段抛出异常或因存储空间不足被放弃时为 False)。
+        attempt (int): 第几次外部重试 (从 0 开始)。
+    """
+    def thumbnail_task():
+        thumbnail_path = download_thumbnail_stage(client, video_id)
+        scheduler.submit('metadata', metadata_task, thumbnail_path, priority=priority)
+
+    def metadata_task(thumbnail_path):
+        # 预先获取带 fileUrl 的视频信息并写入缓存，视频阶段直接使用
+        try:
+            client.get_video_info(video_id, require_file_url=True)
+        except Exception as e:
+            logger.warning(f"预取视频 {video_id} 信息失败，将在下载阶段重试: {e}", extra={'video_id': video_id, 'stage': 'metadata'})
+        scheduler.submit('video', video_task, thumbnail_path, priority=priority, size=size,
+                         on_abandon=lambda error: video_abandoned(thumbnail_path, error))
+
+    def video_abandoned(thumbnail_path, error):
+        # 调度器因存储空间不足放弃了视频阶段：记录为失败 (不重试)，视为视频阶段结束
+        try:
+            *meta, video_rating = video_meta
+            log_download_info(log_lock, video_id, *meta, time.time(), None, thumbnail_path, 0, False, None, video_rating)
+        finally:
+            if on_done is not None:
+                on_done(False)
+
+    def video_task(thumbnail_path):
+        result = False
+        try:
+            result = download_video_stage(client, video_id, failed_queue, log_lock, thumbnail_path, *video_meta, attempt=attempt)
+        finally:
+            if on_done is not None:
+                on_done(result)
+
+    scheduler.submit('thumbnail', thumbnail_task, priority=priority, delay=delay)
+
+# --- 批量下载主函数 ---
+def batch_download_videos(client,email, password, sort='date', rating='all', page=0, limit=32, subscribed=False, scheduler=None):
     """
     批量下载视频的主函数。
 
@@ -204,6 +435,7 @@ def batch_download_videos(client,email, password, sort='date', rating='all', pag
         page (int): 页码。
         limit (int): 每页数量。
         subscribed (bool): 是否只下载订阅的视频。
+        scheduler (DownloadScheduler | None): 共享的调度器，为 None 时本次调用单独创建。
     """
 
 
@@ -211,81 +443,126 @@ def batch_download_videos(client,email, password, sort='date', rating='all', pag
         videos_response = client.get_videos(sort=sort, rating=rating, page=page, limit=limit, subscribed=subscribed)
         videos = videos_response.json().get('results', []) # 安全获取 results
         if not videos:
-            print("未找到任何视频。")
+            logger.info("未找到任何视频。")
             return
     except RequestException as e:
-         print(f"获取视频列表失败: {e}")
+         logger.error(f"获取视频列表失败: {e}")
          return
     except Exception as e: # 包括可能的 JSONDecodeError
-        print(f"处理视频列表响应时出错: {e}")
+        logger.error(f"处理视频列表响应时出错: {e}")
         return
 
+    download_videos(client, videos, subscribed=subscribed, scheduler=scheduler)
+
+def download_videos(client, videos, subscribed=False, scheduler=None, subscribed_ids=frozenset()):
+    """
+    下载一组视频 (来自 /videos 列表或抓取计划)，已下载完成的视频会被跳过。
+
+    Args:
+        client (ApiClient): API 客户端实例。
+        videos (list): 视频列表条目。
+        subscribed (bool): 这些视频是否全部来自订阅列表 (影响调度优先级)。
+        scheduler (DownloadScheduler | None): 共享的调度器，为 None 时本次调用单独创建。
+        subscribed_ids (set): 来自订阅列表的视频ID (影响调度优先级)。
+    """
+    # 跳过已下载完成的视频，不做任何网络请求
+    completed_index = get_completed_index()
+    pending_videos = [video for video in videos if not completed_index.is_completed(video.get('id'))]
+    skipped = len(videos) - len(pending_videos)
+    if skipped:
+        logger.info(f"跳过 {skipped} 个已下载完成的视频。")
+    videos = pending_videos
+    if not videos:
+        logger.info("所有视频均已下载完成。")
+        return
+
+    # 列表结果已包含 file / thumbnail 等信息，预先写入缓存，缩略图下载无需再请求 /video/{id}
+    client.seed_video_cache(videos)
+
+    own_scheduler = scheduler is None
+    if own_scheduler:
+        scheduler = DownloadScheduler(disk_guard=get_storage_layout().admission)
+    client.bandwidth_limiter = scheduler.bandwidth
+
     failed_queue = queue.Queue()  # 存储失败任务的队列 (用于外部重试)
     log_lock = threading.Lock()  # 创建日志文件锁
-    threads = []
+    tasks = {} # video_id -> (video_meta, priority, size)，重试时使用对应视频自己的信息
 
-    print(f"开始处理 {len(videos)} 个视频的下载任务...")
+    logger.info(f"开始处理 {len(videos)} 个视频的下载任务...")
 
     # 处理初始下载任务
     for video in videos:
         video_id = video.get('id')
-        avatar_name = video.get('user')['name']
-        video_title = video.get('title')
-        video_numComments = video.get('numComments')
-        video_numLikes = video.get('numLikes')
-        video_numViews = video.get('numViews')
-        video_tagList = [tag['id'] for tag in video.get('tags')]
-        video_createTime = video.get('createdAt')
         if not video_id:
-            print(f"[警告] 视频信息缺少 ID: {video}")
+            logger.warning(f"视频信息缺少 ID: {video}")
             continue # 跳过缺少 ID 的视频
+        if video_id in tasks:
+            continue # 同一批次中重复的视频只下载一次
 
-        # 启动下载工作线程，传入锁
-        t = Thread(target=download_worker,
-                   args=(client, video_id, failed_queue, log_lock,avatar_name,video_title,video_numComments,video_numLikes,video_numViews,video_tagList,video_createTime))
-        threads.append(t)
-        t.start()
-        time.sleep(0.1) # 短暂休眠，避免瞬间启动过多线程可能带来的问题
+        is_subscribed = subscribed or video_id in subscribed_ids
+        tasks[video_id] = (extract_video_meta(video), video_priority(video, is_subscribed), video_expected_size(video))
+        video_meta, priority, size = tasks[video_id]
+        schedule_download(scheduler, client, video_id, failed_queue, log_lock, video_meta, priority=priority, size=size)
 
-    # 等待所有初始任务的线程完成
-    print("等待所有初始下载线程完成...")
-    for t in threads:
-        t.join()
-    print("所有初始下载线程已结束。")
+    # 等待所有初始任务完成
+    logger.info("等待所有初始下载任务完成...")
+    scheduler.join()
+    logger.info("所有初始下载任务已结束。")
 
     # 处理失败任务的重试 (外部重试循环)
-    retry_threads = [] # 用于管理重试线程
+    # 只有可重试的错误才会放入 failed_queue，每个视频最多执行 JOB_RETRY.max_attempts 次
+    attempts = {} # video_id -> 已进行的外部重试次数
     while not failed_queue.empty():
-        video_id, retry_time = failed_queue.get()
-        current_time = time.time()
-        wait_time = retry_time - current_time
-        if wait_time > 0:
-            print(f"等待 {wait_time:.1f} 秒后重试视频 {video_id}...")
-            time.sleep(wait_time)
-
-        print(f"开始重试下载视频 {video_id}...")
-        # 重新启动 download_worker 进行重试，同样传入锁
-        # 注意：这里的重试不会无限循环，因为 worker 内部有次数限制，
-        # 并且只有特定错误才会再次放入 failed_queue
-        # 为了避免无限重试循环，可以在这里加入一个最大外部重试次数的逻辑（可选）
-        t = Thread(target=download_worker,
-                   args=(client, video_id, failed_queue, log_lock,avatar_name,video_title,video_numComments,video_numLikes,video_numViews,video_tagList,video_createTime))
-        retry_threads.append(t)
-        t.start()
-        # 为了简化，让重试任务也并发执行，如果需要严格顺序执行，则去掉 threading，直接调用 worker
-        # t.join() # 如果需要顺序执行重试任务，取消这行注释并移除 retry_threads 列表
-
-    # 等待所有重试任务的线程完成 (如果使用并发重试)
-    if retry_threads:
-        print("等待所有重试线程完成...")
-        for t in retry_threads:
-            t.join()
-        print("所有重试线程已结束。")
-
-    print("批量下载任务处理完毕。")
+        while not failed_queue.empty():
+            video_id, retry_time, error = failed_queue.get()
+            attempts[video_id] = attempts.get(video_id, 0) + 1
+            if attempts[video_id] >= JOB_RETRY.max_attempts:
+                logger.error(f"视频 {video_id} 已执行 {attempts[video_id]} 次仍失败，放弃: {error}", extra={'video_id': video_id, 'stage': 'retry'})
+                continue
+            wait_time = max(0, retry_time - time.time())
+            logger.info(f"{wait_time:.1f} 秒后重试视频 {video_id}...", extra={'video_id': video_id, 'stage': 'retry'})
+            video_meta, priority, size = tasks[video_id]
+            schedule_download(scheduler, client, video_id, failed_queue, log_lock, video_meta, priority=priority, size=size,
+                              delay=wait_time, attempt=attempts[video_id])
+        logger.info("等待所有重试任务完成...")
+        scheduler.join()
+        logger.info("所有重试任务已结束。")
+
+    if own_scheduler:
+        scheduler.shutdown()
+
+    logger.info("批量下载任务处理完毕。")
+
+def enqueue_videos(videos, subscribed=False, subscribed_ids=frozenset()):
+    """
+    把一组视频加入持久化任务队列，交给正在运行的任务执行器 (web 服务或 job_runner.py) 下载，
+    与按需下载共用同一个调度器和并发限制。已下载完成的视频会被跳过。
+
+    Args:
+        videos (list): 视频列表条目。
+        subscribed (bool): 这些视频是否全部来自订阅列表。
+        subscribed_ids (set): 来自订阅列表的视频ID。
+
+    Returns:
+        int: 加入队列的任务数。
+    """
+    completed_index = get_completed_index()
+    job_queue = get_job_queue()
+    count = 0
+    for video in videos:
+        video_id = video.get('id')
+        if not video_id or completed_index.is_completed(video_id):
+            continue
+        is_subscribed = subscribed or video_id in subscribed_ids
+        meta = {'video_meta': list(extract_video_meta(video)), 'size': video_expected_size(video)}
+        job_queue.enqueue(video_id, priority=JOB_PRIORITY_SUBSCRIBED if is_subscribed else JOB_PRIORITY_BATCH, source='batch', meta=meta)
+        count += 1
+    logger.info(f"已将 {count} 个视频加入下载任务队列。")
+    return count
 
 # --- 使用示例 ---
 if __name__ == "__main__":
+    setup_logging()
     # 确保下载目录和缩略图目录存在 (虽然下载函数会创建，但预先创建更好)
     os.makedirs(DOWNLOAD_DIR, exist_ok=True)
     os.makedirs(THUMBNAIL_DIR, exist_ok=True)
@@ -298,25 +575,37 @@ if __name__ == "__main__":
 
     data = json_read()
     if data is None:
-        print("配置文件读取失败，程序中止")
+        logger.error("配置文件读取失败，程序中止")
         exit(1)
 
     email = data['email']
     password = data['password']
 
     if email == "your_email@example.com" or password == "your_password":
-        print("请在 config.json 中替换你的邮箱和密码！")
+        logger.error("请在 config.json 中替换你的邮箱和密码！")
     else:
         # 下载最新的3页32个视频/页共96个视频
         try:
             client = ApiClient(email=email, password=password)
             client.login()  # 登录，如果失败会抛出 ConnectionError
         except ConnectionError as e:
-            print(f"无法继续下载，登录失败: {e}")
-
-        for k in range(0, 1):
-            style = True if range == 0 else False
-            for i in range(0, 3):
-                for j in range(1, 5):
-                    batch_download_videos(client, email, password, sort='trending', rating='all', page=i, limit=j * 8,
-                                          subscribed=style)
\ No newline at end of file
+            logger.error(f"无法继续下载，登录失败: {e}")
+
+        # 抓取计划: 每个唯一页面只请求一次，合并去重后统一下载
+        # (limit 参数不生效，原先按 limit=8/16/24/32 循环会重复抓取同一页)
+        sources = [
+            CrawlSource(sort='trending', rating='all', subscribed=False, pages=3),
+            # CrawlSource(sort='date', rating='all', subscribed=True, pages=3), # 订阅的视频
+        ]
+        planner = CrawlPlanner(client, sources, completed_index=get_completed_index())
+        videos = planner.plan()
+
+        if get_job_queue().runner_alive():
+            # 已有任务执行器在运行 (web 服务或 job_runner.py)，交给它下载，共用同一并发限制
+            enqueue_videos(videos, subscribed_ids=planner.subscribed_ids)
+        else:
+            # 所有视频共享同一个调度器，并发数与带宽限制对整个运行生效
+            scheduler = DownloadScheduler(disk_guard=get_storage_layout().admission)
+            download_videos(client, videos, scheduler=scheduler, subscribed_ids=planner.subscribed_ids)
+            scheduler.shutdown()
+            export_static()
\ No newline at end of file
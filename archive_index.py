@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+'''
+已完成视频索引：启动时从下载账本和下载目录加载一次，
+在发起任何网络请求前判断视频是否已经下载完成。
+'''
+import os
+import threading
+
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+# 下载过程中的辅助文件，不代表完整视频
+PARTIAL_SUFFIXES = ('.tmp', '.part', '.part.json')
+# 扫描分片目录的最大深度 (date 布局为 年/月 两层)
+SCAN_MAX_DEPTH = 2
+
+def _scan_videos(directory, exclude, on_disk, partial_ids, depth=0):
+    '''
+    递归扫描存储根目录 (含分片子目录): 跳过隐藏目录和 exclude 中的目录 (例如缩略图目录)
+    '''
+    with os.scandir(directory) as it:
+        for entry in it:
+            name = entry.name
+            if entry.is_dir():
+                if depth < SCAN_MAX_DEPTH and not name.startswith('.') and os.path.abspath(entry.path) not in exclude:
+                    _scan_videos(entry.path, exclude, on_disk, partial_ids, depth + 1)
+                continue
+            if not entry.is_file():
+                continue
+            if name.endswith(PARTIAL_SUFFIXES):
+                partial_ids.add(name.split('.', 1)[0])
+                continue
+            video_id, ext = os.path.splitext(name)
+            if ext:
+                on_disk[video_id] = (entry.path, entry.stat().st_size)
+
+class CompletedIndex:
+    '''
+    线程安全的已完成视频索引: video_id -> (文件路径, 文件大小bytes)
+    账本标记为成功且文件仍在磁盘上的视频视为已完成。
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    @classmethod
+    def load(cls, ledger, download_dirs, exclude=()) -> 'CompletedIndex':
+        '''
+        从账本和存储根目录构建索引
+        :param ledger: DownloadLedger
+        :param download_dirs: 存储根目录 (一个或多个)
+        :param exclude: 不扫描的子目录 (例如缩略图目录)
+        :return: CompletedIndex
+        '''
+        index = cls()
+        if isinstance(download_dirs, str):
+            download_dirs = [download_dirs]
+        exclude = {os.path.abspath(path) for path in exclude}
+
+        # 扫描一次存储根目录: video_id -> (路径, 大小)，存在分段记录等辅助文件的视频视为未完成
+        on_disk = {}
+        partial_ids = set()
+        for download_dir in download_dirs:
+            if os.path.isdir(download_dir):
+                _scan_videos(download_dir, exclude, on_disk, partial_ids)
+
+        for video_id, video_path, video_size_mb in ledger.iter_success():
+            if video_id in partial_ids:
+                continue
+            if video_id in on_disk:
+                index._entries[video_id] = on_disk[video_id]
+            elif video_path and os.path.exists(video_path):
+                # 文件不在存储根目录中 (例如旧版本的存储位置)
+                index._entries[video_id] = (video_path, os.path.getsize(video_path))
+            elif not video_path:
+                # 旧记录没有保存路径，只能相信账本
+                index._entries[video_id] = (None, int(video_size_mb * 1024 * 1024))
+        logger.info(f"已完成视频 {len(index._entries)} 个 (账本 + 存储目录)")
+        return index
+
+    def is_completed(self, video_id) -> bool:
+        with self._lock:
+            return video_id in self._entries
+
+    def get(self, video_id) -> tuple | None:
+        with self._lock:
+            return self._entries.get(video_id)
+
+    def add(self, video_id, video_path, size):
+        with self._lock:
+            self._entries[video_id] = (video_path, size)
+
+    def discard(self, video_id):
+        with self._lock:
+            self._entries.pop(video_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+'''
+下载账本查询：进程内索引，支持分页、过滤和排序，只有账本版本变化时才重新加载。
+供 json_to_web.py 的 /ecchiData 使用。
+'''
+import threading
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+SORT_FIELDS = ('local_id', 'video_numLikes', 'download_time')
+DATE_FIELDS = ('download_time', 'video_createTime')
+
+class QueryError(ValueError):
+    '''
+    查询参数错误
+    '''
+
+def _parse_bool(value):
+    if value is None:
+        return None
+    value = value.lower()
+    if value in ('1', 'true', 'yes'):
+        return True
+    if value in ('0', 'false', 'no'):
+        return False
+    raise QueryError(f"无效的布尔值: {value}")
+
+def _parse_float(name, value):
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise QueryError(f"参数 {name} 必须是数字: {value}")
+
+def _parse_int(name, value, default):
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise QueryError(f"参数 {name} 必须是整数: {value}")
+
+def _normalize_date(value):
+    # download_time 为 '2025-04-10 22:02:00'，video_createTime 为 '2025-04-10T22:02:00.000Z'，统一成可比较的形式
+    return value.replace('T', ' ') if value else ''
+
+class ArchiveQueryIndex:
+    '''
+    账本的进程内查询索引
+    '''
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self.version = None
+        self._lock = threading.Lock()
+        self._entries = []
+        self._by_author = {}
+        self._by_tag = {}
+        self.archive_total = 0
+
+    def refresh(self) -> str:
+        '''
+        账本版本变化时重新加载
+        :return: 当前版本
+        '''
+        version = self.ledger.version()
+        if version == self.version:
+            return version
+        with self._lock:
+            if version == self.version:
+                return version
+            entries = list(self.ledger.iter_entries())
+            by_author, by_tag = {}, {}
+            for position, entry in enumerate(entries):
+                by_author.setdefault(entry.get('avatar_name'), []).append(position)
+                for tag in entry.get('video_tagList') or []:
+                    by_tag.setdefault(tag, []).append(position)
+            self._entries, self._by_author, self._by_tag = entries, by_author, by_tag
+            self.archive_total = self.ledger.total_number()
+            self.version = version
+        return version
+
+    def query(self, args) -> dict:
+        '''
+        执行查询
+        :param args: 查询参数 (dict 或 werkzeug MultiDict)
+            page (从 1 开始), page_size, author, tag (可多个，逗号分隔，需全部匹配), success,
+            date_from, date_to, date_field (download_time | video_createTime),
+            min_size_mb, max_size_mb, sort (local_id | video_numLikes | download_time), order (asc | desc)
+        :return: {'total', 'page', 'page_size', 'items', 'archive_total'}
+        '''
+        self.refresh()
+        page = max(1, _parse_int('page', args.get('page'), 1))
+        page_size = min(MAX_PAGE_SIZE, max(1, _parse_int('page_size', args.get('page_size'), DEFAULT_PAGE_SIZE)))
+        sort = args.get('sort') or 'local_id'
+        if sort not in SORT_FIELDS:
+            raise QueryError(f"不支持的排序字段: {sort}")
+        order = args.get('order') or 'desc'
+        if order not in ('asc', 'desc'):
+            raise QueryError(f"order 只能是 asc 或 desc: {order}")
+        date_field = args.get('date_field') or 'download_time'
+        if date_field not in DATE_FIELDS:
+            raise QueryError(f"不支持的日期字段: {date_field}")
+
+        author = args.get('author')
+        tags = [t for t in (args.get('tag') or '').split(',') if t]
+        success = _parse_bool(args.get('success'))
+        date_from = _normalize_date(args.get('date_from'))
+        date_to = _normalize_date(args.get('date_to'))
+        min_size = _parse_float('min_size_mb', args.get('min_size_mb'))
+        max_size = _parse_float('max_size_mb', args.get('max_size_mb'))
+
+        with self._lock:
+            entries = self._entries
+            # 先用作者/标签索引缩小候选范围
+            candidates = None
+            if author:
+                candidates = set(self._by_author.get(author, ()))
+            for tag in tags:
+                positions = set(self._by_tag.get(tag, ()))
+                candidates = positions if candidates is None else candidates & positions
+            positions = range(len(entries)) if candidates is None else sorted(candidates)
+
+            matched = []
+            for position in positions:
+                entry = entries[position]
+                if success is not None and bool(entry.get('success')) != success:
+                    continue
+                if date_from or date_to:
+                    value = _normalize_date(entry.get(date_field))
+                    if date_from and value < date_from:
+                        continue
+                    # 只给出日期时包含当天
+                    if date_to and value[:len(date_to)] > date_to:
+                        continue
+                if min_size is not None or max_size is not None:
+                    size = entry.get('video_size_mb') or 0.0
+                    if min_size is not None and size < min_size:
+                        continue
+                    if max_size is not None and size > max_size:
+                        continue
+                matched.append(entry)
+
+        if sort == 'download_time':
+            key = lambda e: e.get('download_time') or ''
+        else:
+            key = lambda e: e.get(sort) or 0
+        matched.sort(key=key, reverse=(order == 'desc'))
+
+        start = (page - 1) * page_size
+        return {
+            'total': len(matched),
+            'page': page,
+            'page_size': page_size,
+            'items': matched[start:start + page_size],
+            'archive_total': {'number': self.archive_total},
+        }
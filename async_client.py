@@ -0,0 +1,599 @@
+# -*- coding: utf-8 -*-
+'''
+基于 asyncio + aiohttp 的下载后端，作为线程版 ApiClient 的替代。
+单个进程、单个事件循环即可同时进行数百个元数据/缩略图请求，适合抓取更深的列表页。
+
+用法: python async_client.py [页数]
+'''
+from __future__ import annotations
+
+import os
+import sys
+import time
+import asyncio
+
+try:
+    import aiohttp
+except ImportError: # 可选依赖，仅异步后端需要
+    aiohttp = None
+
+from api_client import (api_url, file_url, TOKEN_FILE, THUMBNAIL_DIR, POOL_MAXSIZE, VIDEO_CACHE_TTL,
+                        DOWNLOAD_CHUNK_SIZE, SEGMENT_COUNT, SEGMENT_MIN_SIZE, RemoteFileChanged, SegmentPlan, VideoInfoCache,
+                        begin_stream, complete_partial, complete_stream, get_partial_index, get_rate_limiter, get_storage_layout, get_thumbnail_store,
+                        range_headers, resource_request, response_total_size, select_download_resource, settle_unsatisfiable, thumbnail_url,
+                        unsatisfiable_total, write_blocks, write_segment)
+from credentials import CredentialManager
+from log_config import get_logger, setup_logging, video_logger
+from integrity import BlockHasher
+from file_sink import FileSink
+from thumbnails import THUMBNAIL_FRAMES, THUMBNAIL_FRAME_COUNT
+from rate_limit import RATE_LIMIT_RETRIES
+from scheduler import MAX_BANDWIDTH, BANDWIDTH_PROFILES, BANDWIDTH_FILE, BandwidthLimiter, video_expected_size
+from storage import STORAGE_SPACE_POLL, InsufficientStorageError
+from metrics import record_retry
+from retry_policy import DOWNLOAD_RETRY, JOB_RETRY, ERROR_TRANSIENT, RetryExhaustedError, get_breaker
+
+logger = get_logger(__name__)
+
+# 异步后端默认并发数
+ASYNC_METADATA_CONCURRENCY = 64
+ASYNC_THUMBNAIL_CONCURRENCY = 32
+ASYNC_VIDEO_CONCURRENCY = 3
+ASYNC_PAGE_CONCURRENCY = 4 # 同一来源同时请求的列表页数
+# 视频数据攒够该大小后在线程中写入文件并计算摘要 (文件读写、哈希和元数据保存不在事件循环中进行)
+ASYNC_WRITE_BUFFER_SIZE = 1024 * 1024
+
+class AsyncApiClient:
+    '''
+    ApiClient 的异步版本。接口与 ApiClient 对应，但响应直接返回解析后的 JSON。
+    '''
+    def __init__(self, email, password, limit_per_host=POOL_MAXSIZE, video_cache_ttl=VIDEO_CACHE_TTL, token_file=TOKEN_FILE, rate_limiter=None, partials=None,
+                 thumbnails=None, thumbnail_frames=THUMBNAIL_FRAMES, storage=None, bandwidth_limiter=None,
+                 segments=SEGMENT_COUNT, segment_min_size=SEGMENT_MIN_SIZE):
+        if aiohttp is None:
+            raise ImportError("异步后端需要安装 aiohttp: pip install aiohttp")
+        self.email = email
+        self.password = password
+
+        self.api_url = api_url
+        self.file_url = file_url
+        self.timeout = 30
+        self.download_timeout = 300 # 单次下载请求的超时时间
+        # 与 ApiClient 共用 token 文件；登录由本类异步完成
+        self.credentials = CredentialManager(email, password, None, token_file)
+        self._login_lock = None
+
+        self.limit_per_host = limit_per_host
+        # 与线程版共用请求限速器 (及其跨进程共享的额度)
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self.video_cache = VideoInfoCache(ttl=video_cache_ttl)
+        # 与线程版共用未完成下载索引
+        self.partials = partials if partials is not None else get_partial_index()
+        self.thumbnails = thumbnails or get_thumbnail_store()
+        self.thumbnail_frames = thumbnail_frames
+        self.storage = storage or get_storage_layout()
+        # 带宽限速: 与线程版调度器使用相同的上限、时段和运行时配置文件 (bandwidth.json)，所有视频共享
+        self.bandwidth_limiter = bandwidth_limiter or BandwidthLimiter(MAX_BANDWIDTH, profiles=BANDWIDTH_PROFILES, config_file=BANDWIDTH_FILE)
+        # 分段下载: 与 ApiClient 相同的分段数和最小文件大小
+        self.segments = segments
+        self.segment_min_size = segment_min_size
+        self._session = None
+
+    @property
+    def session(self):
+        # ClientSession 必须在事件循环中创建，首次使用时再初始化
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.limit_per_host, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, headers={'User-Agent': 'Mozilla/5.0'})
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    @property
+    def token(self) -> str | None:
+        return self.credentials.token
+
+    async def _auth_headers(self) -> dict:
+        if not self.credentials.is_valid():
+            await self.login()
+        return {'Authorization': 'Bearer ' + self.token}
+
+    async def _throttle(self, url, headers=None):
+        '''
+        等待限速器放行 (令牌不足或被限流时)。限速器的状态文件需要加锁读写，在线程中进行
+        '''
+        delay = await asyncio.to_thread(self.rate_limiter.reserve, url, headers)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _observe(self, url, request_headers, status, response_headers):
+        '''
+        把响应状态告知限速器 (被限流时会写入状态文件，在线程中进行)
+        '''
+        await asyncio.to_thread(self.rate_limiter.observe, url, request_headers, status, response_headers)
+
+    async def _get_json(self, url, params=None, headers=None):
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        relogged = False
+        throttled = 0
+        while True:
+            auth_headers = await self._auth_headers()
+            request_headers = {**auth_headers, **(headers or {})}
+            await self._throttle(url, request_headers)
+            async with self.session.get(url, params=params, headers=request_headers, timeout=timeout) as r:
+                await self._observe(url, request_headers, r.status, r.headers)
+                if r.status == 401 and not relogged:
+                    # token 被拒绝: 重新登录后重试一次 (其他协程已刷新时直接使用新 token)
+                    logger.warning(f"登录凭证被拒绝 (401)，重新登录: {url}")
+                    await self.login(failed_token=auth_headers['Authorization'][len('Bearer '):])
+                    relogged = True
+                    continue
+                if r.status == 429 and throttled < RATE_LIMIT_RETRIES:
+                    throttled += 1 # 下一次 _throttle 会等到限流结束
+                    continue
+                r.raise_for_status()
+                return await r.json(content_type=None)
+
+    async def login(self, failed_token=None):
+        '''
+        确保已登录：保存的 token 仍然有效时直接使用，否则请求登录接口
+        :param failed_token: 被服务器拒绝的 token，与当前 token 相同时强制重新登录
+        '''
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        async with self._login_lock:
+            if failed_token is None and self.credentials.is_valid():
+                return
+            if failed_token is not None and failed_token != self.token:
+                return
+            await self._login_request()
+
+    async def _login_request(self):
+        url = self.api_url + '/user/login'
+        json = {'email': self.email, 'password': self.password}
+        try:
+            await self._throttle(url)
+            async with self.session.post(url, json=json, timeout=aiohttp.ClientTimeout(total=self.timeout)) as r:
+                await self._observe(url, None, r.status, r.headers)
+                r.raise_for_status()
+                token = (await r.json(content_type=None))['token']
+            await asyncio.to_thread(self.credentials.set_token, token) # 写入 token 文件
+            logger.info('API 登录成功')
+        except aiohttp.ClientError as e:
+            logger.error(f'API 登录失败: {e}')
+            raise ConnectionError(f"API登录失败: {e}")
+        except Exception as e:
+            logger.error(f'API 登录失败，解析响应错误: {e}')
+            raise ConnectionError(f"API登录失败，解析响应错误: {e}")
+
+    async def get_videos(self, sort='date', rating='all', page=0, limit=32, subscribed=False) -> dict:
+        '''
+        获取视频列表，参数同 ApiClient.get_videos
+        :return: 响应 JSON
+        '''
+        params = {'sort': sort, 'rating': rating, 'page': page, 'limit': limit,
+                  'subscribed': 'true' if subscribed else 'false'}
+        return await self._get_json(self.api_url + '/videos', params=params)
+
+    async def get_video(self, video_id) -> dict:
+        video_info = await self._get_json(self.api_url + '/video/' + video_id)
+        self.video_cache.put(video_info)
+        return video_info
+
+    async def get_video_info(self, video_id, require_file_url=False) -> dict:
+        '''
+        获取视频信息，优先使用缓存，参数同 ApiClient.get_video_info
+        '''
+        video_info = self.video_cache.get(video_id, require_file_url=require_file_url)
+        if video_info is not None:
+            return video_info
+        return await self.get_video(video_id)
+
+    def seed_video_cache(self, videos):
+        for video in videos:
+            if isinstance(video, dict):
+                self.video_cache.put(video, overwrite=False)
+
+    async def download_video_thumbnail(self, video_id) -> str | None:
+        '''
+        下载视频缩略图
+        :return: 缩略图文件的完整路径，如果下载失败则返回 None
+        '''
+        thumbnail_path = await asyncio.to_thread(self.thumbnails.relocate, video_id)
+        if thumbnail_path is not None:
+            return thumbnail_path
+        try:
+            video_info = await self.get_video_info(video_id)
+            url = thumbnail_url(video_id, video_info, self.file_url)
+            if url is None:
+                return None
+            os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+            data = await self._fetch_image(url)
+            frames = []
+            if self.thumbnail_frames:
+                urls = [thumbnail_url(video_id, video_info, self.file_url, frame=i) for i in range(THUMBNAIL_FRAME_COUNT)]
+                results = await asyncio.gather(*(self._fetch_image(u) for u in urls), return_exceptions=True)
+                frames = [r for r in results if isinstance(r, bytes)] # 预览帧缺失不影响封面
+            return await asyncio.to_thread(self.thumbnails.add, video_id, data, frames)
+        except Exception as e:
+            logger.error(f"下载视频 {video_id} 的缩略图失败: {e}", extra={'video_id': video_id, 'stage': 'thumbnail'})
+            return None
+
+    async def _fetch_image(self, url) -> bytes:
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        await self._throttle(url)
+        async with self.session.get(url, timeout=timeout, ssl=False) as r:
+            await self._observe(url, None, r.status, r.headers)
+            r.raise_for_status()
+            return await r.read()
+
+    async def get_download_resource(self, video_id) -> tuple[str, str]:
+        '''
+        解析下载链接
+        :return: (下载链接, 文件类型)
+        '''
+        video = await self.get_video_info(video_id, require_file_url=True)
+        url, headers = resource_request(video_id, video)
+        try:
+            resources = await self._get_json(url, headers=headers)
+        except Exception as e:
+            self.video_cache.invalidate(video_id) # fileUrl 可能已失效，下次重试重新获取
+            raise Exception(f"获取视频 {video_id} 下载资源链接失败: {e}")
+        return select_download_resource(video_id, resources)
+
+    async def probe_file_size(self, download_link, partial=None) -> int | None:
+        '''
+        获取远端文件总大小 (请求 bytes=0-0，从 Content-Range 中解析)，参数同 ApiClient.probe_file_size
+        '''
+        headers = range_headers(0, 0)
+        await self._throttle(download_link)
+        async with self.session.get(download_link, headers=headers, timeout=aiohttp.ClientTimeout(total=self.timeout), ssl=False) as r:
+            await self._observe(download_link, headers, r.status, r.headers)
+            r.raise_for_status()
+            if r.status != 206:
+                return None
+            total_size = response_total_size(r.status, r.headers)
+            if partial is not None:
+                partial.record_response(download_link, r.headers, total_size)
+            return total_size
+
+    async def download_video(self, video_id, progress_callback=None) -> tuple[str, int, str]:
+        '''
+        下载视频 (支持断点续传、分段下载和重试)，与 ApiClient.download_video_byAi_timeoutRetransmission_queue 使用相同的
+        未完成下载记录和共用步骤 (api_client 中的 range_headers / begin_stream / complete_stream / SegmentPlan 等)
+        :param video_id: 视频ID
+        :param progress_callback: 进度回调 callback(已下载字节数, 总字节数或None)，每写入一批数据后在写入线程中调用
+        :return: (视频文件路径, 文件大小bytes, 文件摘要)
+        '''
+        log = video_logger(logger, video_id, 'download')
+        partial = self.partials.get(video_id)
+        if partial is not None and partial.is_complete():
+            # 数据已全部写入但上次没来得及完成 (重命名前中断)，不需要任何网络请求
+            return await asyncio.to_thread(complete_partial, self.partials, partial)
+        download_link, file_type = await self.get_download_resource(video_id)
+        video_file_name = await asyncio.to_thread(self.storage.video_path, video_id, file_type)
+        partial = await asyncio.to_thread(self.partials.open, video_id, video_file_name)
+        if partial.is_complete():
+            return await asyncio.to_thread(complete_partial, self.partials, partial)
+
+        if self.segments > 1 or 'segments' in partial.meta:
+            result = await self.download_segmented(video_id, download_link, partial, progress_callback=progress_callback)
+            if result is not None:
+                return result
+
+        timeout = aiohttp.ClientTimeout(total=self.download_timeout)
+        policy = DOWNLOAD_RETRY
+        breaker = get_breaker(download_link)
+
+        for attempt in range(policy.max_attempts):
+            while (delay := breaker.acquire()) > 0: # CDN 节点熔断期间等待，不消耗重试次数
+                await asyncio.sleep(delay)
+            resume_byte_pos = partial.size
+            headers = range_headers(resume_byte_pos, if_range=partial.if_range())
+            try:
+                await self._throttle(download_link)
+                async with self.session.get(download_link, headers=headers, timeout=timeout, ssl=False) as response:
+                    await self._observe(download_link, headers, response.status, response.headers)
+                    if response.status == 416:
+                        total_size = unsatisfiable_total(response.headers, partial) or await self.probe_file_size(download_link)
+                        if await asyncio.to_thread(settle_unsatisfiable, partial, total_size):
+                            return await asyncio.to_thread(complete_partial, self.partials, partial)
+                        continue
+                    response.raise_for_status()
+                    breaker.record_success()
+
+                    mode, total_size, hasher = await asyncio.to_thread(begin_stream, partial, download_link, response.status, response.headers, resume_byte_pos)
+                    downloaded_size = resume_byte_pos if mode == 'ab' else 0
+                    sink = await asyncio.to_thread(FileSink, partial.path, mode, total_size=total_size)
+                    try:
+                        buffer = bytearray()
+                        try:
+                            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                                await self.bandwidth_limiter.consume_async(len(chunk), video_id)
+                                buffer += chunk
+                                downloaded_size += len(chunk)
+                                if len(buffer) >= ASYNC_WRITE_BUFFER_SIZE:
+                                    await asyncio.to_thread(_write_batch, sink, partial, hasher, bytes(buffer), progress_callback, downloaded_size, total_size)
+                                    buffer.clear()
+                        finally:
+                            # 连接中断时也写入已收到的数据，续传从这里继续
+                            if buffer:
+                                await asyncio.to_thread(_write_batch, sink, partial, hasher, bytes(buffer), progress_callback, downloaded_size, total_size)
+                        await asyncio.to_thread(sink.finish)
+                    finally:
+                        await asyncio.to_thread(sink.close)
+
+                result = await asyncio.to_thread(complete_stream, self.partials, partial, total_size, hasher)
+                if result is not None:
+                    return result
+                await asyncio.sleep(policy.delay(attempt))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                await asyncio.sleep(policy.next_delay(e, attempt, f"下载视频 {video_id}", breaker=breaker, log=log))
+
+        raise RetryExhaustedError(f"视频 {video_id} 下载失败，已达到最大重试次数 ({policy.max_attempts}次)。", ERROR_TRANSIENT)
+
+    async def download_segmented(self, video_id, download_link, partial, progress_callback=None) -> tuple[str, int, str] | None:
+        '''
+        分段并行下载 (见 api_client.SegmentPlan)，与线程版共用分段记录，可以续传任一版本留下的分段下载
+        :return: 成功时返回 (视频文件路径, 文件大小bytes, 文件摘要)；不适合分段下载时返回 None (由调用方使用单连接下载)
+        '''
+        log = video_logger(logger, video_id, 'segment')
+        plan = await asyncio.to_thread(SegmentPlan.resume, partial)
+        if plan is None:
+            if partial.size > 0 or self.segments <= 1:
+                return None # 单连接下载留下的部分文件，继续按原方式续传
+            try:
+                total_size = await self.probe_file_size(download_link, partial)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                log.warning(f"获取视频 {video_id} 文件大小失败，使用单连接下载: {e}")
+                return None
+            if total_size is None or total_size < self.segment_min_size:
+                return None
+            plan = SegmentPlan.create(partial, total_size, self.segments)
+        log.info(f"视频 {video_id} 分段下载: {len(plan.ranges)} 段，每段 {plan.state['segment_size'] / 1024 / 1024:.1f} MB，剩余 {len(plan.pending)} 段")
+
+        def on_bytes(nbytes):
+            current = plan.add_progress(nbytes)
+            if progress_callback is not None:
+                progress_callback(current, plan.total_size)
+
+        try:
+            fd = await asyncio.to_thread(plan.open)
+            try:
+                tasks = [asyncio.create_task(self._download_segment(video_id, download_link, fd, plan, segment, on_bytes)) for segment in plan.pending]
+                try:
+                    # 任一分段最终失败时立即取消其他分段并抛出异常；已完成的分段保留在记录中
+                    await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                    for task in tasks:
+                        if task.done() and not task.cancelled() and task.exception() is not None:
+                            raise task.exception()
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                await asyncio.to_thread(os.fsync, fd)
+            finally:
+                await asyncio.to_thread(os.close, fd)
+        except RemoteFileChanged as e:
+            log.warning(f"视频 {video_id} 在服务器上已变化，丢弃已下载的分段，使用单连接重新下载: {e}")
+            await asyncio.to_thread(partial.restart)
+            return None
+
+        return await asyncio.to_thread(complete_partial, self.partials, partial)
+
+    async def _download_segment(self, video_id, download_link, fd, plan, segment, on_bytes):
+        '''
+        下载一个分段并写入 fd 的对应偏移，失败时从已写入的位置继续重试；完成后在分段记录中标记
+        '''
+        log = video_logger(logger, video_id, 'segment')
+        index, start, end = segment
+        timeout = aiohttp.ClientTimeout(total=self.download_timeout)
+        policy = DOWNLOAD_RETRY
+        breaker = get_breaker(download_link)
+        hasher = BlockHasher()
+        pos = start
+        for attempt in range(policy.max_attempts):
+            while (delay := breaker.acquire()) > 0:
+                await asyncio.sleep(delay)
+            headers = range_headers(pos, end, plan.if_range)
+            try:
+                await self._throttle(download_link)
+                async with self.session.get(download_link, headers=headers, timeout=timeout, ssl=False) as response:
+                    await self._observe(download_link, headers, response.status, response.headers)
+                    response.raise_for_status()
+                    if response.status == 200 and plan.if_range:
+                        raise RemoteFileChanged(f"If-Range {plan.if_range} 不匹配")
+                    if response.status != 206:
+                        raise aiohttp.ClientPayloadError(f"服务器未返回分段内容 (状态码 {response.status})")
+                    breaker.record_success()
+                    buffer = bytearray()
+                    try:
+                        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                            await self.bandwidth_limiter.consume_async(len(chunk), video_id) # 同一视频的各分段共用一份带宽
+                            buffer += chunk
+                            if len(buffer) >= ASYNC_WRITE_BUFFER_SIZE:
+                                pos = await asyncio.to_thread(write_segment, fd, bytes(buffer), pos, end, hasher, on_bytes)
+                                buffer.clear()
+                    finally:
+                        if buffer:
+                            pos = await asyncio.to_thread(write_segment, fd, bytes(buffer), pos, end, hasher, on_bytes)
+                if pos > end:
+                    await asyncio.to_thread(plan.mark_done, fd, index, hasher.block_list())
+                    return
+                log.warning(f"视频 {video_id} 分段 {start}-{end} 不完整，已写入至 {pos}，将继续重试。")
+                record_retry('segment', 'IncompleteRead')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                await asyncio.sleep(policy.next_delay(e, attempt, f"下载视频 {video_id} 分段 {start}-{end}", breaker=breaker, log=log, stage='segment'))
+        raise RetryExhaustedError(f"视频 {video_id} 分段 {start}-{end} 下载失败，已达到最大重试次数 ({policy.max_attempts}次)。", ERROR_TRANSIENT)
+
+def _write_batch(sink, partial, hasher, data, progress_callback=None, downloaded=0, total=None):
+    '''
+    在线程中写入一批数据 (见 api_client.write_blocks)。
+    进度回调 (例如 InflightLock.update_progress 会写入锁文件) 也在这里调用，不在事件循环中进行
+    '''
+    write_blocks(sink, partial, hasher, data)
+    if progress_callback is not None:
+        progress_callback(downloaded, total)
+
+async def crawl_sources_async(client, sources, completed_index=None, page_concurrency=ASYNC_PAGE_CONCURRENCY) -> tuple[list, set]:
+    '''
+    异步抓取列表：所有来源并发，同一来源每次并发请求 page_concurrency 页，
+    某一批页面的视频全部已下载时停止翻页。
+    :return: (去重后尚未下载的视频条目列表, 来自订阅列表的视频ID集合)
+    '''
+    videos = {}
+    subscribed_ids = set()
+
+    async def crawl(source):
+        for first in range(0, source.pages, page_concurrency):
+            pages = range(first, min(source.pages, first + page_concurrency))
+            results = await asyncio.gather(*[client.get_videos(sort=source.sort, rating=source.rating, page=page,
+                                                               limit=source.limit, subscribed=source.subscribed)
+                                             for page in pages], return_exceptions=True)
+            total = archived = 0
+            for page, result in zip(pages, results):
+                if isinstance(result, BaseException):
+                    logger.error(f"获取 {source} 第 {page} 页失败: {result}")
+                    continue
+                for video in result.get('results', []):
+                    video_id = video.get('id')
+                    if not video_id:
+                        continue
+                    total += 1
+                    if completed_index is not None and completed_index.is_completed(video_id):
+                        archived += 1
+                        continue
+                    videos.setdefault(video_id, video)
+                    if source.subscribed:
+                        subscribed_ids.add(video_id)
+            if total == 0 or (completed_index is not None and archived == total):
+                break
+
+    await asyncio.gather(*[crawl(source) for source in sources])
+    return list(videos.values()), subscribed_ids
+
+async def batch_download_videos_async(client, videos, metadata_concurrency=ASYNC_METADATA_CONCURRENCY,
+                                      thumbnail_concurrency=ASYNC_THUMBNAIL_CONCURRENCY, video_concurrency=ASYNC_VIDEO_CONCURRENCY):
+    '''
+    异步批量下载：缩略图、元数据、视频三个阶段分别用信号量限制并发。
+    与线程版共用下载账本、已完成索引和下载中登记表。
+    :param client: AsyncApiClient
+    :param videos: 视频列表条目
+    '''
+    from app import extract_video_meta, log_download_info, get_completed_index, get_inflight_registry, job_retry_delay
+
+    completed_index = get_completed_index()
+    videos = [video for video in videos if video.get('id') and not completed_index.is_completed(video['id'])]
+    client.seed_video_cache(videos)
+
+    metadata_sem = asyncio.Semaphore(metadata_concurrency)
+    thumbnail_sem = asyncio.Semaphore(thumbnail_concurrency)
+    video_sem = asyncio.Semaphore(video_concurrency)
+    registry = get_inflight_registry()
+
+    async def reserve_disk(video_id, reserved):
+        # 在占用下载连接 (video_sem) 之前预留磁盘空间，放不下的大视频不会阻塞其他视频的下载；
+        # 延后超过上限或等待也无法满足时抛出 InsufficientStorageError
+        started = time.monotonic()
+        while not await asyncio.to_thread(client.storage.admission.admit, reserved, time.monotonic() - started):
+            logger.warning(f"存储空间不足，视频 {video_id} 延后 {STORAGE_SPACE_POLL} 秒下载", extra={'video_id': video_id, 'stage': 'download'})
+            await asyncio.sleep(STORAGE_SPACE_POLL)
+
+    async def download_once(video, thumbnail_path, reserved) -> Exception | None:
+        '''
+        下载一次并记录到账本
+        :return: 失败时的异常，成功 (或正由其他任务下载) 时为 None
+        '''
+        video_id = video['id']
+        try:
+            await reserve_disk(video_id, reserved)
+        except InsufficientStorageError as e:
+            *video_meta, video_rating = extract_video_meta(video)
+            await asyncio.to_thread(log_download_info, None, video_id, *video_meta, time.time(),
+                                    None, thumbnail_path, 0, False, None, video_rating)
+            return e
+        try:
+            async with video_sem:
+                inflight_lock = await asyncio.to_thread(registry.try_acquire, video_id) # 打开锁文件并 flock
+                if inflight_lock is None:
+                    logger.info(f"视频 {video_id} 正在由其他任务下载，跳过", extra={'video_id': video_id, 'stage': 'download'})
+                    return None
+                video_path, video_size_bytes, video_digest, success, error = None, 0, None, False, None
+                try:
+                    video_path, video_size_bytes, video_digest = await client.download_video(video_id, progress_callback=inflight_lock.update_progress)
+                    success = True
+                except Exception as e:
+                    error = e
+                finally:
+                    *video_meta, video_rating = extract_video_meta(video)
+                    await asyncio.to_thread(log_download_info, None, video_id, *video_meta, time.time(),
+                                            video_path, thumbnail_path, video_size_bytes, success, video_digest, video_rating)
+                    await asyncio.to_thread(inflight_lock.release)
+                return error
+        finally:
+            client.storage.admission.release(reserved)
+
+    async def download_one(video):
+        video_id = video['id']
+        async with thumbnail_sem:
+            thumbnail_path = await client.download_video_thumbnail(video_id)
+        async with metadata_sem:
+            try:
+                await client.get_video_info(video_id, require_file_url=True)
+            except Exception as e:
+                logger.warning(f"预取视频 {video_id} 信息失败，将在下载阶段重试: {e}", extra={'video_id': video_id, 'stage': 'metadata'})
+
+        # 与线程版相同的外部重试 (见 app.job_retry_delay)
+        reserved = video_expected_size(video)
+        for attempt in range(JOB_RETRY.max_attempts):
+            error = await download_once(video, thumbnail_path, reserved)
+            if error is None:
+                return
+            delay = job_retry_delay(client, video_id, error, attempt)
+            if delay is None:
+                return
+            await asyncio.sleep(delay)
+
+    logger.info(f"开始处理 {len(videos)} 个视频的下载任务 (异步后端)...")
+    await asyncio.gather(*[download_one(video) for video in videos])
+    logger.info("批量下载任务处理完毕。")
+
+def run_async_download(email, password, sources, **kwargs):
+    '''
+    同步入口：登录、抓取列表并下载，内部运行一个事件循环
+    :param sources: CrawlSource 列表
+    :param kwargs: 传给 batch_download_videos_async 的并发参数
+    '''
+    from app import get_completed_index
+
+    async def main():
+        async with AsyncApiClient(email, password) as client:
+            try:
+                await client.login()
+            except ConnectionError as e:
+                logger.error(f"无法继续下载，登录失败: {e}")
+            videos, _ = await crawl_sources_async(client, sources, completed_index=get_completed_index())
+            await batch_download_videos_async(client, videos, **kwargs)
+
+    asyncio.run(main())
+
+if __name__ == '__main__':
+    setup_logging()
+    from app import json_read
+    from crawl_planner import CrawlSource
+
+    data = json_read()
+    if data is None:
+        logger.error("配置文件读取失败，程序中止")
+        exit(1)
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    run_async_download(data['email'], data['password'], [CrawlSource(sort='trending', rating='all', pages=pages)])
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+'''
+统计基准测试：生成 N 条记录的账本，测量列式表的首次加载、从快照加载、各报表 (不使用缓存) 的耗时和内存，
+并与逐条加载为 dict 的方式 (旧的一次性脚本的做法) 对比。
+
+用法: python benchmarks/bench_analytics.py [条目数]   (默认 1000000)
+'''
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ledger import DownloadLedger # noqa: E402
+from analytics import ArchiveStats, default_snapshot_path # noqa: E402
+
+# dict 方式的内存按该条数测量后换算
+DICT_SAMPLE = 100000
+
+def make_entry(rng, i, now):
+    return {
+        "video_id": f"v{i:012d}",
+        "avatar_name": f"author{rng.randint(0, 20000)}",
+        "video_title": f"title {i}",
+        "video_numComments": rng.randint(0, 500),
+        "video_numLikes": rng.randint(0, 5000),
+        "video_numViews": rng.randint(0, 100000),
+        "video_tagList": [f"tag{rng.randint(0, 2000)}" for _ in range(rng.randint(1, 5))],
+        "video_createTime": f"20{rng.randint(18, 25)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T00:00:00.000Z",
+        "video_rating": rng.choice(['general', 'ecchi']),
+        "download_time": "2025-04-10 22:02:00",
+        "video_path": f"/srv/video_downloader/data/downloads/v{i:012d}.mp4",
+        "thumbnail_path": f"/srv/video_downloader/data/downloads/thumbnails/v{i:012d}.jpg",
+        "video_size_mb": round(rng.uniform(5, 2000), 1),
+        "success": rng.random() > 0.05,
+        "last_update_timestamp": now - rng.uniform(0, 90 * 86400),
+        "local_id": i + 1,
+    }
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rng = random.Random(1)
+    now = time.time()
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, 'download_log.json')
+        with open(json_path, 'w', encoding='utf-8') as f:
+            f.write('{"total": {"number": %d}' % n)
+            for i in range(n):
+                entry = make_entry(rng, i, now)
+                f.write(f', "{entry["video_id"]}": {json.dumps(entry)}')
+            f.write('}')
+        ledger = DownloadLedger(os.path.join(tmp, 'download_log.db'), legacy_json_path=json_path)
+        os.remove(json_path)
+
+        snapshot_path = default_snapshot_path(ledger)
+        start = time.perf_counter()
+        ArchiveStats(ledger, snapshot_path).table.refresh()
+        print(f"{n} 条记录，首次从账本加载 {time.perf_counter() - start:.2f} 秒 (之后读取快照)")
+
+        stats = ArchiveStats(ledger, snapshot_path)
+        start = time.perf_counter()
+        stats.table.refresh()
+        print(f"从快照加载 {time.perf_counter() - start:.2f} 秒，数组 {stats.table.nbytes / 2**20:.1f} MB")
+
+        for name in ArchiveStats.REPORTS:
+            samples = []
+            for _ in range(5):
+                stats._cache.clear()
+                start = time.perf_counter()
+                stats.report(name)
+                samples.append(time.perf_counter() - start)
+            print(f"  {name:<22} {min(samples) * 1000:8.1f} ms")
+        stats.report('bytes_per_author')
+        start = time.perf_counter()
+        stats.report('bytes_per_author')
+        print(f"  {'(缓存命中)':<22} {(time.perf_counter() - start) * 1000:8.3f} ms")
+
+        entries = ledger.iter_entries()
+        tracemalloc.start()
+        sample = [next(entries) for _ in range(min(n, DICT_SAMPLE))]
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"dict 方式 (按 {len(sample)} 条换算): 约 {current / len(sample) * n / 2**20:.0f} MB")
+
+        ledger.record(make_entry(rng, n, now))
+        start = time.perf_counter()
+        stats.report('summary')
+        print(f"写入 1 条后增量更新并重新统计 {(time.perf_counter() - start) * 1000:.1f} ms")
+        ledger.close()
+
+if __name__ == '__main__':
+    main()
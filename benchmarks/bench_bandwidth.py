@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+'''
+带宽限制测试：本地桩服务器提供快速和限速 (模拟慢速 CDN 节点) 两种下载，
+多个下载同时经过同一个 BandwidthLimiter，检查：
+
+  - cap:      总速率不超过上限，多个下载平分带宽
+  - slow:     其中一个下载受服务器限速时，剩余带宽由其他下载使用
+  - runtime:  下载进行中调整上限，不中断连接即按新上限继续
+  - profiles: 按时段选择上限 (跨午夜时段)
+
+任一检查超出允许误差时以非零状态退出。
+
+用法: python benchmarks/bench_bandwidth.py [上限MB/s]   (默认 4)
+'''
+import os
+import sys
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api_client import create_session, DOWNLOAD_CHUNK_SIZE # noqa: E402
+from scheduler import BandwidthLimiter, profile_rate # noqa: E402
+
+MB = 1024 * 1024
+SLOW_RATE = 0.5 * MB # 慢速下载的服务器端速率
+DURATION = 3.0 # 每个场景的下载时长 (秒)
+TOLERANCE = 0.15 # 允许的相对误差
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    block = os.urandom(64 * 1024)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(1024 * MB))
+        self.end_headers()
+        slow = self.path.startswith('/slow')
+        try:
+            while True:
+                start = time.monotonic()
+                self.wfile.write(self.block)
+                if slow:
+                    time.sleep(max(0.0, len(self.block) / SLOW_RATE - (time.monotonic() - start)))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+def fetch(session, url, limiter, stream, deadline, counts):
+    # 与 ApiClient 下载循环相同：每读取一块数据经过限速器
+    with session.get(url, stream=True, timeout=30) as response:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            limiter.consume(len(chunk), stream)
+            counts[stream] = counts.get(stream, 0) + len(chunk)
+            if time.monotonic() >= deadline:
+                break
+
+def run(base_url, limiter, paths, duration=DURATION, on_half=None) -> dict:
+    '''
+    同时下载 paths，返回各下载的平均速率 (MB/s)
+    '''
+    session = create_session()
+    counts = {}
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=fetch, args=(session, base_url + path, limiter, f"{path}#{i}", deadline, counts))
+               for i, path in enumerate(paths)]
+    for t in threads:
+        t.start()
+    if on_half is not None:
+        time.sleep(duration / 2)
+        on_half(counts)
+    for t in threads:
+        t.join()
+    session.close()
+    return {stream: nbytes / duration / MB for stream, nbytes in sorted(counts.items())}
+
+def check(name, value, expected, failures):
+    ok = abs(value - expected) <= expected * TOLERANCE
+    print(f"  {name:<28} {value:6.2f}  (期望 {expected:.2f}) {'OK' if ok else '超出误差'}")
+    if not ok:
+        failures.append(name)
+
+def main():
+    cap = float(sys.argv[1]) if len(sys.argv) > 1 else 4.0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    failures = []
+
+    print(f"[cap] 3 个快速下载，上限 {cap} MB/s")
+    rates = run(base_url, BandwidthLimiter(cap * MB), ['/fast', '/fast', '/fast'])
+    check('总速率', sum(rates.values()), cap, failures)
+    for stream, rate in rates.items():
+        check(f'单个下载 {stream}', rate, cap / 3, failures)
+
+    print(f"[slow] 1 个慢速 ({SLOW_RATE / MB} MB/s) + 2 个快速下载")
+    rates = run(base_url, BandwidthLimiter(cap * MB), ['/slow', '/fast', '/fast'])
+    check('慢速下载', rates['/slow#0'], SLOW_RATE / MB, failures)
+    check('总速率', sum(rates.values()), cap, failures)
+
+    print(f"[runtime] 下载进行到一半时上限由 {cap} 调整为 {cap / 4} MB/s")
+    limiter = BandwidthLimiter(cap * MB)
+    marks = {}
+    def on_half(counts):
+        marks['half'] = sum(counts.values())
+        limiter.set_limits(rate=cap / 4 * MB, save=False)
+    rates = run(base_url, limiter, ['/fast', '/fast'], on_half=on_half)
+    second_half = (sum(rates.values()) * DURATION * MB - marks['half']) / (DURATION / 2) / MB
+    check('调整前总速率', marks['half'] / (DURATION / 2) / MB, cap, failures)
+    check('调整后总速率', second_half, cap / 4, failures)
+
+    print("[profiles] 按时段选择上限")
+    profiles = [('08:00', '23:00', 2 * MB), ('23:00', '01:00', MB)]
+    for clock, expected in (('12:00', 2 * MB), ('23:30', MB), ('00:30', MB), ('03:00', None)):
+        hour, minute = map(int, clock.split(':'))
+        when = time.struct_time((2025, 1, 1, hour, minute, 0, 0, 1, -1))
+        actual = profile_rate(profiles, None, when)
+        print(f"  {clock}: {actual}  {'OK' if actual == expected else '错误'}")
+        if actual != expected:
+            failures.append(f'profiles {clock}')
+
+    server.shutdown()
+    if failures:
+        print(f"失败: {', '.join(failures)}")
+        sys.exit(1)
+    print("全部通过")
+
+if __name__ == '__main__':
+    main()
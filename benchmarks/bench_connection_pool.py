@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+'''
+连接池基准测试：本地桩服务器统计新建连接(握手)次数与请求延迟。
+
+对比两种方式：
+  - before: 每次调用模块级 requests.get (每次都新建连接)
+  - after:  ApiClient.session (按主机复用 keep-alive 连接)
+
+用法: python benchmarks/bench_connection_pool.py [请求数] [线程数]
+'''
+import os
+import sys
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api_client import create_session # noqa: E402
+
+HANDSHAKE_DELAY = 0.02 # 模拟 TCP+TLS 握手开销 (秒)
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # 支持 keep-alive
+    disable_nagle_algorithm = True # 避免 Nagle + 延迟 ACK 干扰延迟测量
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        # 每个新连接只会调用一次 setup，即一次“握手”
+        with StubHandler.lock:
+            StubHandler.connections += 1
+        time.sleep(HANDSHAKE_DELAY)
+        super().setup()
+
+    def do_GET(self):
+        body = json.dumps({'id': self.path.rsplit('/', 1)[-1], 'title': 'stub'}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def run(label, get, base_url, total, workers):
+    StubHandler.connections = 0
+    latencies = []
+    lat_lock = threading.Lock()
+
+    def one(i):
+        start = time.perf_counter()
+        r = get(f"{base_url}/video/{i}", timeout=10)
+        r.raise_for_status()
+        r.json()
+        with lat_lock:
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    print(f"{label:<8} 请求: {total:>5}  新建连接: {StubHandler.connections:>5}  "
+          f"总耗时: {elapsed:.2f}s  p50: {p50:.2f}ms  p99: {p99:.2f}ms")
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        run('before', requests.get, base_url, total, workers)
+        session = create_session(pool_maxsize=workers)
+        run('after', session.get, base_url, total, workers)
+        session.close()
+    finally:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+'''
+下载日志基准测试：对比旧的 download_log.json 全量读写与 SQLite 账本单条写入的每次记录耗时。
+
+用法: python benchmarks/bench_ledger.py [条目数 ...]   (默认 10000 100000 1000000)
+'''
+import os
+import sys
+import json
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ledger import DownloadLedger # noqa: E402
+
+def make_entry(i, success=True):
+    return {
+        "video_id": f"v{i:012d}",
+        "avatar_name": f"author{i % 5000}",
+        "video_title": f"title {i}",
+        "video_numComments": i % 100,
+        "video_numLikes": i % 10000,
+        "video_numViews": i % 100000,
+        "video_tagList": ["tag%d" % (i % 300), "tag%d" % (i % 17)],
+        "video_createTime": "2025-04-10T00:00:00.000Z",
+        "download_time": "2025-04-10 22:02:00",
+        "video_path": f"/srv/video_downloader/data/downloads/v{i:012d}.mp4",
+        "thumbnail_path": f"/srv/video_downloader/data/downloads/thumbnails/v{i:012d}.jpg",
+        "video_size_mb": 123.4,
+        "success": success,
+        "last_update_timestamp": 1744293565.0 + i,
+    }
+
+def json_event(path, entry):
+    # 旧 app.log_download_info 的做法: 读取整个文件，修改一条，再整体写回
+    with open(path, 'r', encoding='utf-8') as f:
+        log_data = json.load(f)
+    log_data['total']['number'] += 1
+    log_data[entry['video_id']] = dict(entry, local_id=log_data['total']['number'])
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(log_data, f, ensure_ascii=False, indent=4)
+
+def bench(n, workdir):
+    json_path = os.path.join(workdir, f"log_{n}.json")
+    db_path = os.path.join(workdir, f"log_{n}.db")
+
+    data = {'total': {'number': n}}
+    for i in range(n):
+        data[f"v{i:012d}"] = dict(make_entry(i), local_id=i + 1)
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    del data
+
+    # 一次性迁移 (同时得到一个 n 条记录的账本)
+    start = time.perf_counter()
+    ledger = DownloadLedger(db_path, legacy_json_path=json_path)
+    migrate_s = time.perf_counter() - start
+
+    json_events = max(1, min(20, 200000 // n))
+    start = time.perf_counter()
+    for i in range(json_events):
+        json_event(json_path, make_entry(n + i))
+    json_ms = (time.perf_counter() - start) / json_events * 1000
+
+    ledger_events = 1000
+    start = time.perf_counter()
+    for i in range(ledger_events):
+        ledger.record(make_entry(n + i, success=False))
+    ledger_ms = (time.perf_counter() - start) / ledger_events * 1000
+
+    start = time.perf_counter()
+    for i in range(ledger_events):
+        ledger.is_success(f"v{(i * 7919) % n:012d}")
+    lookup_us = (time.perf_counter() - start) / ledger_events * 1e6
+    ledger.close()
+
+    print(f"{n:>9} 条: JSON 全量重写 {json_ms:>10.2f} ms/次 ({json_events} 次)  "
+          f"SQLite 账本 {ledger_ms:>6.3f} ms/次  按 ID 查询 {lookup_us:>6.1f} us/次  迁移 {migrate_s:.1f}s")
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [10000, 100000, 1000000]
+    with tempfile.TemporaryDirectory() as workdir:
+        for n in sizes:
+            bench(n, workdir)
+
+if __name__ == '__main__':
+    main()
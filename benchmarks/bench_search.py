@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+'''
+搜索索引基准测试：生成 N 条记录的账本，测量首次建立索引、各类查询的耗时 (中位数 / p95)
+以及写入少量新记录后的增量更新耗时。
+
+用法: python benchmarks/bench_search.py [条目数]   (默认 100000)
+'''
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ledger import DownloadLedger # noqa: E402
+from search_index import SearchIndex # noqa: E402
+
+WORDS = ['mmd', 'dance', 'miku', 'vocaloid', 'original', 'motion', 'r-18', 'cosplay', 'genshin', 'honkai', 'blender', '4k', '60fps']
+CJK = ['初音ミク', '東方', '霊夢', '魔理沙', '原神', '舞蹈', '可爱', '甘雨', '胡桃', '雷電将軍', 'ホロライブ', '踊ってみた']
+TAGS = ['mmd', 'dance', 'vocaloid', 'genshin', 'touhou', 'hololive', 'r-18', 'cosplay', 'original'] + [f"tag{i}" for i in range(300)]
+
+def make_entry(rng, i):
+    title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))) + ' ' + ''.join(rng.choice(CJK) for _ in range(rng.randint(1, 2)))
+    return {
+        "video_id": f"v{i:012d}",
+        "avatar_name": f"author{rng.randint(0, 5000)}",
+        "video_title": title,
+        "video_numLikes": int(rng.paretovariate(1.2) * 10),
+        "video_tagList": rng.sample(TAGS[:9], rng.randint(1, 3)) + [rng.choice(TAGS[9:])],
+        "video_createTime": f"20{rng.randint(18, 25)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T00:00:00.000Z",
+        "download_time": "2025-04-10 22:02:00",
+        "video_size_mb": round(rng.uniform(5, 2000), 1),
+        "success": rng.random() > 0.05,
+        "last_update_timestamp": 1744293565.0 + i,
+        "local_id": i + 1,
+    }
+
+QUERIES = [
+    ('单个词', {'q': 'dance'}),
+    ('多个词', {'q': 'mmd miku 60fps'}),
+    ('汉字', {'q': '初音ミク'}),
+    ('单个汉字', {'q': '雷'}),
+    ('Tag 布尔', {'tags': 'mmd AND (dance OR genshin) AND NOT r-18'}),
+    ('Tag + 点赞排序', {'tags': 'hololive', 'sort': 'video_numLikes'}),
+    ('范围', {'created_from': '2024-01-01', 'created_to': '2024-06-30', 'min_likes': 50}),
+    ('组合', {'q': '東方', 'tags': 'touhou OR mmd', 'min_size_mb': 100, 'success': 'true'}),
+    ('作者', {'author': 'author42'}),
+    ('全部 (默认排序)', {}),
+    ('全部 第 100 页', {'page': 100}),
+]
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, 'download_log.json')
+        data = {'total': {'number': n}}
+        for i in range(n):
+            entry = make_entry(rng, i)
+            data[entry['video_id']] = entry
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        del data
+        ledger = DownloadLedger(os.path.join(tmp, 'download_log.db'), legacy_json_path=json_path)
+
+        index = SearchIndex(ledger)
+        start = time.perf_counter()
+        index.refresh()
+        print(f"{n} 条记录，首次建立索引 {time.perf_counter() - start:.2f} 秒")
+
+        for name, args in QUERIES:
+            result = index.search(args)
+            median, p95 = timed(lambda: index.search(args), 50)
+            print(f"  {name:<16} 命中 {result['total']:>7}   中位数 {median:6.2f} ms   p95 {p95:6.2f} ms")
+
+        for delta in (1, 100):
+            for i in range(n, n + delta):
+                ledger.record(make_entry(rng, i))
+            start = time.perf_counter()
+            index.refresh()
+            print(f"写入 {delta} 条后增量更新 {(time.perf_counter() - start) * 1000:.2f} ms")
+            n += delta
+        ledger.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+'''
+分段下载测试：本地支持 Range / If-Range 的桩服务器 (每个连接限速，模拟 CDN 单连接速率)，
+直接调用 ApiClient.download_segmented，检查：
+
+  - speedup:  分段下载的文件摘要正确，耗时与单连接下载对比
+  - resume:   一个分段失败 (其他分段已完成) 后抛出异常，.part.json 记录已完成的分段；
+              重新加载未完成下载索引 (模拟重启) 后续传，只请求失败的分段，摘要正确
+  - failfast: 一个分段立即失败时不等待其他分段下载完成，正在下载的分段随即停止
+
+任一检查失败时以非零状态退出。
+
+用法: python benchmarks/bench_segmented.py [文件大小MB]   (默认 32，至少 9：分段大小对齐到 8 MB 摘要块)
+'''
+import os
+import re
+import sys
+import time
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api_client import ApiClient # noqa: E402
+from integrity import HASH_BLOCK_SIZE, file_digest # noqa: E402
+from partials import PartialIndex # noqa: E402
+from rate_limit import RateLimiter # noqa: E402
+from storage import StorageLayout, StorageRoot # noqa: E402
+from thumbnails import ThumbnailStore # noqa: E402
+
+MB = 1024 * 1024
+SEGMENTS = 4
+CONNECTION_RATE = 16 * MB # 服务器每个连接的速率 (bytes/s)
+WRITE_BLOCK = 64 * 1024
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    data = b''
+    etag = '"v1"'
+    rate = CONNECTION_RATE
+    fail_start = None # 从该偏移开始的分段请求返回 404 (探测大小的 bytes=0-0 除外)
+    fail_delay = 0.0 # 返回 404 之前等待的秒数
+    served = 0 # 已发送的数据字节数
+    requests = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        data = self.data
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        start, end = 0, len(data) - 1
+        partial = match is not None
+        if partial and self.headers.get('If-Range') not in (None, self.etag):
+            partial = False # 文件已变化：返回完整内容
+        if partial:
+            start = int(match[1])
+            end = min(int(match[2]), end) if match[2] else end
+        with RangeHandler.lock:
+            RangeHandler.requests.append((start, end))
+        if partial and start == self.fail_start and end > start:
+            time.sleep(self.fail_delay)
+            self.send_error(404)
+            return
+        self.send_response(206 if partial else 200)
+        if partial:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', self.etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        began = time.monotonic()
+        sent = 0
+        try:
+            for offset in range(start, end + 1, WRITE_BLOCK):
+                block = data[offset:min(offset + WRITE_BLOCK, end + 1)]
+                self.wfile.write(block)
+                sent += len(block)
+                with RangeHandler.lock:
+                    RangeHandler.served += len(block)
+                time.sleep(max(0.0, sent / self.rate - (time.monotonic() - began)))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+def reset_server(**fields):
+    RangeHandler.fail_start = None
+    RangeHandler.fail_delay = 0.0
+    RangeHandler.rate = CONNECTION_RATE
+    RangeHandler.served = 0
+    RangeHandler.requests = []
+    for key, value in fields.items():
+        setattr(RangeHandler, key, value)
+
+def make_client(tmp, partials, segments=SEGMENTS):
+    return ApiClient('bench@example.com', 'bench', token_file=os.path.join(tmp, 'token.json'),
+                     rate_limiter=RateLimiter(state_file=os.path.join(tmp, 'ratelimit.json')),
+                     partials=partials, thumbnails=ThumbnailStore(os.path.join(tmp, 'thumbnails'), preview_workers=0),
+                     storage=StorageLayout([StorageRoot(tmp, min_free=0)]), segments=segments, segment_min_size=1)
+
+def check(name, ok, detail, failures):
+    print(f"  {'OK  ' if ok else 'FAIL'} {name}: {detail}")
+    if not ok:
+        failures.append(name)
+
+def scenario_speedup(tmp, url, expected, failures):
+    reset_server()
+    partials = PartialIndex(tmp)
+    client = make_client(tmp, partials)
+    start = time.perf_counter()
+    path, size, digest = client.download_segmented('speedup', url, partials.open('speedup', client.storage.video_path('speedup', 'mp4')))
+    segmented = time.perf_counter() - start
+    check('speedup 摘要', digest == expected and file_digest(path) == expected, f"{size / MB:.0f} MB", failures)
+    single = len(RangeHandler.data) / CONNECTION_RATE
+    check('speedup 耗时', segmented < single * 0.6, f"分段 {segmented:.2f} 秒，单连接约 {single:.2f} 秒", failures)
+    client.close()
+
+def scenario_resume(tmp, url, expected, failures):
+    partials = PartialIndex(tmp)
+    client = make_client(tmp, partials)
+    video_file_name = client.storage.video_path('resume', 'mp4')
+    partial = partials.open('resume', video_file_name)
+    # 最后一个分段在其他分段完成后才失败 (分段大小与 download_segmented 相同，对齐到摘要块)
+    segment_size = -(-len(RangeHandler.data) // SEGMENTS)
+    segment_size = -(-segment_size // HASH_BLOCK_SIZE) * HASH_BLOCK_SIZE
+    count = -(-len(RangeHandler.data) // segment_size)
+    last_start = (count - 1) * segment_size
+    reset_server(fail_start=last_start, fail_delay=segment_size / CONNECTION_RATE * 2)
+    try:
+        client.download_segmented('resume', url, partial)
+        check('resume 失败', False, "分段失败时没有抛出异常", failures)
+    except Exception as e:
+        check('resume 失败', True, f"{type(e).__name__}", failures)
+    client.close()
+
+    # 模拟重启：重新扫描未完成下载
+    partials = PartialIndex.load(tmp)
+    partial = partials.get('resume')
+    done = sorted(partial.meta.get('segments', {}).get('done', [])) if partial is not None else []
+    check('resume 记录', done == list(range(count - 1)), f"已完成分段 {done}", failures)
+    if partial is None:
+        return
+    reset_server()
+    client = make_client(tmp, partials)
+    path, size, digest = client.download_segmented('resume', url, partial)
+    requested = sorted(RangeHandler.requests)
+    check('resume 续传', requested == [(last_start, len(RangeHandler.data) - 1)] and RangeHandler.served == len(RangeHandler.data) - last_start,
+          f"续传请求 {requested}，发送 {RangeHandler.served / MB:.1f} MB", failures)
+    check('resume 摘要', digest == expected and file_digest(path) == expected and not os.path.exists(partial.meta_path), path, failures)
+    client.close()
+
+def scenario_failfast(tmp, url, failures):
+    partials = PartialIndex(tmp)
+    client = make_client(tmp, partials)
+    partial = partials.open('failfast', client.storage.video_path('failfast', 'mp4'))
+    # 其他分段需要约 2 秒，第一个分段立即失败
+    rate = len(RangeHandler.data) / SEGMENTS / 2.0
+    reset_server(fail_start=0, rate=rate)
+    start = time.perf_counter()
+    try:
+        client.download_segmented('failfast', url, partial)
+        check('failfast 失败', False, "分段失败时没有抛出异常", failures)
+        return
+    except Exception:
+        elapsed = time.perf_counter() - start
+    served = RangeHandler.served
+    time.sleep(0.5)
+    check('failfast 耗时', elapsed < 1.0, f"{elapsed:.2f} 秒后抛出异常 (其他分段需要约 2 秒)", failures)
+    check('failfast 停止', RangeHandler.served - served < rate * 0.2, f"抛出异常后服务器又发送 {(RangeHandler.served - served) / MB:.2f} MB", failures)
+    client.close()
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    RangeHandler.data = os.urandom(size_mb * MB - 12345) # 最后一个分段包含不完整的块
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/video.mp4"
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        reference = os.path.join(tmp, 'reference')
+        with open(reference, 'wb') as f:
+            f.write(RangeHandler.data)
+        expected = file_digest(reference)
+        for name, run in (('speedup', lambda: scenario_speedup(tmp, url, expected, failures)),
+                          ('resume', lambda: scenario_resume(tmp, url, expected, failures)),
+                          ('failfast', lambda: scenario_failfast(tmp, url, failures))):
+            print(name)
+            run()
+    server.shutdown()
+    if failures:
+        print(f"失败: {', '.join(failures)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+'''
+写入路径基准测试：本地桩服务器 (独立进程，不计入 CPU 时间) 以最快速度返回数据，
+统计下载进程每 GB 消耗的 CPU 时间与吞吐量。
+
+对比：
+  - before: iter_content(32 KiB) + 缓冲 f.write (原下载循环)
+  - after:  readinto 复用缓冲区 + FileSink (预分配，无用户态写缓冲)
+  - after+fsync: 同上，完成时 fsync (默认的 FSYNC_POLICY)
+
+用法: python benchmarks/bench_write_path.py [每轮MB] [轮数]   (默认 512 3)
+'''
+import os
+import sys
+import time
+import tempfile
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api_client import create_session, DOWNLOAD_CHUNK_SIZE # noqa: E402
+from file_sink import BUFFER_POOL, FileSink, iter_response_into # noqa: E402
+
+MB = 1024 * 1024
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    block = os.urandom(MB)
+
+    def do_GET(self):
+        size = int(self.path.rsplit('/', 1)[-1]) * MB
+        self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        view = memoryview(self.block)
+        try:
+            for _ in range(size // MB):
+                self.wfile.write(view)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port_queue):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def before(response, path):
+    with open(path, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if chunk:
+                f.write(chunk)
+
+def after(response, path, fsync_policy='none'):
+    total_size = int(response.headers['Content-Length'])
+    with BUFFER_POOL.borrow() as buffer, FileSink(path, 'wb', total_size=total_size, fsync_policy=fsync_policy) as sink:
+        for chunk in iter_response_into(response, buffer):
+            sink.write(chunk)
+        sink.finish()
+
+def measure(session, url, path, write) -> tuple[float, float]:
+    '''
+    :return: (CPU 秒, 墙钟秒)
+    '''
+    cpu, wall = time.process_time(), time.perf_counter()
+    with session.get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        write(response, path)
+    return time.process_time() - cpu, time.perf_counter() - wall
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(port_queue,), daemon=True)
+    server.start()
+    url = f"http://127.0.0.1:{port_queue.get()}/{size_mb}"
+    session = create_session()
+    variants = [
+        ('before', before),
+        ('after', after),
+        ('after+fsync', lambda response, path: after(response, path, 'complete')),
+    ]
+    gb = size_mb / 1024
+    print(f"每轮 {size_mb} MB，{rounds} 轮，取最小值")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'video.mp4')
+            results = {}
+            for name, write in variants:
+                samples = [measure(session, url, path, write) for _ in range(rounds)]
+                os.remove(path)
+                cpu = min(s[0] for s in samples)
+                wall = min(s[1] for s in samples)
+                results[name] = cpu
+                print(f"  {name:<12} CPU {cpu / gb:6.3f} 秒/GB   吞吐 {size_mb / wall:8.1f} MB/s")
+            print(f"CPU 时间: after 为 before 的 {results['after'] / results['before'] * 100:.0f}%")
+    finally:
+        session.close()
+        server.terminate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+'''
+列表抓取计划：按声明的来源 (排序、分级、是否订阅、页数) 抓取 /videos 列表，
+每个唯一页面只请求一次，结果按视频ID去重后交给下载器。
+'''
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.exceptions import RequestException
+
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+# 并发抓取的来源数
+CRAWL_WORKERS = 4
+
+class CrawlSource:
+    '''
+    一个列表来源，例如 “trending / all / 前 3 页”
+    '''
+    def __init__(self, sort='date', rating='all', subscribed=False, pages=1, limit=32):
+        '''
+        :param sort: date, trending, popularity, views, likes / 最新，流行，人气，最多人观看，最多赞
+        :param rating: all, general, ecchi / 所有，普通，H
+        :param subscribed: 是否订阅
+        :param pages: 最多抓取的页数
+        :param limit: 每页数量 (API 目前忽略该参数)
+        '''
+        self.sort = sort
+        self.rating = rating
+        self.subscribed = subscribed
+        self.pages = pages
+        self.limit = limit
+
+    def page_key(self, page) -> tuple:
+        # limit 参数不生效，不同 limit 的同一页视为同一个页面
+        return (self.sort, self.rating, self.subscribed, page)
+
+    def __repr__(self):
+        return f"CrawlSource(sort={self.sort!r}, rating={self.rating!r}, subscribed={self.subscribed}, pages={self.pages})"
+
+class CrawlPlanner:
+    '''
+    抓取计划执行器。
+    多个来源并发抓取，同一来源内按页顺序抓取；某一页的视频全部已下载时停止继续翻页。
+    '''
+    def __init__(self, client, sources, completed_index=None, max_workers=CRAWL_WORKERS):
+        '''
+        :param client: ApiClient
+        :param sources: CrawlSource 列表
+        :param completed_index: CompletedIndex，用于判断是否已下载；为 None 时总是抓满页数
+        :param max_workers: 并发抓取的来源数
+        '''
+        self.client = client
+        # 相同 (排序, 分级, 订阅) 的来源合并为一个，取最大页数，保证每个页面只请求一次
+        merged = {}
+        for source in sources:
+            key = source.page_key(None)
+            if key not in merged or source.pages > merged[key].pages:
+                merged[key] = source
+        self.sources = list(merged.values())
+        self.completed_index = completed_index
+        self.max_workers = max_workers
+
+        self._lock = threading.Lock()
+        self._fetched_pages = {} # page_key -> 视频列表
+        self.videos = {} # video_id -> 视频条目 (保持首次出现的顺序)
+        self.subscribed_ids = set()
+
+    def _fetch_page(self, source, page) -> list:
+        key = source.page_key(page)
+        with self._lock:
+            if key in self._fetched_pages:
+                return self._fetched_pages[key]
+        r = self.client.get_videos(sort=source.sort, rating=source.rating, page=page, limit=source.limit, subscribed=source.subscribed)
+        videos = r.json().get('results', [])
+        with self._lock:
+            self._fetched_pages[key] = videos
+        return videos
+
+    def _crawl_source(self, source):
+        for page in range(source.pages):
+            try:
+                videos = self._fetch_page(source, page)
+            except RequestException as e:
+                logger.error(f"获取 {source} 第 {page} 页失败: {e}")
+                return
+            except Exception as e: # 包括可能的 JSONDecodeError
+                logger.error(f"处理 {source} 第 {page} 页响应时出错: {e}")
+                return
+            if not videos:
+                break
+
+            archived = 0
+            with self._lock:
+                for video in videos:
+                    video_id = video.get('id')
+                    if not video_id:
+                        logger.warning(f"视频信息缺少 ID: {video}")
+                        continue
+                    if self.completed_index is not None and self.completed_index.is_completed(video_id):
+                        archived += 1
+                        continue
+                    self.videos.setdefault(video_id, video)
+                    if source.subscribed:
+                        self.subscribed_ids.add(video_id)
+
+            if self.completed_index is not None and archived == len(videos):
+                logger.info(f"{source} 第 {page} 页的视频均已下载，停止翻页。")
+                break
+
+    def plan(self) -> list:
+        '''
+        执行抓取计划
+        :return: 去重后尚未下载的视频条目列表
+        '''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            list(pool.map(self._crawl_source, self.sources))
+        logger.info(f"抓取计划完成: 请求 {len(self._fetched_pages)} 个页面，待下载视频 {len(self.videos)} 个。")
+        return list(self.videos.values())
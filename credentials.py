@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+'''
+登录凭证管理：所有线程共享一个 token，到期前主动刷新，收到 401 时重新登录；
+token 持久化到磁盘，重启或 app.sh 定时任务可以直接复用，不必每次都请求登录接口。
+'''
+import os
+import json
+import time
+import base64
+import hashlib
+import threading
+
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+# token 在到期前多少秒主动刷新
+TOKEN_REFRESH_MARGIN = 300
+# 无法从 token 中解析到期时间时，视为登录后多久过期 (秒)
+TOKEN_DEFAULT_TTL = 3600
+
+def token_expires_at(token) -> float | None:
+    '''
+    从 JWT 的 exp 字段解析到期时间 (不校验签名)
+    :return: UNIX 时间戳，无法解析时为 None
+    '''
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        return float(exp) if exp else None
+    except (AttributeError, IndexError, ValueError, TypeError):
+        return None
+
+class TokenStore:
+    '''
+    token 持久化文件，按邮箱保存 (文件中只保存邮箱的哈希)
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(email):
+        return hashlib.sha1(email.encode('utf-8')).hexdigest()
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self, email) -> tuple[str, float] | None:
+        '''
+        :return: (token, 到期时间)，没有保存时为 None
+        '''
+        entry = self._read().get(self._key(email))
+        if not entry or not entry.get('token'):
+            return None
+        return entry['token'], entry.get('expires_at') or 0.0
+
+    def save(self, email, token, expires_at):
+        with self._lock:
+            data = self._read()
+            if token is None:
+                data.pop(self._key(email), None)
+            else:
+                data[self._key(email)] = {'token': token, 'expires_at': expires_at}
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600) # token 只允许本用户读取
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+
+class CredentialManager:
+    '''
+    线程安全的 token 管理器。
+    并发请求同时发现 token 失效时只会登录一次，其他线程等待并使用新 token。
+    '''
+    def __init__(self, email, password, login_func, token_file=None, refresh_margin=TOKEN_REFRESH_MARGIN):
+        '''
+        :param email: 邮箱
+        :param password: 密码
+        :param login_func: 登录函数 login_func(email, password) -> token，失败时抛出 ConnectionError；
+            为 None 时只负责保存/读取 token，由调用方登录后调用 set_token
+        :param token_file: token 持久化文件，None 表示不持久化
+        :param refresh_margin: 到期前多少秒主动刷新
+        '''
+        self.email = email
+        self.password = password
+        self.login_func = login_func
+        self.store = TokenStore(token_file) if token_file else None
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0.0
+        if self.store is not None:
+            saved = self.store.load(email)
+            if saved is not None:
+                self.token, self.expires_at = saved
+
+    def is_valid(self) -> bool:
+        return self.token is not None and time.time() < self.expires_at - self.refresh_margin
+
+    def set_token(self, token):
+        '''
+        设置新登录得到的 token 并持久化 (供自行实现登录的异步客户端使用)
+        '''
+        self.token = token
+        self.expires_at = token_expires_at(token) or time.time() + TOKEN_DEFAULT_TTL
+        if self.store is not None:
+            try:
+                self.store.save(self.email, token, self.expires_at)
+            except OSError as e:
+                logger.warning(f"保存登录凭证失败: {e}")
+
+    def get_token(self) -> str:
+        '''
+        获取有效的 token，即将过期或没有 token 时登录
+        '''
+        if self.is_valid():
+            return self.token
+        with self._lock:
+            if not self.is_valid():
+                self.set_token(self.login_func(self.email, self.password))
+            return self.token
+
+    def refresh(self, failed_token=None) -> str:
+        '''
+        强制重新登录 (收到 401 时调用)
+        :param failed_token: 被拒绝的 token；如果其他线程已经换了新 token，则直接使用新 token
+        '''
+        with self._lock:
+            if failed_token is None or failed_token == self.token:
+                self.set_token(self.login_func(self.email, self.password))
+            return self.token
+
+    def clear(self):
+        '''
+        丢弃当前 token (包括磁盘上的)
+        '''
+        with self._lock:
+            self.token = None
+            self.expires_at = 0.0
+            if self.store is not None:
+                self.store.save(self.email, None, 0.0)
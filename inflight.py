@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+'''
+下载中视频登记：同一个视频同一时间只允许一个下载任务写入文件。
+使用 {video_id}.lock 文件 + flock 实现跨线程、跨进程 (批量任务与 web 服务) 互斥，
+锁文件中同时保存下载进度，后来的请求可以直接查看正在进行的下载进度。
+'''
+import os
+import json
+import time
+import fcntl
+import threading
+
+# 进度写入锁文件的最小间隔 (秒)
+PROGRESS_WRITE_INTERVAL = 1.0
+
+class InflightLock:
+    '''
+    一个正在进行的下载。持有期间其他线程/进程无法获取同一视频的锁。
+    '''
+    def __init__(self, registry, video_id, path, fd):
+        self.registry = registry
+        self.video_id = video_id
+        self.path = path
+        self._fd = fd
+        self._last_write = 0.0
+        self.progress = {'video_id': video_id, 'pid': os.getpid(), 'started_at': time.time(),
+                         'downloaded': 0, 'total': None, 'updated_at': time.time()}
+        self._write_progress()
+
+    def _write_progress(self):
+        data = json.dumps(self.progress).encode('utf-8')
+        os.ftruncate(self._fd, 0)
+        os.pwrite(self._fd, data, 0)
+        self._last_write = time.monotonic()
+
+    def update_progress(self, downloaded, total=None):
+        '''
+        更新下载进度 (可作为下载函数的 progress_callback)
+        :param downloaded: 已下载字节数
+        :param total: 总字节数，未知时为 None
+        '''
+        self.progress['downloaded'] = downloaded
+        if total is not None:
+            self.progress['total'] = total
+        self.progress['updated_at'] = time.time()
+        if time.monotonic() - self._last_write >= PROGRESS_WRITE_INTERVAL:
+            self._write_progress()
+
+    def release(self):
+        self.registry._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+class InflightRegistry:
+    '''
+    下载中视频登记表
+    '''
+    def __init__(self, lock_dir):
+        '''
+        :param lock_dir: 锁文件目录 (批量任务与 web 服务需要使用同一目录)
+        '''
+        self.lock_dir = lock_dir
+        os.makedirs(lock_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._active = {} # video_id -> InflightLock (本进程持有的锁)
+        self._released = threading.Condition(self._lock)
+
+    def _path(self, video_id):
+        return os.path.join(self.lock_dir, f"{video_id}.lock")
+
+    def try_acquire(self, video_id) -> InflightLock | None:
+        '''
+        尝试登记下载，视频已在下载中 (本进程或其他进程) 时返回 None
+        '''
+        path = self._path(video_id)
+        with self._lock:
+            if video_id in self._active:
+                return None
+            while True:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)
+                    return None
+                # 加锁前文件可能已被上一个持有者删除，此时锁住的是旧文件，需要重新打开
+                try:
+                    if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                        break
+                except FileNotFoundError:
+                    pass
+                os.close(fd)
+            lock = InflightLock(self, video_id, path, fd)
+            self._active[video_id] = lock
+            return lock
+
+    def _release(self, lock):
+        with self._lock:
+            if self._active.get(lock.video_id) is not lock:
+                return
+            del self._active[lock.video_id]
+            try:
+                os.unlink(lock.path) # 先删除再解锁，等待中的进程会发现 inode 变化并重新打开
+            except FileNotFoundError:
+                pass
+            os.close(lock._fd) # 关闭文件即释放 flock
+            self._released.notify_all()
+
+    def is_active(self, video_id) -> bool:
+        '''
+        视频是否正在下载 (本进程或其他进程)
+        '''
+        return self.progress(video_id) is not None
+
+    def progress(self, video_id) -> dict | None:
+        '''
+        获取正在进行的下载进度
+        :return: {'video_id', 'pid', 'started_at', 'downloaded', 'total', 'updated_at'}；未在下载时返回 None
+        '''
+        with self._lock:
+            lock = self._active.get(video_id)
+            if lock is not None:
+                return dict(lock.progress)
+        path = self._path(video_id)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                return None # 能加锁说明没有进程在下载 (遗留的锁文件)
+            except BlockingIOError:
+                pass
+            data = os.read(fd, 65536)
+        finally:
+            os.close(fd)
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            return {'video_id': video_id, 'downloaded': None, 'total': None}
+
+    def wait(self, video_id, timeout=None, poll_interval=1.0) -> bool:
+        '''
+        等待视频的下载结束
+        :return: 在超时前结束返回 True
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.is_active(video_id):
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            with self._lock:
+                # 本进程内的下载结束时会立即唤醒，其他进程的下载按轮询间隔检查
+                self._released.wait(poll_interval if remaining is None else min(poll_interval, remaining))
+        return True
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+'''
+视频文件完整性校验。
+
+摘要算法为“分块 SHA-256”：文件按 HASH_BLOCK_SIZE 切块，每块计算 SHA-256，
+最终摘要为所有块摘要拼接后的 SHA-256。下载时边接收边计算，已完成块的摘要保存在
+未完成下载的元数据中 (partials.py)，断点续传时最多只需重新读取最后一个不完整的块。
+
+用法: python integrity.py verify [--workers N] [--backfill]
+'''
+import os
+import sys
+import mmap
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+from log_config import get_logger, setup_logging
+
+logger = get_logger(__name__)
+
+HASH_BLOCK_SIZE = 8 * 1024 * 1024 # 分块大小，分段下载的分段大小会对齐到该值
+HASH_ALGORITHM = 'sha256-blocks-8m' # 摘要前缀，块大小变化时必须同时修改
+
+def combine_block_digests(block_digests) -> str:
+    '''
+    由各块摘要 (hex) 计算最终摘要
+    '''
+    h = hashlib.sha256()
+    for digest in block_digests:
+        h.update(bytes.fromhex(digest))
+    return f"{HASH_ALGORITHM}:{h.hexdigest()}"
+
+class BlockHasher:
+    '''
+    流式分块哈希，update() 需按文件顺序传入数据
+    '''
+    def __init__(self, block_size=HASH_BLOCK_SIZE, block_digests=None):
+        self.block_size = block_size
+        self.block_digests = list(block_digests or [])
+        self._current = hashlib.sha256()
+        self._current_len = 0
+
+    @property
+    def offset(self) -> int:
+        '''
+        已经哈希的字节数
+        '''
+        return len(self.block_digests) * self.block_size + self._current_len
+
+    def update(self, data) -> bool:
+        '''
+        :return: 本次是否有块完成 (可以据此决定是否持久化状态)
+        '''
+        view = memoryview(data)
+        completed = False
+        while view:
+            take = min(len(view), self.block_size - self._current_len)
+            self._current.update(view[:take])
+            self._current_len += take
+            view = view[take:]
+            if self._current_len == self.block_size:
+                self.block_digests.append(self._current.hexdigest())
+                self._current = hashlib.sha256()
+                self._current_len = 0
+                completed = True
+        return completed
+
+    def block_list(self) -> list:
+        '''
+        所有块的摘要，包括最后一个不完整的块
+        '''
+        digests = list(self.block_digests)
+        if self._current_len or not digests:
+            digests.append(self._current.hexdigest())
+        return digests
+
+    def hexdigest(self) -> str:
+        return combine_block_digests(self.block_list())
+
+def _feed_file(hasher, path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = f.read(min(remaining, HASH_BLOCK_SIZE))
+            if not data:
+                break
+            hasher.update(data)
+            remaining -= len(data)
+
+def open_hasher(video_file_name, resume_byte_pos, block_digests=None) -> BlockHasher:
+    '''
+    为续传创建哈希器：优先使用已记录的已完成块摘要，只重新读取剩余的部分块；
+    没有记录或与文件不符时从头读取已下载的部分。
+    :param video_file_name: 已下载部分的文件路径 (None 表示从头下载)
+    :param resume_byte_pos: 续传位置 (即已下载的字节数)
+    :param block_digests: 已完成块的摘要 (未完成下载的元数据)，None 表示没有记录
+    '''
+    hasher = BlockHasher()
+    if not video_file_name or resume_byte_pos <= 0:
+        return hasher
+    if block_digests is not None and len(block_digests) * HASH_BLOCK_SIZE <= resume_byte_pos:
+        hasher = BlockHasher(block_digests=block_digests)
+    _feed_file(hasher, video_file_name, hasher.offset, resume_byte_pos)
+    return hasher
+
+def file_digest(path) -> str:
+    '''
+    使用 mmap 计算整个文件的摘要 (用于校验，不经过 Python 缓冲区复制)
+    '''
+    size = os.path.getsize(path)
+    if size == 0:
+        return BlockHasher().hexdigest()
+    digests = []
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            for offset in range(0, size, HASH_BLOCK_SIZE):
+                digests.append(hashlib.sha256(view[offset:offset + HASH_BLOCK_SIZE]).hexdigest())
+        finally:
+            view.release()
+    return combine_block_digests(digests)
+
+def _verify_one(item):
+    video_id, video_path, expected = item
+    if not video_path or not os.path.exists(video_path):
+        return video_id, video_path, expected, None, 'missing'
+    try:
+        actual = file_digest(video_path)
+    except OSError as e:
+        return video_id, video_path, expected, None, f'error: {e}'
+    if expected is None:
+        return video_id, video_path, expected, actual, 'no_digest'
+    return video_id, video_path, expected, actual, 'ok' if actual == expected else 'mismatch'
+
+def verify_archive(ledger, workers=None, backfill=False) -> dict:
+    '''
+    多进程并行校验账本中所有下载成功的视频，不会重新下载任何文件
+    :param ledger: DownloadLedger
+    :param workers: 进程数，默认等于 CPU 核数
+    :param backfill: 为没有摘要的旧记录计算并写入摘要
+    :return: 各状态的数量 {'ok': n, 'mismatch': n, 'missing': n, 'no_digest': n, ...}
+    '''
+    items = [(entry['video_id'], entry.get('video_path'), entry.get('video_digest'))
+             for entry in ledger.iter_entries() if entry.get('success')]
+    logger.info(f"开始校验 {len(items)} 个视频...")
+    counts = {}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for video_id, video_path, expected, actual, status in pool.map(_verify_one, items, chunksize=4):
+            counts[status] = counts.get(status, 0) + 1
+            if status == 'mismatch':
+                logger.error(f"视频 {video_id} 校验失败: {video_path} 期望 {expected}，实际 {actual}", extra={'video_id': video_id, 'stage': 'verify'})
+            elif status == 'missing':
+                logger.error(f"视频 {video_id} 文件不存在: {video_path}", extra={'video_id': video_id, 'stage': 'verify'})
+            elif status.startswith('error'):
+                logger.error(f"视频 {video_id} 读取失败: {status}", extra={'video_id': video_id, 'stage': 'verify'})
+            elif status == 'no_digest' and backfill:
+                ledger.update_entry(video_id, video_digest=actual)
+    logger.info(f"校验完成: {counts}")
+    return counts
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'verify':
+        print(__doc__)
+        sys.exit(2)
+    from app import get_ledger
+
+    setup_logging(console_level='INFO')
+
+    args = sys.argv[2:]
+    workers = int(args[args.index('--workers') + 1]) if '--workers' in args else None
+    result = verify_archive(get_ledger(), workers=workers, backfill='--backfill' in args)
+    sys.exit(1 if result.get('mismatch') or result.get('missing') else 0)
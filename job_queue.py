@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+'''
+持久化下载任务队列：使用 SQLite (WAL 模式) 保存任务及其状态，进程重启后任务不会丢失。
+
+状态: queued (等待) -> running (执行中) -> done (完成) / failed (失败)
+可重试的失败会重新进入 queued 并设置 not_before；进程崩溃时遗留的 running 任务在启动时恢复为 queued。
+web 服务的按需下载与批量任务 (在有任务执行器运行时) 都写入同一个队列，由同一个执行器按同一并发限制消费。
+'''
+import json
+import time
+import sqlite3
+import threading
+
+JOBS_FILE_NAME = 'jobs.db'
+
+# 任务优先级 (越小越先执行)
+JOB_PRIORITY_WEB = 0 # 网页按需下载，有人在等待
+JOB_PRIORITY_SUBSCRIBED = 1
+JOB_PRIORITY_BATCH = 2
+# 单个任务最多执行次数 (包括可重试失败后的重试)
+JOB_MAX_ATTEMPTS = 5
+# 执行器心跳超过该秒数未更新视为执行器未运行
+RUNNER_HEARTBEAT_TIMEOUT = 30
+
+JOB_STATES = ('queued', 'running', 'done', 'failed')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    video_id TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    priority INTEGER NOT NULL DEFAULT 0,
+    source TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    not_before REAL NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    error TEXT,
+    meta TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs(state, priority, id);
+CREATE INDEX IF NOT EXISTS idx_jobs_video_id ON jobs(video_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+_COLUMNS = ('id', 'video_id', 'state', 'priority', 'source', 'attempts', 'max_attempts',
+            'not_before', 'created_at', 'updated_at', 'error', 'meta')
+
+def _row_to_job(row) -> dict | None:
+    if row is None:
+        return None
+    job = dict(zip(_COLUMNS, row))
+    job['meta'] = json.loads(job['meta']) if job['meta'] else None
+    return job
+
+class JobQueue:
+    '''
+    线程安全、多进程共享的下载任务队列
+    '''
+    def __init__(self, path):
+        '''
+        :param path: SQLite 数据库文件路径
+        '''
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=30000')
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _select(self, where, params=()):
+        return self._conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE {where}", params)
+
+    def enqueue(self, video_id, priority=JOB_PRIORITY_WEB, source='web', meta=None, max_attempts=JOB_MAX_ATTEMPTS) -> dict:
+        '''
+        添加下载任务。同一视频已有等待中或执行中的任务时不会重复添加 (但会提升其优先级)。
+        :param video_id: 视频ID
+        :param priority: 优先级，越小越先执行
+        :param source: 任务来源 (web, batch ...)
+        :param meta: extract_video_meta 的结果，为 None 时由执行器获取
+        :param max_attempts: 最多执行次数
+        :return: 任务 dict
+        '''
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                job = _row_to_job(self._select("video_id = ? AND state IN ('queued', 'running') ORDER BY id LIMIT 1", (video_id,)).fetchone())
+                if job is None:
+                    cur = self._conn.execute('INSERT INTO jobs(video_id, state, priority, source, max_attempts, created_at, updated_at, meta) '
+                                             "VALUES(?, 'queued', ?, ?, ?, ?, ?, ?)",
+                                             (video_id, priority, source, max_attempts, now, now,
+                                              json.dumps(meta, ensure_ascii=False) if meta is not None else None))
+                    job_id = cur.lastrowid
+                else:
+                    job_id = job['id']
+                    if priority < job['priority']:
+                        self._conn.execute('UPDATE jobs SET priority = ?, updated_at = ? WHERE id = ?', (priority, now, job_id))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            return self.get(job_id)
+
+    def claim(self) -> dict | None:
+        '''
+        取出优先级最高的可执行任务并标记为 running (多个进程同时调用也只有一个能取到)
+        :return: 任务 dict，没有可执行任务时为 None
+        '''
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute("SELECT id FROM jobs WHERE state = 'queued' AND not_before <= ? "
+                                         'ORDER BY priority, id LIMIT 1', (now,)).fetchone()
+                if row is None:
+                    self._conn.execute('COMMIT')
+                    return None
+                self._conn.execute("UPDATE jobs SET state = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?", (now, row[0]))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            return self.get(row[0])
+
+    def finish(self, job_id, state='done', error=None):
+        '''
+        结束任务
+        :param state: done 或 failed
+        '''
+        if state not in ('done', 'failed'):
+            raise ValueError(f"无效的结束状态: {state}")
+        with self._lock:
+            self._conn.execute('UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE id = ?', (state, error, time.time(), job_id))
+
+    def retry(self, job_id, delay, error=None, count_attempt=True) -> bool:
+        '''
+        任务稍后重试；执行次数用完时标记为 failed
+        :param delay: 多少秒后重试
+        :param count_attempt: 为 False 时本次执行不计入次数 (例如视频正由其他任务下载)
+        :return: 是否重新进入队列
+        '''
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                if not count_attempt:
+                    self._conn.execute('UPDATE jobs SET attempts = MAX(attempts - 1, 0) WHERE id = ?', (job_id,))
+                requeued = self._conn.execute("UPDATE jobs SET state = 'queued', not_before = ?, error = ?, updated_at = ? "
+                                              'WHERE id = ? AND attempts < max_attempts', (now + delay, error, now, job_id)).rowcount
+                if not requeued:
+                    self._conn.execute("UPDATE jobs SET state = 'failed', error = ?, updated_at = ? WHERE id = ?", (error, now, job_id))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            return bool(requeued)
+
+    def recover(self) -> int:
+        '''
+        将遗留的 running 任务恢复为 queued (执行器启动时调用，此时本机没有其他执行器在运行)
+        :return: 恢复的任务数
+        '''
+        with self._lock:
+            return self._conn.execute("UPDATE jobs SET state = 'queued', attempts = MAX(attempts - 1, 0), updated_at = ? "
+                                      "WHERE state = 'running'", (time.time(),)).rowcount
+
+    def get(self, job_id) -> dict | None:
+        with self._lock:
+            return _row_to_job(self._select('id = ?', (job_id,)).fetchone())
+
+    def list_jobs(self, state=None, limit=50, offset=0) -> list:
+        '''
+        按提交时间倒序列出任务
+        :param state: 只列出该状态的任务，None 表示全部
+        '''
+        with self._lock:
+            if state is None:
+                rows = self._select('1 ORDER BY id DESC LIMIT ? OFFSET ?', (limit, offset))
+            else:
+                rows = self._select('state = ? ORDER BY id DESC LIMIT ? OFFSET ?', (state, limit, offset))
+            return [_row_to_job(row) for row in rows.fetchall()]
+
+    def counts(self) -> dict:
+        '''
+        各状态的任务数
+        '''
+        with self._lock:
+            counts = dict.fromkeys(JOB_STATES, 0)
+            counts.update(self._conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+            return counts
+
+    def heartbeat(self):
+        '''
+        执行器心跳 (由执行器定期调用)
+        '''
+        with self._lock:
+            self._conn.execute('INSERT INTO meta(key, value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                               ('runner_heartbeat', str(time.time())))
+
+    def runner_alive(self, timeout=RUNNER_HEARTBEAT_TIMEOUT) -> bool:
+        '''
+        是否有执行器正在运行 (批量任务据此决定是交给执行器还是自己下载)
+        '''
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'runner_heartbeat'").fetchone()
+        return row is not None and time.time() - float(row[0]) < timeout
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+'''
+下载任务执行器：从持久化任务队列 (job_queue.py) 取出任务，交给共享的 DownloadScheduler 执行。
+可以嵌入 web 服务 (json_to_web.py)，也可以作为独立进程运行：
+
+    python job_runner.py
+
+同一时间只应运行一个执行器；批量任务 (app.py) 检测到执行器在运行时会把视频加入队列而不是自己下载。
+'''
+import time
+import queue
+import threading
+
+from app import (json_read, get_completed_index, get_inflight_registry, get_job_queue, get_storage_migrator, extract_video_meta,
+                 schedule_download, export_static, DOWNLOAD_ATTACHED)
+from api_client import ApiClient, get_storage_layout
+from log_config import get_logger, setup_logging
+from partials import PARTIAL_JANITOR_INTERVAL
+from retry_policy import JOB_RETRY, classify_error
+from static_export import STATIC_EXPORT_INTERVAL
+from scheduler import DownloadScheduler, VIDEO_WORKERS, DEFAULT_VIDEO_SIZE, video_expected_size
+
+logger = get_logger(__name__)
+
+# 执行器同时处理的任务数 (视频阶段的并发仍由调度器限制，这里多取一些让缩略图/元数据阶段提前进行)
+JOB_RUNNER_ACTIVE_JOBS = VIDEO_WORKERS * 2
+# 队列为空时的轮询间隔 (秒)
+JOB_POLL_INTERVAL = 2.0
+# 执行器心跳间隔 (秒)
+JOB_HEARTBEAT_INTERVAL = 5.0
+# 视频正由其他进程下载时的重新检查间隔 (秒)；下载失败的重试间隔见 retry_policy.JOB_RETRY
+JOB_RETRY_DELAY = 30
+
+def describe_job(job) -> dict:
+    '''
+    任务状态 (执行中的任务附带下载进度)，用于 /jobs 接口
+    '''
+    if job is None:
+        return None
+    info = {key: value for key, value in job.items() if key != 'meta'}
+    info['progress'] = get_inflight_registry().progress(job['video_id']) if job['state'] == 'running' else None
+    return info
+
+class JobRunner:
+    '''
+    任务执行器
+    '''
+    def __init__(self, client, scheduler=None, job_queue=None, active_jobs=JOB_RUNNER_ACTIVE_JOBS, poll_interval=JOB_POLL_INTERVAL):
+        '''
+        :param client: ApiClient
+        :param scheduler: 共享的 DownloadScheduler，为 None 时单独创建
+        :param job_queue: JobQueue，默认使用 app.get_job_queue()
+        :param active_jobs: 同时处理的任务数
+        :param poll_interval: 队列为空时的轮询间隔
+        '''
+        self.client = client
+        self.own_scheduler = scheduler is None
+        self.scheduler = scheduler or DownloadScheduler(disk_guard=get_storage_layout().admission)
+        self.client.bandwidth_limiter = self.scheduler.bandwidth
+        self.job_queue = job_queue or get_job_queue()
+        self.poll_interval = poll_interval
+        self.log_lock = threading.Lock()
+        self._slots = threading.Semaphore(active_jobs)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if not self.job_queue.runner_alive():
+            # 没有其他执行器在运行，上次退出时遗留的 running 任务需要重新执行
+            recovered = self.job_queue.recover()
+            if recovered:
+                logger.info(f"恢复 {recovered} 个未完成的任务")
+        self.job_queue.heartbeat()
+        self.scheduler.start()
+        # 后台把视频移到存储布局规定的位置 (旧的平铺文件、超过保留期的 hot 文件)
+        get_storage_migrator().start()
+        self._thread = threading.Thread(target=self._dispatch_loop, name='job-dispatcher', daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        '''
+        有新任务加入队列时调用，立即唤醒分派线程
+        '''
+        self._wakeup.set()
+
+    def stop(self):
+        '''
+        停止分派新任务，等待已分派的任务完成
+        '''
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        get_storage_migrator().stop()
+        if self.own_scheduler:
+            self.scheduler.shutdown()
+        else:
+            self.scheduler.join()
+
+    def _dispatch_loop(self):
+        last_heartbeat = last_sweep = last_export = time.monotonic()
+        while not self._stop.is_set():
+            if time.monotonic() - last_heartbeat >= JOB_HEARTBEAT_INTERVAL:
+                self.job_queue.heartbeat()
+                last_heartbeat = time.monotonic()
+            if time.monotonic() - last_sweep >= PARTIAL_JANITOR_INTERVAL:
+                # 清理长时间没有进展的未完成下载 (正在下载的视频除外)
+                try:
+                    self.client.partials.sweep(is_active=get_inflight_registry().is_active)
+                except OSError as e:
+                    logger.error(f"清理未完成下载失败: {e}")
+                last_sweep = time.monotonic()
+            if not self._slots.acquire(timeout=self.poll_interval):
+                continue
+            try:
+                job = self.job_queue.claim()
+            except Exception as e:
+                logger.error(f"读取任务队列失败: {e}")
+                job = None
+            if job is None:
+                self._slots.release()
+                if time.monotonic() - last_export >= STATIC_EXPORT_INTERVAL:
+                    # 队列空闲时把新的下载记录写入静态导出 (只写入变化的分片)
+                    export_static()
+                    last_export = time.monotonic()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._start_job(job)
+
+    def _start_job(self, job):
+        video_id = job['video_id']
+        if get_completed_index().is_completed(video_id):
+            self.job_queue.finish(job['id'], 'done')
+            self._slots.release()
+            return
+        logger.info(f"开始任务 {job['id']}: 视频 {video_id} (第 {job['attempts']} 次)", extra={'video_id': video_id, 'stage': 'job', 'job_id': job['id']})
+        self.scheduler.submit('metadata', self._prepare_job, job, priority=(job['priority'], job['id']))
+
+    def _prepare_job(self, job):
+        # 批量任务入队时已带有视频信息；网页请求的任务在这里获取
+        video_id = job['video_id']
+        meta = job['meta']
+        if meta is None:
+            try:
+                video = self.client.get_video_info(video_id, require_file_url=True)
+            except Exception as e:
+                error_class = classify_error(e)
+                logger.warning(f"获取视频 {video_id} 信息失败 ({error_class}): {e}", extra={'video_id': video_id, 'stage': 'job', 'job_id': job['id']})
+                if error_class in JOB_RETRY.retryable:
+                    self.job_queue.retry(job['id'], JOB_RETRY.delay(job['attempts'] - 1, e), error=f"{error_class}: {e}")
+                else:
+                    self.job_queue.finish(job['id'], 'failed', error=f"{error_class}: {e}") # 视频已删除等，重试无用
+                self._slots.release()
+                return
+            meta = {'video_meta': list(extract_video_meta(video)), 'size': video_expected_size(video)}
+        failed_queue = queue.Queue()
+        try:
+            schedule_download(self.scheduler, self.client, video_id, failed_queue, self.log_lock, tuple(meta['video_meta']),
+                              priority=(job['priority'], job['id']), size=meta.get('size') or DEFAULT_VIDEO_SIZE,
+                              on_done=lambda result: self._finish_job(job, failed_queue, result), attempt=job['attempts'] - 1)
+        except Exception as e:
+            # 没有提交到调度器 (调度器已关闭、任务元数据损坏等)，on_done 不会被调用，在这里释放名额
+            logger.error(f"提交视频 {video_id} 的下载失败: {e}", extra={'video_id': video_id, 'stage': 'job', 'job_id': job['id']})
+            try:
+                self.job_queue.retry(job['id'], JOB_RETRY.delay(job['attempts'] - 1, e), error=f"提交下载失败: {e}")
+            finally:
+                self._slots.release()
+
+    def _finish_job(self, job, failed_queue, result=None):
+        video_id = job['video_id']
+        try:
+            if get_completed_index().is_completed(video_id):
+                self.job_queue.finish(job['id'], 'done')
+                logger.info(f"任务 {job['id']} 完成: 视频 {video_id}", extra={'video_id': video_id, 'stage': 'job', 'job_id': job['id']})
+            elif not failed_queue.empty():
+                # 重试次数上限由任务的 max_attempts 控制
+                _, retry_time, error = failed_queue.get()
+                requeued = self.job_queue.retry(job['id'], max(0, retry_time - time.time()), error=error)
+                logger.warning(f"任务 {job['id']} {'稍后重试' if requeued else '重试次数用完，失败'}: 视频 {video_id}", extra={'video_id': video_id, 'stage': 'job', 'job_id': job['id']})
+            elif result == DOWNLOAD_ATTACHED or get_inflight_registry().is_active(video_id):
+                # 附加到其他任务正在进行的下载，稍后再检查结果 (那次下载失败时由本任务重新下载)
+                self.job_queue.retry(job['id'], JOB_RETRY_DELAY, error='已附加到正在进行的下载', count_attempt=False)
+                logger.info(f"任务 {job['id']} 已附加到正在进行的下载: 视频 {video_id}，{JOB_RETRY_DELAY} 秒后检查结果",
+                            extra={'video_id': video_id, 'stage': 'job', 'job_id': job['id']})
+            else:
+                self.job_queue.finish(job['id'], 'failed', error='下载失败，详见日志')
+                logger.warning(f"任务 {job['id']} 失败: 视频 {video_id}", extra={'video_id': video_id, 'stage': 'job', 'job_id': job['id']})
+        finally:
+            self._slots.release()
+            self._wakeup.set()
+
+if __name__ == '__main__':
+    setup_logging()
+    data = json_read()
+    if data is None:
+        logger.error("配置文件读取失败，程序中止")
+        exit(1)
+    runner = JobRunner(ApiClient(email=data['email'], password=data['password']))
+    runner.start()
+    logger.info("任务执行器已启动，按 Ctrl+C 停止")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        logger.info("正在停止，等待已开始的任务完成...")
+        runner.stop()
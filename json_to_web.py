@@ -1,20 +1,64 @@
 # server.py
-import os
-import queue
 import subprocess
 import threading
 
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, send_file
 import json
 from flask_cors import CORS
-from app import LOG_FILE  # 导入ApiClient和目录常量
-from api_client import ApiClient
-from app import json_read,download_worker
-from threading import Thread
+from api_client import ApiClient, get_partial_index, get_rate_limiter, get_storage_layout, get_thumbnail_store
+from app import json_read,get_ledger,get_completed_index,get_inflight_registry,get_job_queue
+from job_queue import JOB_STATES, JOB_PRIORITY_WEB
+from job_runner import JobRunner, describe_job
+from scheduler import BandwidthLimiter, MAX_BANDWIDTH, BANDWIDTH_PROFILES, BANDWIDTH_FILE
+from archive_query import ArchiveQueryIndex, QueryError
+from search_index import SearchIndex
+from analytics import ArchiveStats, StatsError, STATS_DEFAULT_TOP, STATS_DEFAULT_DAYS, default_snapshot_path, np
+from metrics import REGISTRY, DOWNLOAD_TRACKER
+from retry_policy import BREAKERS
+from thumbnails import PREVIEW_SIZES
+from log_config import get_logger, setup_logging, set_level, get_levels, dropped_records
+import hashlib
 import socket
 app = Flask(__name__)
+logger = get_logger(__name__)
 CORS(app)
 
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """
+    获取共享的 ApiClient (首次调用时读取 config.json)。
+    登录按需进行：保存的 token 有效时直接使用，到期前自动刷新，401 时重新登录。
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            data = json_read()
+            client = ApiClient(email=data['email'], password=data['password'])
+            client.login()
+            _client = client
+        return _client
+
+# 是否在 web 进程内运行任务执行器；单独运行 job_runner.py 时设为 False
+EMBEDDED_JOB_RUNNER = True
+_job_runner = None
+
+def get_job_runner():
+    """
+    获取 (并启动) 进程内的任务执行器，按需下载与批量任务共用它的调度器和并发限制。
+    EMBEDDED_JOB_RUNNER 为 False 时返回 None，任务由独立的 job_runner.py 进程执行。
+    """
+    global _job_runner
+    if not EMBEDDED_JOB_RUNNER:
+        return None
+    client = get_client()
+    with _client_lock:
+        if _job_runner is None:
+            _job_runner = JobRunner(client)
+            _job_runner.start()
+        return _job_runner
+
 @app.route('/updateVideo')
 def update_video():
     subprocess.run(['./app.sh'])
@@ -23,49 +67,106 @@ def update_video():
 @app.route('/downloadVideoById', methods=['GET'])
 def download_video_by_id():
     id = request.args.get('id')
-    global client
-    result = ""
-    data = ""
-    data = json_read()
-    print(data)
-    # 登录
-    email = data['email']
-    password = data['password']
+    if not id:
+        return jsonify({"error": "缺少参数 id"}), 400
+    # 已下载完成的视频直接返回，不登录也不请求 API
+    if get_completed_index().is_completed(id):
+        return f"视频 {id} 已下载完成"
+    # 正在下载 (批量任务或之前的请求) 时返回当前进度，不重复下载
+    progress = get_inflight_registry().progress(id)
+    if progress is not None:
+        return jsonify(progress)
+    # 加入持久化任务队列，由任务执行器按统一的并发限制下载；进程重启后任务不会丢失
+    job = get_job_queue().enqueue(id, priority=JOB_PRIORITY_WEB, source='web')
     try:
-        client = ApiClient(email=email, password=password)
-        client.login()  # 登录，如果失败会抛出 ConnectionError
+        runner = get_job_runner()
     except ConnectionError as e:
-        result = f"无法继续下载，登录失败: {e}"
+        return jsonify({"error": f"登录失败，任务已加入队列，稍后执行: {e}", "job": describe_job(job)}), 503
+    if runner is not None:
+        runner.notify()
+    return jsonify(describe_job(job))
+
+@app.route('/jobs')
+def list_jobs():
+    """
+    任务列表: /jobs?state=queued&limit=50&offset=0
+    """
+    state = request.args.get('state')
+    if state is not None and state not in JOB_STATES:
+        return jsonify({"error": f"未知的任务状态: {state}"}), 400
+    try:
+        limit = min(500, int(request.args.get('limit', 50)))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "limit / offset 必须是整数"}), 400
+    job_queue = get_job_queue()
+    return jsonify({"counts": job_queue.counts(),
+                    "jobs": [describe_job(job) for job in job_queue.list_jobs(state, limit, offset)]})
 
+@app.route('/jobs/<int:job_id>')
+def get_job(job_id):
+    """
+    单个任务的状态与下载进度
+    """
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({"error": f"任务 {job_id} 不存在"}), 404
+    return jsonify(describe_job(job))
 
+@app.route('/metrics')
+def metrics():
+    """
+    Prometheus 指标 (本进程: API 耗时、重试次数、账本写入耗时、下载字节数与速率)
+    """
+    return app.response_class(REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/progress')
+def progress():
+    """
+    下载进度: 本进程正在进行的下载 (字节数、速率、预计剩余时间)、最近结束的下载、任务队列状态、熔断中的主机、请求限速状态、未完成下载
+    和各存储根目录的可用空间与下载预留
+    """
+    snapshot = DOWNLOAD_TRACKER.snapshot()
+    snapshot['jobs'] = get_job_queue().counts()
+    snapshot['circuit_breakers'] = BREAKERS.snapshot()
+    snapshot['rate_limits'] = get_rate_limiter().snapshot()
+    snapshot['partials'] = get_partial_index().snapshot()
+    snapshot['storage'] = get_storage_layout().snapshot()
+    return jsonify(snapshot)
+
+@app.route('/logLevel')
+def log_level():
+    """
+    查看或调整日志级别: /logLevel?level=DEBUG&logger=api_client (不带 logger 时调整全部)
+    """
+    level = request.args.get('level')
+    if level:
+        try:
+            set_level(level, request.args.get('logger'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    return jsonify({"levels": get_levels(), "dropped": dropped_records()})
+
+@app.route('/bandwidth')
+def bandwidth():
+    """
+    查看或调整带宽上限，写入 bandwidth.json，批量任务进程几秒内同步，正在进行的下载不会中断:
+    /bandwidth?limit=2M (none 表示不限速)
+    /bandwidth?profiles=[["08:00","01:00","2M"]] (按时段的上限，[] 表示清除)
+    """
+    limiter = _job_runner.scheduler.bandwidth if _job_runner is not None else \
+        BandwidthLimiter(MAX_BANDWIDTH, profiles=BANDWIDTH_PROFILES, config_file=BANDWIDTH_FILE)
+    changes = {}
     try:
-        # 获取视频数据并下载
-        data = client.get_video(id)
-        # 安全获取 results
-        video = data.text
-        video = json.loads(video)
-        video_id = video.get('id')
-
-        log_lock = threading.Lock()  # 创建日志文件锁
-        failed_queue = queue.Queue()
-
-        avatar_name = video.get('user')['name']
-        video_title = video.get('title')
-        video_numComments = video.get('numComments')
-        video_numLikes = video.get('numLikes')
-        video_numViews = video.get('numViews')
-        video_tagList = [tag['id'] for tag in video.get('tags')]
-        video_createTime = video.get('createdAt')
-
-        t = Thread(target=download_worker,
-                   args=(client, id, failed_queue, log_lock, avatar_name, video_title, video_numComments,
-                         video_numLikes, video_numViews, video_tagList, video_createTime))
-        t.start()
-
-    except Exception as e:
-        result = e
-
-    return result
+        if 'limit' in request.args:
+            changes['rate'] = request.args['limit']
+        if 'profiles' in request.args:
+            changes['profiles'] = json.loads(request.args['profiles'])
+        if changes:
+            limiter.set_limits(**changes)
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": f"无效的带宽配置: {e}"}), 400
+    return jsonify(limiter.status())
 
 def ipconfig():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -77,11 +178,138 @@ def get_ip():
     return jsonify({"id": ipconfig() })
 
 
+_query_index = None
+_query_index_lock = threading.Lock()
+
+def get_query_index():
+    global _query_index
+    with _query_index_lock:
+        if _query_index is None:
+            _query_index = ArchiveQueryIndex(get_ledger())
+        return _query_index
+
+_search_index = None
+_archive_stats = None
+
+def get_search_index():
+    global _search_index
+    with _query_index_lock:
+        if _search_index is None:
+            _search_index = SearchIndex(get_ledger())
+        return _search_index
+
+def get_archive_stats():
+    global _archive_stats
+    with _query_index_lock:
+        if _archive_stats is None:
+            _archive_stats = ArchiveStats(get_ledger(), default_snapshot_path(get_ledger()))
+        return _archive_stats
+
+# 缩略图响应的浏览器缓存时间 (秒)
+THUMBNAIL_MAX_AGE = 7 * 24 * 3600
+
+@app.route('/thumbnail/<video_id>')
+def thumbnail(video_id):
+    """
+    视频缩略图: /thumbnail/<id>?size=small&frame=3
+    size 为 small / medium / large (预览图) 或 original (原图)，默认 small；frame 为预览帧序号，不带时为封面。
+    列表页应使用 small，避免加载原图。
+    """
+    size = request.args.get('size', 'small')
+    if size != 'original' and size not in PREVIEW_SIZES:
+        return jsonify({"error": f"size 必须是 original 或 {', '.join(PREVIEW_SIZES)}"}), 400
+    frame = request.args.get('frame')
+    if frame is not None and not frame.isdigit():
+        return jsonify({"error": "frame 必须是非负整数"}), 400
+    path = get_thumbnail_store().preview_path(video_id, size, int(frame) if frame is not None else None)
+    if path is None:
+        return jsonify({"error": f"视频 {video_id} 没有缩略图"}), 404
+    return send_file(path, max_age=THUMBNAIL_MAX_AGE)
+
 @app.route('/ecchiData')
 def get_data():
-    with open(LOG_FILE, encoding='utf-8') as f:
-        data = json.load(f)
-    return jsonify(data)
+    """
+    查询下载记录
+    不带参数时返回与旧 download_log.json 相同的格式 (全部记录)；
+    带参数时分页返回，参数见 ArchiveQueryIndex.query，例如
+    /ecchiData?page=1&page_size=50&author=xxx&tag=yyy&success=true&sort=video_numLikes&order=desc
+    响应带 ETag，账本未变化时 If-None-Match 返回 304。
+    """
+    index = get_query_index()
+    version = index.refresh()
+    args = sorted(request.args.items(multi=True))
+    etag = hashlib.sha1(f"{version}|{args}".encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    if not args:
+        response = jsonify(get_ledger().export_dict())
+    else:
+        try:
+            response = jsonify(index.query(request.args))
+        except QueryError as e:
+            return jsonify({"error": str(e)}), 400
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache' # 允许缓存，但每次都需要用 ETag 验证
+    return response
+
+@app.route('/search')
+def search():
+    """
+    搜索下载记录，参数见 SearchIndex.search，例如
+    /search?q=初音ミク&tags=mmd AND NOT vtuber&min_likes=100&created_from=2024-01-01&page=1
+    响应带 ETag，账本未变化时 If-None-Match 返回 304。
+    """
+    index = get_search_index()
+    version = index.refresh()
+    args = sorted(request.args.items(multi=True))
+    etag = hashlib.sha1(f"search|{version}|{args}".encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    try:
+        response = jsonify(index.search(request.args))
+    except QueryError as e:
+        return jsonify({"error": str(e)}), 400
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/stats')
+@app.route('/stats/<report>')
+def stats(report=None):
+    """
+    下载记录统计: /stats 列出全部报表，/stats/<报表>?top=20&days=30 返回报表 (见 analytics.ArchiveStats.REPORTS)
+    结果按账本版本缓存，响应带 ETag。
+    """
+    if report is None:
+        return jsonify({"reports": ArchiveStats.REPORTS})
+    if np is None:
+        return jsonify({"error": "统计需要安装 numpy"}), 503
+    top = request.args.get('top', str(STATS_DEFAULT_TOP))
+    days = request.args.get('days', str(STATS_DEFAULT_DAYS))
+    if not top.isdigit() or not days.isdigit():
+        return jsonify({"error": "top 和 days 必须是正整数"}), 400
+    try:
+        result = get_archive_stats().report(report, top=int(top), days=int(days))
+    except StatsError as e:
+        return jsonify({"error": str(e)}), 400
+    etag = hashlib.sha1(f"stats|{result['version']}|{report}|{top}|{days}".encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(result)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 if __name__ == '__main__':
+    setup_logging()
+    try:
+        get_job_runner()  # 启动时即开始执行队列中遗留的任务
+    except ConnectionError as e:
+        logger.warning(f"登录失败，任务执行器将在下次请求时启动: {e}")
     app.run(host='0.0.0.0', port=5000)  # 不建议用3306端口
\ No newline at end of file
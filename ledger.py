@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+'''
+下载账本：使用 SQLite (WAL 模式) 记录每个视频的下载信息，取代每次全量重写的 download_log.json。
+
+- 每次记录只是一条按主键的 upsert，耗时与账本大小无关
+- 按 video_id 建立主键索引，查询无需加载整个账本
+- WAL + 事务保证进程崩溃时账本不会损坏
+- 首次打开时自动从旧的 download_log.json 迁移
+'''
+import os
+import json
+import sqlite3
+import threading
+
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+LEDGER_FILE_NAME = 'download_log.db'
+LEGACY_LOG_FILE_NAME = 'download_log.json'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS videos (
+    video_id TEXT PRIMARY KEY,
+    local_id INTEGER NOT NULL,
+    success INTEGER NOT NULL DEFAULT 0,
+    last_update_timestamp REAL,
+    entry TEXT NOT NULL,
+    revision INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_videos_local_id ON videos(local_id);
+CREATE INDEX IF NOT EXISTS idx_videos_success ON videos(success);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+class DownloadLedger:
+    '''
+    线程安全的下载账本。
+    条目格式与旧 download_log.json 中的条目相同 (video_id, avatar_name, ..., success, local_id)。
+    '''
+    def __init__(self, path, legacy_json_path=None):
+        '''
+        :param path: SQLite 数据库文件路径
+        :param legacy_json_path: 旧 JSON 日志路径，账本为空时从该文件迁移
+        '''
+        self.path = path
+        self._lock = threading.RLock()
+        self._writes = 0 # 本进程的写入次数，用于 version()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL') # WAL 模式下 NORMAL 即可保证崩溃后一致
+        self._conn.execute('PRAGMA busy_timeout=30000') # 与其他进程 (web 服务) 并发写入时等待
+        self._conn.executescript(SCHEMA)
+        self._ensure_revision_column()
+        if legacy_json_path:
+            self.migrate_from_json(legacy_json_path)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _ensure_revision_column(self):
+        '''
+        旧版本的账本没有 revision 列 (每次写入递增的修订号，用于增量同步)，补上
+        '''
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(videos)')]
+        if 'revision' not in columns:
+            self._conn.execute('ALTER TABLE videos ADD COLUMN revision INTEGER NOT NULL DEFAULT 0')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_videos_revision ON videos(revision)')
+
+    def _next_revision(self) -> int:
+        # 需在写事务中调用
+        revision = int(self._get_meta('revision', 0)) + 1
+        self._set_meta('revision', revision)
+        return revision
+
+    def _get_meta(self, key, default=None):
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self._conn.execute('INSERT INTO meta(key, value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                           (key, str(value)))
+
+    def migrate_from_json(self, json_path) -> int:
+        '''
+        一次性从旧 download_log.json 导入所有条目 (已迁移过则跳过)
+        :param json_path: 旧 JSON 日志路径
+        :return: 导入的条目数
+        '''
+        with self._lock:
+            if self._get_meta('migrated_from_json') or not os.path.exists(json_path):
+                return 0
+            try:
+                with open(json_path, 'r', encoding='utf-8') as f:
+                    log_data = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"旧日志 {json_path} 无法读取，跳过迁移: {e}")
+                return 0
+
+            total_number = (log_data.get('total') or {}).get('number', 0)
+            rows = []
+            for video_id, entry in log_data.items():
+                if video_id == 'total' or not isinstance(entry, dict):
+                    continue
+                local_id = entry.get('local_id') or 0
+                total_number = max(total_number, local_id)
+                rows.append((video_id, local_id, 1 if entry.get('success') else 0,
+                             entry.get('last_update_timestamp'), json.dumps(entry, ensure_ascii=False)))
+
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany('INSERT OR IGNORE INTO videos(video_id, local_id, success, last_update_timestamp, entry) '
+                                       'VALUES(?, ?, ?, ?, ?)', rows)
+                self._set_meta('total_number', max(total_number, int(self._get_meta('total_number', 0))))
+                self._set_meta('migrated_from_json', json_path)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            logger.info(f"已从 {json_path} 迁移 {len(rows)} 条下载记录")
+            return len(rows)
+
+    def record(self, entry) -> int | None:
+        '''
+        记录一条下载信息。
+        已存在且成功的条目不会被覆盖；新条目分配新的本地序列号，已有条目沿用原序列号。
+        :param entry: 日志条目 dict (不需要包含 local_id)
+        :return: 条目的 local_id；视频已下载完成时返回 None
+        '''
+        video_id = entry['video_id']
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT local_id, success FROM videos WHERE video_id = ?', (video_id,)).fetchone()
+                if row is not None and row[1]:
+                    self._conn.execute('COMMIT')
+                    return None
+                if row is None:
+                    local_id = int(self._get_meta('total_number', 0)) + 1
+                    self._set_meta('total_number', local_id)
+                else:
+                    local_id = row[0]
+                entry = dict(entry, local_id=local_id)
+                self._conn.execute(
+                    'INSERT INTO videos(video_id, local_id, success, last_update_timestamp, entry, revision) VALUES(?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT(video_id) DO UPDATE SET success = excluded.success, '
+                    'last_update_timestamp = excluded.last_update_timestamp, entry = excluded.entry, revision = excluded.revision',
+                    (video_id, local_id, 1 if entry.get('success') else 0, entry.get('last_update_timestamp'),
+                     json.dumps(entry, ensure_ascii=False), self._next_revision()))
+                self._conn.execute('COMMIT')
+                self._writes += 1
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            return local_id
+
+    def update_entry(self, video_id, **fields) -> bool:
+        '''
+        修改已有条目的字段 (不改变 success 与 local_id)
+        :return: 条目存在时返回 True
+        '''
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT entry FROM videos WHERE video_id = ?', (video_id,)).fetchone()
+                if row is None:
+                    self._conn.execute('COMMIT')
+                    return False
+                entry = dict(json.loads(row[0]), **fields)
+                self._conn.execute('UPDATE videos SET entry = ?, revision = ? WHERE video_id = ?',
+                                   (json.dumps(entry, ensure_ascii=False), self._next_revision(), video_id))
+                self._conn.execute('COMMIT')
+                self._writes += 1
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            return True
+
+    def version(self) -> str:
+        '''
+        账本版本标识：数据库与 WAL 文件的修改时间/大小 + 本进程写入次数。
+        任何进程写入后都会变化，可用于缓存失效和 ETag。
+        '''
+        parts = [str(self._writes)]
+        for path in (self.path, self.path + '-wal'):
+            try:
+                st = os.stat(path)
+                parts.append(f"{st.st_mtime_ns}-{st.st_size}")
+            except FileNotFoundError:
+                parts.append('0')
+        return '.'.join(parts)
+
+    def get(self, video_id) -> dict | None:
+        '''
+        按 video_id 查询条目
+        '''
+        with self._lock:
+            row = self._conn.execute('SELECT entry FROM videos WHERE video_id = ?', (video_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def is_success(self, video_id) -> bool:
+        with self._lock:
+            row = self._conn.execute('SELECT success FROM videos WHERE video_id = ?', (video_id,)).fetchone()
+        return bool(row and row[0])
+
+    def iter_success(self):
+        '''
+        遍历所有下载成功的条目
+        :return: (video_id, video_path, video_size_mb) 迭代器
+        '''
+        with self._lock:
+            rows = self._conn.execute('SELECT video_id, entry FROM videos WHERE success = 1').fetchall()
+        for video_id, entry in rows:
+            entry = json.loads(entry)
+            yield video_id, entry.get('video_path'), entry.get('video_size_mb') or 0.0
+
+    def total_number(self) -> int:
+        with self._lock:
+            return int(self._get_meta('total_number', 0))
+
+    def iter_entries(self):
+        '''
+        按本地序列号顺序遍历所有条目
+        '''
+        with self._lock:
+            rows = self._conn.execute('SELECT entry FROM videos ORDER BY local_id').fetchall()
+        for row in rows:
+            yield json.loads(row[0])
+
+    def revision(self) -> int:
+        '''
+        最新的修订号 (每次写入递增)
+        '''
+        with self._lock:
+            return int(self._get_meta('revision', 0))
+
+    def iter_changes(self, since=None):
+        '''
+        按修订号顺序遍历 since 之后写入的条目 (增量同步)
+        :param since: 上次同步到的修订号，None 表示全部条目 (包括从旧 JSON 迁移、修订号为 0 的条目)
+        :return: (revision, entry) 迭代器
+        '''
+        with self._lock:
+            rows = self._conn.execute('SELECT revision, entry FROM videos WHERE revision > ? ORDER BY revision',
+                                      (-1 if since is None else since,)).fetchall()
+        for revision, entry in rows:
+            yield revision, json.loads(entry)
+
+    def select_fields(self, fields, since=None, until=None) -> list:
+        '''
+        按列读取条目字段，JSON 在 SQLite 中解析，不创建条目 dict (用于统计)
+        :param fields: {字段名: 缺失时的默认值}
+        :param since: 只读取修订号大于 since 的条目，None 表示全部
+        :param until: 只读取修订号不大于 until 的条目
+        :return: [(revision, local_id, success, 字段值...)]
+        '''
+        columns = ', '.join(f"COALESCE(json_extract(entry, '$.{name}'), ?)" for name in fields)
+        with self._lock:
+            return self._conn.execute(
+                f'SELECT revision, local_id, success, {columns} FROM videos WHERE revision > ? AND revision <= ?',
+                (*fields.values(), -1 if since is None else since, until if until is not None else 2 ** 62)).fetchall()
+
+    def select_list_items(self, field, since=None, until=None) -> list:
+        '''
+        展开列表字段 (如 video_tagList)，范围参数同 select_fields
+        :return: [(local_id, 元素)]
+        '''
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT v.local_id, t.value FROM videos v, json_each(v.entry, '$.{field}') t WHERE v.revision > ? AND v.revision <= ?",
+                (-1 if since is None else since, until if until is not None else 2 ** 62)).fetchall()
+
+    def export_dict(self) -> dict:
+        '''
+        导出为旧 download_log.json 的格式: {"total": {"number": N}, video_id: entry, ...}
+        '''
+        data = {'total': {'number': self.total_number()}}
+        for entry in self.iter_entries():
+            data[entry['video_id']] = entry
+        return data
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+'''
+日志配置：JSON 结构化日志 (带 video_id / stage 字段)，经由队列异步写出，工作线程不会阻塞在控制台或磁盘上。
+
+- 各模块使用 get_logger(__name__)，与视频相关的日志通过 extra={'video_id': ..., 'stage': ...} 附带字段
+- 文件按大小 (或按时间) 轮转，控制台输出简短的文本格式
+- set_level() 可在运行时调整级别 (web 服务提供 /logLevel 接口)
+- 入口脚本 (app.py / json_to_web.py / job_runner.py / async_client.py) 启动时调用 setup_logging()
+'''
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+LOGGER_NAME = 'iwara'
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+LOG_FILE_NAME = 'iwara.log'
+LOG_LEVEL = os.environ.get('IWARA_LOG_LEVEL', 'INFO') # 日志级别，可通过环境变量覆盖
+LOG_MAX_BYTES = 10 * 1024 * 1024 # 单个日志文件大小上限
+LOG_BACKUP_COUNT = 5 # 保留的轮转文件数
+LOG_ROTATE_WHEN = None # 按时间轮转，例如 'midnight'；为 None 时按大小轮转
+# 日志队列长度上限，写出跟不上时丢弃新日志而不是阻塞工作线程
+LOG_QUEUE_SIZE = 10000
+
+# 结构化字段：通过 extra 传入时写入 JSON 记录
+CONTEXT_FIELDS = ('video_id', 'stage', 'job_id', 'attempt', 'bytes', 'total', 'elapsed', 'url', 'status')
+
+_setup_lock = threading.Lock()
+_listener = None
+
+class JsonFormatter(logging.Formatter):
+    '''
+    每条日志一行 JSON
+    '''
+    def format(self, record):
+        data = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class ConsoleFormatter(logging.Formatter):
+    '''
+    控制台的简短文本格式: 时间 级别 [阶段 视频ID] 消息
+    '''
+    def format(self, record):
+        context = ' '.join(str(getattr(record, field)) for field in ('stage', 'video_id') if getattr(record, field, None))
+        line = f"{time.strftime('%H:%M:%S', time.localtime(record.created))} {record.levelname[0]} {'[' + context + '] ' if context else ''}{record.getMessage()}"
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+class _DroppingQueueHandler(QueueHandler):
+    '''
+    队列满时丢弃日志并计数，保证调用线程不会阻塞
+    '''
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+def get_logger(name) -> logging.Logger:
+    '''
+    获取模块日志器 (iwara.<模块名>)
+    '''
+    return logging.getLogger(f"{LOGGER_NAME}.{name.rsplit('.', 1)[-1]}")
+
+def video_logger(logger, video_id, stage) -> logging.LoggerAdapter:
+    '''
+    为一个视频的某个阶段创建日志适配器，记录自动带上 video_id 和 stage 字段
+    '''
+    return logging.LoggerAdapter(logger, {'video_id': video_id, 'stage': stage})
+
+def setup_logging(level=LOG_LEVEL, log_dir=LOG_DIR, console_level=None, rotate_when=LOG_ROTATE_WHEN,
+                  max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+    '''
+    配置日志 (重复调用无效)
+    :param level: 日志级别
+    :param log_dir: 日志目录，None 表示不写文件
+    :param console_level: 控制台级别；默认在终端中与 level 相同，输出被重定向 (nohup、cron) 时只输出 WARNING 以上
+    :param rotate_when: 按时间轮转的周期 (TimedRotatingFileHandler 的 when)，None 表示按大小轮转
+    :param max_bytes: 按大小轮转时单个文件的上限
+    :param backup_count: 保留的轮转文件数
+    '''
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        handlers = []
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(ConsoleFormatter())
+        if console_level is None:
+            console_level = level if sys.stdout.isatty() else logging.WARNING
+        console.setLevel(console_level)
+        handlers.append(console)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+            path = os.path.join(log_dir, LOG_FILE_NAME)
+            if rotate_when:
+                file_handler = TimedRotatingFileHandler(path, when=rotate_when, backupCount=backup_count, encoding='utf-8')
+            else:
+                file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+            file_handler.setFormatter(JsonFormatter())
+            handlers.append(file_handler)
+
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        root = logging.getLogger(LOGGER_NAME)
+        root.setLevel(level)
+        root.addHandler(_DroppingQueueHandler(log_queue))
+        root.propagate = False
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+def shutdown_logging():
+    '''
+    写出队列中剩余的日志并停止后台线程
+    '''
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+def set_level(level, name=None) -> str:
+    '''
+    运行时调整日志级别
+    :param level: 级别名 (DEBUG, INFO, WARNING, ERROR) 或数值
+    :param name: 模块名 (例如 api_client)，None 表示全部
+    :return: 调整后的级别名
+    '''
+    if isinstance(level, str):
+        level = level.upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f"未知的日志级别: {level}")
+    logger = logging.getLogger(LOGGER_NAME if name is None else f"{LOGGER_NAME}.{name}")
+    logger.setLevel(level)
+    return logging.getLevelName(logger.getEffectiveLevel())
+
+def get_levels() -> dict:
+    '''
+    当前各日志器的级别
+    '''
+    levels = {LOGGER_NAME: logging.getLevelName(logging.getLogger(LOGGER_NAME).getEffectiveLevel())}
+    for name, logger in logging.Logger.manager.loggerDict.items():
+        if name.startswith(LOGGER_NAME + '.') and isinstance(logger, logging.Logger):
+            levels[name] = logging.getLevelName(logger.getEffectiveLevel())
+    return levels
+
+def dropped_records() -> int:
+    '''
+    因队列满而丢弃的日志条数
+    '''
+    return _DroppingQueueHandler.dropped
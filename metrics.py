@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+'''
+运行指标：计数器、仪表、直方图 (Prometheus 文本格式输出) 以及每个下载的实时进度。
+指标只在本进程内统计，由 json_to_web.py 的 /metrics 与 /progress 接口输出。
+'''
+import math
+import time
+import threading
+import urllib.parse
+from contextlib import contextmanager
+
+# API 请求耗时直方图的桶 (秒)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# 账本写入耗时直方图的桶 (秒)
+LEDGER_WRITE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+# 下载速率的平滑系数 (指数加权平均，越大越接近瞬时速率)
+RATE_SMOOTHING = 0.3
+# 下载结束后在 /progress 中保留的条数
+RECENT_DOWNLOADS = 20
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labelnames, values, extra=()) -> str:
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 的标签应为 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+class Counter(_Metric):
+    '''
+    只增不减的计数器
+    '''
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    '''
+    可增可减的数值；指定 func 时每次输出时调用 func() 取值 (无标签)
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), func=None):
+        super().__init__(name, help_text, labelnames)
+        self.func = func
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self) -> list:
+        if self.func is not None:
+            return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", f"{self.name} {_format_value(self.func())}"]
+        return super().render()
+
+class Histogram(_Metric):
+    '''
+    直方图 (累计桶 + 总和 + 次数)
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+        统计代码块耗时: with HISTOGRAM.time(label=...): ...
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        '''
+        Prometheus 文本格式
+        '''
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+class DownloadProgress:
+    '''
+    一个视频下载的进度 (速率为指数加权平均)
+    '''
+    def __init__(self, tracker, video_id):
+        self.tracker = tracker
+        self.video_id = video_id
+        self.started_at = time.time()
+        self.downloaded = 0
+        self.total = None
+        self.rate = 0.0
+        self.finished_at = None
+        self.success = None
+        self._last_sample = None # (monotonic 时间, 已下载字节数)
+
+    def update(self, downloaded, total=None):
+        '''
+        更新进度 (与 progress_callback 的参数相同)
+        '''
+        now = time.monotonic()
+        with self.tracker._lock:
+            if self._last_sample is not None:
+                last_time, last_bytes = self._last_sample
+                elapsed = now - last_time
+                if elapsed >= 0.5:
+                    instant = max(0, downloaded - last_bytes) / elapsed
+                    self.rate = instant if not self.rate else RATE_SMOOTHING * instant + (1 - RATE_SMOOTHING) * self.rate
+                    self._last_sample = (now, downloaded)
+            else:
+                self._last_sample = (now, downloaded) # 续传时第一次回调包含已有的字节数，不计入速率
+            self.downloaded = downloaded
+            if total is not None:
+                self.total = total
+
+    def finish(self, success):
+        self.tracker._finish(self, success)
+
+    def to_dict(self) -> dict:
+        eta = None
+        if self.total and self.rate > 0 and self.finished_at is None:
+            eta = max(0.0, (self.total - self.downloaded) / self.rate)
+        return {'video_id': self.video_id, 'downloaded': self.downloaded, 'total': self.total,
+                'percent': round(self.downloaded * 100 / self.total, 1) if self.total else None,
+                'rate': round(self.rate, 1), 'eta': round(eta, 1) if eta is not None else None,
+                'started_at': self.started_at, 'finished_at': self.finished_at, 'success': self.success}
+
+class DownloadTracker:
+    '''
+    本进程内正在进行的下载
+    '''
+    def __init__(self, recent=RECENT_DOWNLOADS):
+        self._lock = threading.Lock()
+        self._active = {}
+        self._recent = []
+        self.recent_size = recent
+
+    def start(self, video_id) -> DownloadProgress:
+        progress = DownloadProgress(self, video_id)
+        with self._lock:
+            self._active[video_id] = progress
+        return progress
+
+    def _finish(self, progress, success):
+        with self._lock:
+            progress.finished_at = time.time()
+            progress.success = success
+            if self._active.get(progress.video_id) is progress:
+                del self._active[progress.video_id]
+            self._recent.append(progress)
+            del self._recent[:-self.recent_size]
+        DOWNLOADS_FINISHED.inc(result='success' if success else 'failure')
+
+    def active_count(self) -> int:
+        with self._lock:
+            return len(self._active)
+
+    def total_rate(self) -> float:
+        with self._lock:
+            return sum(progress.rate for progress in self._active.values())
+
+    def snapshot(self) -> dict:
+        '''
+        /progress 接口的内容
+        '''
+        with self._lock:
+            active = [progress.to_dict() for progress in self._active.values()]
+            recent = [progress.to_dict() for progress in reversed(self._recent)]
+        return {'active': active, 'recent': recent, 'active_downloads': len(active),
+                'rate': round(sum(item['rate'] for item in active), 1),
+                'downloaded_bytes_total': DOWNLOADED_BYTES.value()}
+
+def classify_endpoint(request) -> str:
+    '''
+    按请求 URL 归类 API 端点，用于耗时统计
+    '''
+    return endpoint_of(request.url, request.headers)
+
+def endpoint_of(url, headers=None) -> str:
+    '''
+    按 URL (及请求头) 归类端点: videos, video, login, api, resources, thumbnails, files
+    '''
+    parsed = urllib.parse.urlsplit(url)
+    path = parsed.path
+    if parsed.hostname and parsed.hostname.startswith('api.'):
+        if path.startswith('/videos'):
+            return 'videos'
+        if path.startswith('/video/'):
+            return 'video'
+        if path.startswith('/user/login'):
+            return 'login'
+        return 'api'
+    if headers and 'X-Version' in headers:
+        return 'resources'
+    if path.startswith('/image/'):
+        return 'thumbnails'
+    return 'files'
+
+def record_response(response, *args, **kwargs):
+    '''
+    requests 的 response hook：记录响应耗时 (到收到响应头为止) 与状态码
+    '''
+    endpoint = classify_endpoint(response.request)
+    API_LATENCY.observe(response.elapsed.total_seconds(), endpoint=endpoint)
+    API_RESPONSES.inc(endpoint=endpoint, status=str(response.status_code))
+    return response
+
+def record_retry(stage, exc):
+    '''
+    记录一次重试
+    :param stage: 重试发生的阶段 (download, segment, job ...)
+    :param exc: 导致重试的异常 (或异常类名)
+    '''
+    RETRIES.inc(stage=stage, exception=exc if isinstance(exc, str) else type(exc).__name__)
+
+class _ByteCounter(Counter):
+    def value(self) -> int:
+        with self._lock:
+            return self._values.get((), 0)
+
+REGISTRY = Registry()
+API_LATENCY = REGISTRY.register(Histogram('iwara_api_request_seconds', 'Time until response headers, by endpoint', ('endpoint',)))
+API_RESPONSES = REGISTRY.register(Counter('iwara_api_responses_total', 'HTTP responses by endpoint and status', ('endpoint', 'status')))
+RETRIES = REGISTRY.register(Counter('iwara_retries_total', 'Retries by stage and exception class', ('stage', 'exception')))
+LEDGER_WRITE_SECONDS = REGISTRY.register(Histogram('iwara_ledger_write_seconds', 'Download ledger write latency', buckets=LEDGER_WRITE_BUCKETS))
+DOWNLOADED_BYTES = REGISTRY.register(_ByteCounter('iwara_downloaded_bytes_total', 'Video bytes received'))
+DOWNLOADS_FINISHED = REGISTRY.register(Counter('iwara_downloads_finished_total', 'Finished video downloads by result', ('result',)))
+RATE_LIMIT_WAIT_SECONDS = REGISTRY.register(Counter('iwara_rate_limit_wait_seconds_total', 'Time spent waiting for the request rate limiter, by endpoint', ('endpoint',)))
+RATE_LIMITED = REGISTRY.register(Counter('iwara_rate_limited_total', 'Responses that asked us to slow down (429 / exhausted rate-limit headers), by endpoint', ('endpoint',)))
+CIRCUIT_OPEN = REGISTRY.register(Gauge('iwara_circuit_open', 'Whether the circuit breaker for a host is open (1) or closed (0)', ('host',)))
+DOWNLOAD_TRACKER = DownloadTracker()
+REGISTRY.register(Gauge('iwara_active_downloads', 'Video downloads in progress', func=DOWNLOAD_TRACKER.active_count))
+REGISTRY.register(Gauge('iwara_download_rate_bytes', 'Current aggregate download rate (bytes/s)', func=DOWNLOAD_TRACKER.total_rate))
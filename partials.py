@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+'''
+未完成下载登记。
+
+下载写入 hot 存储根目录中的 {视频文件名}.part (平铺，见 storage.py)，旁边的 {视频文件名}.part.json 记录
+最终路径、下载链接、总大小、ETag / Last-Modified、已完成块的摘要 (分段下载时还有分段状态)；
+下载完成后原子重命名为最终文件名，因此存储目录中没有 .part 后缀的视频文件一定是完整的。
+
+启动时扫描一次元数据文件建立索引，
+续传时按记录的大小直接判断是否已完成、用 If-Range 发起续传请求，不需要先探测服务器。
+超过 PARTIAL_MAX_AGE 没有进展的未完成下载由 sweep() 清理。
+'''
+import os
+import json
+import time
+import threading
+
+from log_config import get_logger
+from integrity import HASH_ALGORITHM
+
+logger = get_logger(__name__)
+
+PARTIAL_SUFFIX = '.part'
+PARTIAL_META_SUFFIX = '.part.json'
+# 超过该时间 (秒) 没有写入的未完成下载视为已放弃
+PARTIAL_MAX_AGE = 7 * 24 * 3600
+# 任务执行器清理未完成下载的间隔 (秒)
+PARTIAL_JANITOR_INTERVAL = 3600
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class PartialDownload:
+    '''
+    一个未完成的下载: .part 数据文件 + .part.json 元数据
+    '''
+    def __init__(self, video_file_name, meta=None, partial_dir=None):
+        '''
+        :param video_file_name: 完成后的视频文件路径
+        :param meta: 元数据，None 时从磁盘读取 (不存在则为空)
+        :param partial_dir: .part 文件所在目录，None 时与视频文件相同
+        '''
+        self.video_file_name = video_file_name
+        base = os.path.join(partial_dir or os.path.dirname(video_file_name), os.path.basename(video_file_name))
+        self.path = base + PARTIAL_SUFFIX
+        self.meta_path = base + PARTIAL_META_SUFFIX
+        self.meta = self._read_meta() if meta is None else meta
+
+    def _read_meta(self) -> dict:
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            return meta if isinstance(meta, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"未完成下载记录 {self.meta_path} 损坏，忽略: {e}")
+            return {}
+
+    @property
+    def video_id(self) -> str:
+        return os.path.basename(self.video_file_name).split('.', 1)[0]
+
+    @property
+    def size(self) -> int:
+        '''
+        .part 文件当前大小 (分段下载时为预分配后的总大小)
+        '''
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    @property
+    def total_size(self) -> int | None:
+        return self.meta.get('total_size')
+
+    @property
+    def block_digests(self) -> list | None:
+        '''
+        已完成块的摘要 (单连接下载)
+        '''
+        if self.meta.get('algorithm') != HASH_ALGORITHM:
+            return None
+        return self.meta.get('blocks')
+
+    @property
+    def updated(self) -> float:
+        '''
+        最后一次进展的时间 (元数据与数据文件修改时间中较新的)
+        '''
+        times = [self.meta.get('updated', 0)]
+        for path in (self.path, self.meta_path):
+            try:
+                times.append(os.path.getmtime(path))
+            except FileNotFoundError:
+                pass
+        return max(times)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def is_complete(self) -> bool:
+        '''
+        根据记录判断数据是否已全部写入 (不访问网络)
+        '''
+        total_size = self.total_size
+        if not total_size or not self.exists():
+            return False
+        segments = self.meta.get('segments')
+        if segments is not None:
+            return len(segments.get('done', [])) == -(-total_size // segments['segment_size'])
+        return self.size >= total_size
+
+    def if_range(self) -> str | None:
+        '''
+        续传请求的 If-Range 值：文件在服务器上变化时服务器返回完整内容而不是错误的片段
+        '''
+        etag = self.meta.get('etag')
+        if etag and not etag.startswith('W/'): # 弱 ETag 不能用于 If-Range
+            return etag
+        return self.meta.get('last_modified')
+
+    def record_response(self, url, headers, total_size):
+        '''
+        记录下载链接、总大小与服务器的校验信息
+        '''
+        self.meta['url'] = url
+        if total_size:
+            self.meta['total_size'] = total_size
+        for key, header in (('etag', 'ETag'), ('last_modified', 'Last-Modified')):
+            if headers.get(header):
+                self.meta[key] = headers[header]
+
+    def reset(self):
+        '''
+        从头下载：清空数据文件对应的状态 (数据文件由调用方以覆盖方式重新写入)
+        '''
+        self.meta = {'created': time.time()}
+
+    def save(self, **fields):
+        '''
+        更新并原子写入元数据
+        '''
+        self.meta.update(fields)
+        self.meta.setdefault('created', time.time())
+        self.meta['updated'] = time.time()
+        self.meta['target'] = self.video_file_name
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def save_blocks(self, block_digests):
+        self.save(algorithm=HASH_ALGORITHM, blocks=block_digests)
+
+    def commit(self) -> str:
+        '''
+        下载完成：原子重命名为最终文件名并删除元数据
+        :return: 视频文件路径
+        '''
+        os.makedirs(os.path.dirname(self.video_file_name), exist_ok=True)
+        os.replace(self.path, self.video_file_name)
+        _remove(self.meta_path)
+        return self.video_file_name
+
+    def discard(self):
+        _remove(self.path)
+        _remove(self.meta_path)
+        _remove(self.meta_path + '.tmp')
+
+    def restart(self):
+        '''
+        丢弃已下载的数据和记录，从头下载
+        '''
+        self.discard()
+        self.reset()
+
+    def to_dict(self) -> dict:
+        return {'video_id': self.video_id, 'path': self.path, 'size': self.size, 'total_size': self.total_size,
+                'segmented': 'segments' in self.meta, 'updated': self.updated}
+
+class PartialIndex:
+    '''
+    线程安全的未完成下载索引: video_id -> PartialDownload
+    '''
+    def __init__(self, download_dir):
+        self.download_dir = download_dir
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    @classmethod
+    def load(cls, download_dir, max_age=PARTIAL_MAX_AGE) -> 'PartialIndex':
+        '''
+        扫描下载目录建立索引，并清理过期的未完成下载
+        '''
+        index = cls(download_dir)
+        if not os.path.isdir(download_dir):
+            return index
+        with os.scandir(download_dir) as it:
+            names = [entry.name for entry in it if entry.is_file()]
+        for name in names:
+            if name.endswith(PARTIAL_META_SUFFIX):
+                partial = PartialDownload(os.path.join(download_dir, name[:-len(PARTIAL_META_SUFFIX)]))
+                target = partial.meta.get('target')
+                if target and os.path.basename(target) == name[:-len(PARTIAL_META_SUFFIX)]:
+                    # 最终文件在分片目录中
+                    partial = PartialDownload(target, meta=partial.meta, partial_dir=download_dir)
+                index._entries[partial.video_id] = partial
+        removed = index.sweep(max_age)
+        logger.info(f"未完成下载 {len(index)} 个" + (f"，清理过期的 {removed} 个" if removed else ""))
+        return index
+
+    def open(self, video_id, video_file_name) -> PartialDownload:
+        '''
+        获取 (或创建) 视频的未完成下载。文件类型变化 (例如 Source 不可用改用其他画质) 时丢弃旧的未完成下载
+        (只是最终路径变化时，例如 date 布局跨月续传，沿用已下载的数据)；
+        最终文件已存在但没有记录时 (旧版本写入或完成后未登记) 作为没有校验信息的未完成下载续传。
+        '''
+        partial = PartialDownload(video_file_name, partial_dir=self.download_dir)
+        with self._lock:
+            previous = self._entries.get(video_id)
+            self._entries[video_id] = partial
+        if previous is not None and previous.path != partial.path:
+            logger.info(f"视频 {video_id} 的文件类型已变化，丢弃未完成下载 {previous.path}", extra={'video_id': video_id})
+            previous.discard()
+        if not partial.exists() and os.path.exists(video_file_name):
+            os.replace(video_file_name, partial.path)
+            partial.reset()
+        return partial
+
+    def complete(self, partial) -> str:
+        '''
+        下载完成：重命名为最终文件并移出索引
+        :return: 视频文件路径
+        '''
+        path = partial.commit()
+        self._forget(partial)
+        return path
+
+    def discard(self, partial):
+        partial.discard()
+        self._forget(partial)
+
+    def _forget(self, partial):
+        with self._lock:
+            if self._entries.get(partial.video_id) is partial:
+                del self._entries[partial.video_id]
+
+    def get(self, video_id) -> PartialDownload | None:
+        with self._lock:
+            return self._entries.get(video_id)
+
+    def sweep(self, max_age=PARTIAL_MAX_AGE, is_active=None) -> int:
+        '''
+        删除超过 max_age 没有进展的未完成下载
+        :param is_active: is_active(video_id)，返回 True 的视频正在下载，不删除
+        :return: 删除的数量
+        '''
+        cutoff = time.time() - max_age
+        with self._lock:
+            candidates = list(self._entries.values())
+        removed = 0
+        for partial in candidates:
+            if partial.updated >= cutoff or (is_active is not None and is_active(partial.video_id)):
+                continue
+            logger.info(f"清理过期的未完成下载: {partial.path} ({partial.size} 字节)", extra={'video_id': partial.video_id})
+            self.discard(partial)
+            removed += 1
+        return removed
+
+    def snapshot(self) -> list:
+        with self._lock:
+            partials = list(self._entries.values())
+        return [partial.to_dict() for partial in partials]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
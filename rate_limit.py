@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+'''
+请求频率限制：按 (主机, 端点类型) 的令牌桶，所有 ApiClient 请求共享。
+
+- 每类端点 (videos / video / resources / thumbnails / files ...) 有各自的 QPS 和突发上限 (RATE_LIMITS)
+- 收到 429 或限流响应头 (X-RateLimit-Remaining: 0) 时暂停该桶并降低速率，之后成功的请求逐步恢复 (乘性减、加性增)
+- 桶的状态保存在共享文件中并用 flock 互斥，cron 批量任务与 web 服务两个进程共用同一份额度
+'''
+import os
+import json
+import time
+import fcntl
+import threading
+import urllib.parse
+from contextlib import contextmanager
+
+from log_config import get_logger
+from metrics import RATE_LIMIT_WAIT_SECONDS, RATE_LIMITED, endpoint_of
+from retry_policy import parse_retry_after
+
+logger = get_logger(__name__)
+
+# 各类端点的 (每秒请求数, 突发上限)；值为 None 表示不限制
+RATE_LIMITS = {
+    'videos': (2, 4), # 列表页
+    'video': (5, 10), # 视频信息
+    'login': (0.2, 2),
+    'api': (5, 10),
+    'resources': (3, 6), # 下载资源列表 (files.iwara.tv 带 X-Version 签名)
+    'thumbnails': (10, 20),
+    'files': (4, 8), # 视频文件请求 (分段下载每段一个请求)
+}
+# 收到 429 时速率乘以该系数，最低不低于配置值的 RATE_MIN_FRACTION
+RATE_DECREASE = 0.5
+RATE_MIN_FRACTION = 0.1
+# 被降速后每个成功请求恢复配置值的比例
+RATE_RECOVERY_STEP = 0.05
+# 429 未带 Retry-After 时暂停的秒数
+RATE_LIMIT_PENALTY = 10
+# 适配器内对 429 自动重发的次数 (仅 GET/HEAD)
+RATE_LIMIT_RETRIES = 3
+
+def _parse_reset(value) -> float | None:
+    '''
+    X-RateLimit-Reset: 秒数或 UNIX 时间戳
+    '''
+    try:
+        reset = float(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, reset - time.time()) if reset > 1e9 else reset
+
+class RateLimiter:
+    '''
+    线程安全、可跨进程共享的令牌桶限速器
+    '''
+    def __init__(self, limits=None, state_file=None):
+        '''
+        :param limits: 端点类型 -> (QPS, 突发上限)，默认 RATE_LIMITS；未列出的端点不限制
+        :param state_file: 共享状态文件，None 表示只在本进程内限速
+        '''
+        self.limits = dict(RATE_LIMITS if limits is None else limits)
+        self.state_file = state_file
+        self._lock = threading.Lock()
+        self._local_state = {}
+        self._fd = None
+        self._degraded = set() # 本进程看到已被降速的桶，成功响应时才需要写回恢复后的速率
+        if state_file:
+            try:
+                os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+                self._fd = os.open(state_file, os.O_RDWR | os.O_CREAT, 0o644)
+            except OSError as e:
+                logger.warning(f"无法打开限速状态文件 {state_file}，只在本进程内限速: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    @contextmanager
+    def _state(self):
+        '''
+        持有锁期间读写全部桶的状态 (有共享文件时同时持有文件锁)
+        '''
+        with self._lock:
+            if self._fd is None:
+                yield self._local_state
+                return
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                size = os.fstat(self._fd).st_size
+                try:
+                    state = json.loads(os.pread(self._fd, size, 0)) if size else {}
+                except ValueError:
+                    state = {}
+                yield state
+                data = json.dumps(state).encode('utf-8')
+                os.ftruncate(self._fd, 0)
+                os.pwrite(self._fd, data, 0)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _key(host, endpoint) -> str:
+        return f"{host}|{endpoint}"
+
+    def _bucket(self, state, key, limit, now) -> dict:
+        qps, burst = limit
+        bucket = state.get(key)
+        if bucket is None:
+            bucket = state[key] = {'tokens': burst, 'updated': now, 'rate': qps, 'blocked_until': 0.0}
+        rate = min(bucket['rate'], qps) # 配置可能被调低
+        bucket['tokens'] = min(burst, bucket['tokens'] + max(0.0, now - bucket['updated']) * rate)
+        bucket['updated'] = now
+        bucket['rate'] = rate
+        return bucket
+
+    def reserve(self, url, headers=None) -> float:
+        '''
+        预留一次请求的额度
+        :return: 发出请求前需要等待的秒数
+        '''
+        endpoint = endpoint_of(url, headers)
+        limit = self.limits.get(endpoint)
+        if not limit or not limit[0]:
+            return 0.0
+        key = self._key(urllib.parse.urlsplit(url).hostname, endpoint)
+        now = time.time()
+        with self._state() as state:
+            bucket = self._bucket(state, key, limit, now)
+            bucket['tokens'] -= 1
+            wait = -bucket['tokens'] / bucket['rate'] if bucket['tokens'] < 0 else 0.0
+            wait = max(wait, bucket['blocked_until'] - now)
+            if bucket['rate'] < limit[0]:
+                self._degraded.add(key)
+        if wait > 0:
+            RATE_LIMIT_WAIT_SECONDS.inc(wait, endpoint=endpoint)
+        return wait
+
+    def wait(self, url, headers=None):
+        '''
+        阻塞直到允许发出请求
+        '''
+        delay = self.reserve(url, headers)
+        if delay > 0:
+            time.sleep(delay)
+
+    def observe(self, url, request_headers, status, response_headers) -> float | None:
+        '''
+        根据响应调整速率
+        :return: 被要求暂停时为暂停秒数，否则为 None
+        '''
+        endpoint = endpoint_of(url, request_headers)
+        limit = self.limits.get(endpoint)
+        if not limit or not limit[0]:
+            return None
+        key = self._key(urllib.parse.urlsplit(url).hostname, endpoint)
+        pause = None
+        if status == 429:
+            pause = parse_retry_after(response_headers.get('Retry-After')) or RATE_LIMIT_PENALTY
+        elif response_headers.get('X-RateLimit-Remaining', response_headers.get('RateLimit-Remaining')) == '0':
+            pause = _parse_reset(response_headers.get('X-RateLimit-Reset', response_headers.get('RateLimit-Reset'))) or 1.0
+        if pause is None and key not in self._degraded:
+            return None
+
+        now = time.time()
+        with self._state() as state:
+            bucket = self._bucket(state, key, limit, now)
+            if pause is not None:
+                bucket['blocked_until'] = max(bucket['blocked_until'], now + pause)
+                if status == 429:
+                    bucket['rate'] = max(limit[0] * RATE_MIN_FRACTION, bucket['rate'] * RATE_DECREASE)
+                    bucket['tokens'] = min(bucket['tokens'], 0.0)
+                    self._degraded.add(key)
+            elif 200 <= status < 400:
+                bucket['rate'] = min(limit[0], bucket['rate'] + limit[0] * RATE_RECOVERY_STEP)
+                if bucket['rate'] >= limit[0]:
+                    self._degraded.discard(key)
+            rate = bucket['rate']
+        if pause is not None:
+            RATE_LIMITED.inc(endpoint=endpoint)
+            logger.warning(f"{key} 被限流 (状态码 {status})，暂停 {pause:.0f} 秒，当前速率 {rate:.2f}/s")
+        return pause
+
+    def snapshot(self) -> dict:
+        '''
+        各桶当前状态
+        '''
+        now = time.time()
+        with self._state() as state:
+            return {key: {'rate': round(bucket['rate'], 3), 'tokens': round(bucket['tokens'], 2),
+                          'blocked_for': round(max(0.0, bucket['blocked_until'] - now), 1)}
+                    for key, bucket in state.items()}
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+'''
+统一的重试策略：错误分类、指数退避 (带随机抖动，遵守 Retry-After) 以及按主机的熔断器。
+
+错误分类:
+- transient: 连接中断、超时、IncompleteRead 等网络错误，原地重试
+- throttled: 429 或“需稍后重试”，按 Retry-After 等待
+- server: 5xx，原地重试
+- auth: 401/403 (下载链接签名过期、token 失效)，原地重试无用，需重新获取视频信息后在任务层面重试
+- malformed: 响应内容不完整导致的 TypeError/KeyError 等 (例如 nohup.out 中反复出现的
+  "can only concatenate str (not "NoneType") to str")，清除缓存后在任务层面重试
+- permanent: 404/410、缺少 fileUrl、没有下载链接，不再重试
+- unknown: 其他错误，不重试
+
+下载循环 (api_client / async_client) 使用 DOWNLOAD_RETRY 原地重试，
+外层 (app.download_videos 的重试队列、job_runner) 使用 JOB_RETRY 决定是否以及多久之后重新调度。
+同一主机连续失败时熔断器打开，所有请求该主机的线程等待熔断结束，不会各自耗尽重试次数。
+'''
+import time
+import random
+import threading
+import urllib.parse
+from email.utils import parsedate_to_datetime
+from http.client import IncompleteRead
+
+import requests
+
+from log_config import get_logger
+from metrics import CIRCUIT_OPEN, record_retry
+
+logger = get_logger(__name__)
+
+ERROR_TRANSIENT = 'transient'
+ERROR_THROTTLED = 'throttled'
+ERROR_SERVER = 'server'
+ERROR_AUTH = 'auth'
+ERROR_MALFORMED = 'malformed'
+ERROR_PERMANENT = 'permanent'
+ERROR_UNKNOWN = 'unknown'
+
+# 下载循环内原地重试
+DOWNLOAD_MAX_ATTEMPTS = 5
+DOWNLOAD_BASE_DELAY = 2 # 第一次重试前的等待 (秒)，之后每次翻倍
+DOWNLOAD_MAX_DELAY = 60
+# 任务层面重新调度 (下载函数最终失败之后)
+JOB_MAX_ATTEMPTS = 3
+JOB_BASE_DELAY = 30
+JOB_MAX_DELAY = 600
+# 随机抖动比例：实际等待在 [delay * (1 - JITTER), delay] 之间，避免大量任务同时重试
+RETRY_JITTER = 0.5
+# Retry-After 的上限 (秒)，防止异常值让任务长时间挂起
+RETRY_AFTER_MAX = 900
+
+# 熔断器：同一主机连续失败多少次后打开
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30 # 第一次打开的时长 (秒)，连续打开时翻倍
+BREAKER_MAX_RESET_TIMEOUT = 600
+# 半开状态下探测请求的最长时间，超过后允许另一个请求探测
+BREAKER_PROBE_TIMEOUT = 60
+# 半开状态下其他请求的轮询间隔
+BREAKER_POLL_INTERVAL = 1.0
+
+# 计入熔断器的错误类型 (主机本身的问题；404、签名过期等与主机状态无关)
+BREAKER_ERRORS = frozenset({ERROR_TRANSIENT, ERROR_THROTTLED, ERROR_SERVER})
+
+class ClassifiedError(Exception):
+    '''
+    带有错误分类的异常
+    '''
+    error_class = ERROR_UNKNOWN
+
+    def __init__(self, message, error_class=None):
+        super().__init__(message)
+        if error_class is not None:
+            self.error_class = error_class
+
+class PermanentError(ClassifiedError):
+    '''
+    重试也无法成功的错误 (视频已删除、缺少 fileUrl、没有下载链接等)
+    '''
+    error_class = ERROR_PERMANENT
+
+class RetryExhaustedError(ClassifiedError):
+    '''
+    原地重试次数用完；error_class 为最后一次失败的分类，外层据此决定是否重新调度
+    '''
+
+def _status_of(exc) -> int | None:
+    response = getattr(exc, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status is None:
+        status = getattr(exc, 'status', None) # aiohttp.ClientResponseError
+    return status if isinstance(status, int) else None
+
+def _classify_one(exc) -> str | None:
+    error_class = getattr(exc, 'error_class', None)
+    if error_class is not None:
+        return error_class
+    status = _status_of(exc)
+    if status is not None:
+        if status == 429:
+            return ERROR_THROTTLED
+        if status >= 500:
+            return ERROR_SERVER
+        if status in (401, 403):
+            return ERROR_AUTH
+        if status == 408:
+            return ERROR_TRANSIENT
+        if status >= 400:
+            return ERROR_PERMANENT
+    if "需稍后重试" in str(exc):
+        return ERROR_THROTTLED
+    if isinstance(exc, (IncompleteRead, TimeoutError, ConnectionError, requests.exceptions.RequestException)):
+        return ERROR_TRANSIENT
+    if type(exc).__module__.startswith('aiohttp'):
+        return ERROR_TRANSIENT # 没有状态码的 aiohttp 错误都是连接或读取错误
+    if isinstance(exc, (TypeError, KeyError, AttributeError, IndexError, ValueError)):
+        return ERROR_MALFORMED
+    return None
+
+def classify_error(exc) -> str:
+    '''
+    错误分类。包装过的异常 (raise ... from e) 会沿着异常链查找原始原因。
+    :return: ERROR_* 之一
+    '''
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        error_class = _classify_one(exc)
+        if error_class is not None:
+            return error_class
+        exc = exc.__cause__ or exc.__context__
+    return ERROR_UNKNOWN
+
+def parse_retry_after(value) -> float | None:
+    '''
+    解析 Retry-After 响应头 (秒数或 HTTP 日期)
+    :return: 秒数，无法解析时为 None
+    '''
+    if value is None:
+        return None
+    value = str(value).strip()
+    if value.isdigit():
+        return min(float(value), RETRY_AFTER_MAX)
+    try:
+        return min(max(0.0, parsedate_to_datetime(value).timestamp() - time.time()), RETRY_AFTER_MAX)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def retry_after(exc) -> float | None:
+    '''
+    从异常 (或其原因) 关联的响应中读取 Retry-After
+    '''
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        response = getattr(exc, 'response', None)
+        headers = getattr(response, 'headers', None) or getattr(exc, 'headers', None)
+        if headers:
+            seconds = parse_retry_after(headers.get('Retry-After'))
+            if seconds is not None:
+                return seconds
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+class RetryPolicy:
+    '''
+    重试策略：哪些错误可以重试、最多几次、每次等待多久
+    '''
+    def __init__(self, max_attempts, base_delay, max_delay, retryable, jitter=RETRY_JITTER):
+        '''
+        :param max_attempts: 最多尝试次数 (包括第一次)
+        :param base_delay: 第一次重试前的等待 (秒)，之后每次翻倍
+        :param max_delay: 单次等待上限 (Retry-After 不受此限制)
+        :param retryable: 可以重试的错误分类
+        :param jitter: 随机抖动比例
+        '''
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retryable = frozenset(retryable)
+        self.jitter = jitter
+
+    def should_retry(self, error_class, attempt) -> bool:
+        '''
+        :param attempt: 已失败的尝试序号 (从 0 开始)
+        '''
+        return error_class in self.retryable and attempt + 1 < self.max_attempts
+
+    def delay(self, attempt, exc=None) -> float:
+        '''
+        第 attempt 次失败后 (从 0 开始) 应等待的秒数：指数退避加随机抖动，服务器给出 Retry-After 时不短于它
+        '''
+        backoff = min(self.max_delay, self.base_delay * (2 ** attempt))
+        backoff *= 1 - self.jitter * random.random()
+        server_delay = retry_after(exc) if exc is not None else None
+        return max(backoff, server_delay or 0.0)
+
+    def next_delay(self, exc, attempt, action, breaker=None, log=logger, stage='download') -> float:
+        '''
+        一次尝试失败后的统一处理 (线程版与异步版下载共用)：分类、计入熔断器、决定是否原地重试
+        :param attempt: 已失败的尝试序号 (从 0 开始)
+        :param action: 日志与异常中的描述，例如 "下载视频 {video_id}"
+        :param breaker: 请求主机的熔断器
+        :param stage: 重试统计的阶段
+        :return: 重试前应等待的秒数
+        :raise: 不再重试时抛出：可重试的错误用完次数时为 RetryExhaustedError (error_class 为本次的分类)，否则为原异常
+        '''
+        error_class = classify_error(exc)
+        if breaker is not None:
+            breaker.record_failure(error_class, retry_after(exc))
+        if not self.should_retry(error_class, attempt):
+            log.error(f"{action} 失败 ({error_class}，尝试 {attempt + 1}/{self.max_attempts}): {exc}")
+            if error_class in self.retryable:
+                raise RetryExhaustedError(f"{action} 失败，已达到最大重试次数 ({self.max_attempts}次): {exc}", error_class) from exc
+            raise exc
+        delay = self.delay(attempt, exc)
+        log.warning(f"{action} 失败 ({error_class}，尝试 {attempt + 1}/{self.max_attempts})，{delay:.1f} 秒后重试: {exc}")
+        record_retry(stage, exc)
+        return delay
+
+DOWNLOAD_RETRY = RetryPolicy(DOWNLOAD_MAX_ATTEMPTS, DOWNLOAD_BASE_DELAY, DOWNLOAD_MAX_DELAY,
+                             retryable=(ERROR_TRANSIENT, ERROR_THROTTLED, ERROR_SERVER))
+JOB_RETRY = RetryPolicy(JOB_MAX_ATTEMPTS, JOB_BASE_DELAY, JOB_MAX_DELAY,
+                        retryable=(ERROR_TRANSIENT, ERROR_THROTTLED, ERROR_SERVER, ERROR_AUTH, ERROR_MALFORMED))
+
+class CircuitBreaker:
+    '''
+    单个主机的熔断器。
+    closed: 正常；连续失败达到阈值后 open: 所有请求等待；到期后 half_open: 放行一个探测请求，
+    探测成功则恢复 closed，失败则重新 open 且时长翻倍。
+    '''
+    def __init__(self, host, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT,
+                 max_reset_timeout=BREAKER_MAX_RESET_TIMEOUT):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.open_count = 0 # 连续打开的次数 (决定下次打开的时长)
+        self.open_until = 0.0
+        self.probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        '''
+        请求前调用
+        :return: 需要等待的秒数，0 表示可以发出请求
+        '''
+        with self._lock:
+            if self.state == 'closed':
+                return 0.0
+            now = time.monotonic()
+            if self.state == 'open':
+                if now < self.open_until:
+                    return self.open_until - now
+                self.state = 'half_open'
+                self.probe_started = now
+                return 0.0
+            if now - self.probe_started > BREAKER_PROBE_TIMEOUT:
+                self.probe_started = now
+                return 0.0
+            return BREAKER_POLL_INTERVAL
+
+    def wait(self):
+        '''
+        阻塞直到允许请求该主机 (熔断期间不消耗调用方的重试次数)
+        '''
+        logged = False
+        while (delay := self.acquire()) > 0:
+            if not logged:
+                logger.info(f"主机 {self.host} 熔断中，等待 {delay:.0f} 秒")
+                logged = True
+            time.sleep(delay)
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logger.info(f"主机 {self.host} 已恢复，熔断结束")
+                CIRCUIT_OPEN.set(0, host=self.host)
+            self.state = 'closed'
+            self.failures = 0
+            self.open_count = 0
+
+    def record_failure(self, error_class, retry_after_seconds=None):
+        '''
+        :param error_class: classify_error 的结果，不属于主机问题的错误不计入
+        :param retry_after_seconds: 服务器要求的等待时间，给出时立即熔断相应时长
+        '''
+        if error_class not in BREAKER_ERRORS:
+            return
+        with self._lock:
+            self.failures += 1
+            if self.state != 'half_open' and self.failures < self.failure_threshold:
+                if not retry_after_seconds:
+                    return
+                duration = retry_after_seconds # 服务器明确要求等待，整个主机暂停相应时长
+            else:
+                duration = min(self.max_reset_timeout, self.reset_timeout * (2 ** self.open_count))
+                duration = max(duration, retry_after_seconds or 0.0)
+                self.open_count += 1
+                self.failures = 0
+            self.state = 'open'
+            self.open_until = max(self.open_until, time.monotonic() + duration)
+            CIRCUIT_OPEN.set(1, host=self.host)
+        logger.warning(f"主机 {self.host} 连续请求失败 ({error_class})，熔断 {duration:.0f} 秒")
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {'host': self.host, 'state': self.state, 'failures': self.failures,
+                    'reopen_in': round(max(0.0, self.open_until - time.monotonic()), 1) if self.state == 'open' else None}
+
+class CircuitBreakerRegistry:
+    '''
+    按主机名管理熔断器 (进程内共享)
+    '''
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, url) -> CircuitBreaker:
+        '''
+        :param url: 请求地址或主机名
+        '''
+        host = urllib.parse.urlsplit(url).hostname if '://' in url else url
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = self._breakers[host] = CircuitBreaker(host)
+            return breaker
+
+    def snapshot(self) -> list:
+        '''
+        非 closed 状态的熔断器 (用于 /progress)
+        '''
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return [breaker.to_dict() for breaker in breakers if breaker.state != 'closed']
+
+BREAKERS = CircuitBreakerRegistry()
+
+def get_breaker(url) -> CircuitBreaker:
+    return BREAKERS.get(url)
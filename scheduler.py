@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+'''
+下载任务调度器：按阶段 (元数据 / 缩略图 / 视频) 分别限制并发，
+带优先级队列、全局带宽限制和在途字节数限制，取代“每个视频一个线程”的方式。
+'''
+import os
+import json
+import time
+import asyncio
+import queue
+import itertools
+import threading
+from datetime import datetime
+
+from log_config import get_logger
+from storage import STORAGE_SPACE_POLL, InsufficientStorageError
+
+logger = get_logger(__name__)
+
+# 各阶段默认并发数
+METADATA_WORKERS = 8
+THUMBNAIL_WORKERS = 16 # 缩略图很小，以较高并发在视频之前完成
+VIDEO_WORKERS = 3
+# 同时在下载的视频预计总字节数上限 (至少允许一个任务运行)
+MAX_INFLIGHT_BYTES = 4 * 1024 * 1024 * 1024
+# 全局带宽上限 (bytes/s)，None 表示不限速
+MAX_BANDWIDTH = None
+# 按时段的带宽上限: [(开始 'HH:MM', 结束 'HH:MM', bytes/s 或 None)]，按顺序匹配第一个包含当前时间的时段，
+# 跨午夜的时段写成 ('23:00', '07:00', ...)；不在任何时段内时使用 MAX_BANDWIDTH。
+# 例如白天限速、夜间不限: [('08:00', '01:00', 2 * 1024 * 1024)]
+BANDWIDTH_PROFILES = []
+# 运行时带宽配置文件 (批量任务与 web 服务共用)，存在时覆盖上面两项，修改后正在进行的下载几秒内按新限速进行
+BANDWIDTH_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bandwidth.json')
+BANDWIDTH_RELOAD_INTERVAL = 5 # 检查配置文件是否修改的间隔 (秒)
+# 超过该秒数没有读取数据的下载不再参与带宽分配
+BANDWIDTH_STREAM_IDLE = 2.0
+# 无法得知文件大小时用于在途字节统计的估计值
+DEFAULT_VIDEO_SIZE = 256 * 1024 * 1024
+
+LANES = ('metadata', 'thumbnail', 'video')
+
+def video_priority(video, subscribed=False) -> tuple:
+    '''
+    计算视频的调度优先级，数值越小越先执行：订阅优先，其次上传时间越新越先
+    :param video: /videos 列表中的视频条目
+    :param subscribed: 是否来自订阅列表
+    :return: 可比较的优先级元组
+    '''
+    created_ts = 0.0
+    created_at = video.get('createdAt') if isinstance(video, dict) else None
+    if created_at:
+        try:
+            created_ts = datetime.fromisoformat(created_at.replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            pass
+    return (0 if subscribed else 1, -created_ts)
+
+def video_expected_size(video) -> int:
+    '''
+    从列表条目中读取视频文件大小，用于在途字节统计
+    :param video: /videos 列表中的视频条目
+    :return: 字节数，未知时返回 DEFAULT_VIDEO_SIZE
+    '''
+    file_info = video.get('file') if isinstance(video, dict) else None
+    size = file_info.get('size') if isinstance(file_info, dict) else None
+    return size if isinstance(size, int) and size > 0 else DEFAULT_VIDEO_SIZE
+
+def parse_rate(value) -> int | None:
+    '''
+    解析带宽值: 整数 bytes/s，或带 K/M/G 后缀的字符串 (例如 "2M")；None、0、"none" 表示不限速
+    '''
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value) or None
+    text = str(value).strip().upper().removesuffix('B').removesuffix('/S')
+    if text in ('', 'NONE', 'UNLIMITED', '0'):
+        return None
+    multiplier = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}.get(text[-1], 1)
+    number = text[:-1] if multiplier > 1 else text
+    try:
+        return int(float(number) * multiplier) or None
+    except ValueError:
+        raise ValueError(f"无法解析带宽: {value}")
+
+def _parse_clock(text) -> int:
+    hour, minute = str(text).split(':')
+    minutes = int(hour) * 60 + int(minute)
+    if not 0 <= minutes <= 24 * 60:
+        raise ValueError(f"无效的时间: {text}")
+    return minutes
+
+def normalize_profiles(profiles) -> list:
+    '''
+    校验按时段的带宽配置
+    :return: [(开始 'HH:MM', 结束 'HH:MM', bytes/s 或 None)]
+    '''
+    result = []
+    for start, end, rate in profiles or []:
+        _parse_clock(start)
+        _parse_clock(end)
+        result.append((start, end, parse_rate(rate)))
+    return result
+
+def profile_rate(profiles, default, when=None) -> int | None:
+    '''
+    按当前时间选择带宽上限
+    :param when: time.struct_time，默认当前本地时间
+    '''
+    when = when or time.localtime()
+    now = when.tm_hour * 60 + when.tm_min
+    for start, end, rate in profiles:
+        start, end = _parse_clock(start), _parse_clock(end)
+        if (start <= now < end) if start <= end else (now >= start or now < end):
+            return rate
+    return default
+
+class BandwidthLimiter:
+    '''
+    全局令牌桶限速器，所有下载线程共享。
+    带宽不足时按下载 (stream，通常为视频ID) 平分：超出平均份额的下载额外等待，
+    未用满份额的下载 (例如服务器本身较慢) 剩余的带宽由其他下载使用。
+    上限可以按时段变化，也可以在运行中通过 set_limits() 或修改配置文件调整。
+    '''
+    def __init__(self, rate=None, burst=None, profiles=None, config_file=None):
+        '''
+        :param rate: 默认上限 bytes/s，None 表示不限速
+        :param burst: 突发上限 (字节)，默认为 1 秒的流量
+        :param profiles: 按时段的上限，见 BANDWIDTH_PROFILES
+        :param config_file: 运行时配置文件，存在时覆盖 rate 和 profiles
+        '''
+        self.default_rate = rate
+        self.profiles = normalize_profiles(profiles)
+        self.config_file = config_file
+        self._burst = burst
+        self.rate = None
+        self.burst = 0
+        self._tokens = 0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        self._streams = {} # stream -> [令牌数, 最后一次读取的 monotonic 时间]
+        self._config_mtime = None
+        self._next_check = 0.0
+        self._update_rate(time.monotonic())
+
+    def _load_config(self):
+        try:
+            mtime = os.stat(self.config_file).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._config_mtime:
+            return
+        self._config_mtime = mtime
+        if mtime is None:
+            return
+        try:
+            with open(self.config_file, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+            self.default_rate = parse_rate(config.get('max_bandwidth'))
+            self.profiles = normalize_profiles(config.get('profiles'))
+            logger.info(f"已加载带宽配置 {self.config_file}: 默认 {self.default_rate}，时段 {self.profiles}")
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"带宽配置文件 {self.config_file} 无效，继续使用当前配置: {e}")
+
+    def _update_rate(self, now):
+        # 调用方持有 self._lock (或在初始化中)
+        if now < self._next_check:
+            return
+        self._next_check = now + BANDWIDTH_RELOAD_INTERVAL
+        if self.config_file:
+            self._load_config()
+        rate = profile_rate(self.profiles, self.default_rate)
+        if rate != self.rate:
+            if self.rate is not None or rate is not None:
+                logger.info(f"带宽上限调整为 {f'{rate / 1024 / 1024:.2f} MB/s' if rate else '不限速'}")
+            self.rate = rate
+            self.burst = self._burst or (rate or 0)
+            self._tokens = min(self._tokens, self.burst)
+
+    def set_limits(self, rate=..., profiles=..., save=True):
+        '''
+        运行时调整上限，正在进行的下载立即按新上限继续
+        :param rate: 默认上限 bytes/s (可为 "2M" 等字符串)，None 表示不限速；不传则不修改
+        :param profiles: 按时段的上限；不传则不修改
+        :param save: 是否写入配置文件 (其他进程据此同步)
+        '''
+        with self._lock:
+            if rate is not ...:
+                self.default_rate = parse_rate(rate)
+            if profiles is not ...:
+                self.profiles = normalize_profiles(profiles)
+            if save and self.config_file:
+                tmp_path = f"{self.config_file}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'max_bandwidth': self.default_rate, 'profiles': self.profiles}, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, self.config_file)
+                self._config_mtime = os.stat(self.config_file).st_mtime_ns
+            self._next_check = 0.0
+            self._update_rate(time.monotonic())
+
+    def status(self) -> dict:
+        with self._lock:
+            self._update_rate(time.monotonic())
+            now = time.monotonic()
+            return {'rate': self.rate, 'max_bandwidth': self.default_rate, 'profiles': self.profiles,
+                    'active_streams': sum(1 for _, last in self._streams.values() if now - last < BANDWIDTH_STREAM_IDLE)}
+
+    def consume(self, nbytes, stream=None):
+        '''
+        消耗 nbytes 个令牌，令牌不足时阻塞等待
+        :param stream: 所属的下载 (视频ID)，用于在多个下载之间平分带宽；同一视频的多个分段连接共用一份
+        '''
+        wait = self._take(nbytes, stream)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def consume_async(self, nbytes, stream=None):
+        '''
+        consume() 的异步版本 (异步后端使用)：在事件循环中等待，不阻塞其他连接
+        '''
+        wait = self._take(nbytes, stream)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _take(self, nbytes, stream) -> float:
+        '''
+        扣除令牌
+        :return: 需要等待的秒数
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._update_rate(now)
+            if not self.rate:
+                return 0
+            elapsed = now - self._last
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+            self._last = now
+            self._tokens -= nbytes
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+            if stream is not None:
+                for key, (_, last) in list(self._streams.items()):
+                    if now - last >= BANDWIDTH_STREAM_IDLE:
+                        del self._streams[key]
+                share = self.rate / max(1, len(self._streams) + (stream not in self._streams))
+                tokens, last = self._streams.get(stream, (share, now))
+                tokens = min(share, tokens + (now - last) * share) - nbytes
+                if wait > 0 and tokens < 0:
+                    # 带宽已用满：超出平均份额的下载按自己的份额等待
+                    wait = max(wait, -tokens / share)
+                elif wait <= 0:
+                    tokens = max(tokens, 0.0) # 带宽有富余时多用的部分不记账
+                self._streams[stream] = [tokens, now]
+        return wait
+
+class ByteBudget:
+    '''
+    在途字节数限制：预计总大小超过上限时新任务等待 (没有在途任务时总是放行)
+    '''
+    def __init__(self, limit=MAX_INFLIGHT_BYTES):
+        self.limit = limit
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self._cond:
+            while self.limit and self.in_flight > 0 and self.in_flight + nbytes > self.limit:
+                self._cond.wait()
+            self.in_flight += nbytes
+
+    def release(self, nbytes):
+        with self._cond:
+            self.in_flight -= nbytes
+            self._cond.notify_all()
+
+class DownloadScheduler:
+    '''
+    多阶段下载调度器。
+    每个阶段拥有独立的优先级队列和固定数量的工作线程；
+    任务可以在执行过程中向其他阶段提交后续任务，join() 会等待所有任务 (包括后续任务) 完成。
+    '''
+    def __init__(self, metadata_workers=METADATA_WORKERS, thumbnail_workers=THUMBNAIL_WORKERS, video_workers=VIDEO_WORKERS,
+                 max_inflight_bytes=MAX_INFLIGHT_BYTES, max_bandwidth=MAX_BANDWIDTH, bandwidth_profiles=BANDWIDTH_PROFILES,
+                 bandwidth_file=BANDWIDTH_FILE, disk_guard=None):
+        '''
+        :param disk_guard: storage.DiskSpaceGuard，视频阶段开始前按预计大小预留磁盘空间，None 表示不检查
+        '''
+        self.workers = {'metadata': metadata_workers, 'thumbnail': thumbnail_workers, 'video': video_workers}
+        self.queues = {lane: queue.PriorityQueue() for lane in LANES}
+        self.bandwidth = BandwidthLimiter(max_bandwidth, profiles=bandwidth_profiles, config_file=bandwidth_file)
+        self.byte_budget = ByteBudget(max_inflight_bytes)
+        self.disk_guard = disk_guard
+
+        self._seq = itertools.count() # 相同优先级时按提交顺序执行
+        self._pending = 0 # 已提交但尚未完成的任务数
+        self._pending_cond = threading.Condition()
+        self._threads = []
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            for lane in LANES:
+                for i in range(self.workers[lane]):
+                    t = threading.Thread(target=self._worker_loop, args=(lane,), name=f"{lane}-worker-{i}", daemon=True)
+                    t.start()
+                    self._threads.append(t)
+            self._started = True
+
+    def submit(self, lane, func, *args, priority=(0,), size=0, delay=0, on_abandon=None, **kwargs):
+        '''
+        提交任务
+        :param lane: 阶段: metadata, thumbnail, video
+        :param func: 任务函数
+        :param priority: 优先级 (越小越先执行)
+        :param size: 任务预计字节数，仅 video 阶段用于在途字节限制
+        :param delay: 延迟多少秒后才进入队列 (用于重试)
+        :param on_abandon: 任务因磁盘空间不足被放弃 (不会执行) 时调用 on_abandon(异常)
+        '''
+        if lane not in self.queues:
+            raise ValueError(f"未知的调度阶段: {lane}")
+        self.start()
+        with self._pending_cond:
+            self._pending += 1
+        item = (priority, next(self._seq), func, args, kwargs, size, on_abandon, None)
+        if delay > 0:
+            timer = threading.Timer(delay, self.queues[lane].put, args=(item,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.queues[lane].put(item)
+
+    def _worker_loop(self, lane):
+        q = self.queues[lane]
+        while True:
+            priority, seq, func, args, kwargs, size, on_abandon, deferred_since = q.get()
+            if func is None: # 停止信号
+                break
+            reserved = size if lane == 'video' else 0
+            if reserved and self.disk_guard is not None:
+                try:
+                    admitted = self.disk_guard.admit(reserved, time.monotonic() - deferred_since if deferred_since else 0.0)
+                except InsufficientStorageError as e:
+                    # 等待也无法满足或已延后太久：放弃任务，不再阻塞 join()
+                    logger.error(f"任务 {getattr(func, '__name__', func)} ({lane}) 因存储空间不足被放弃: {e}")
+                    self._abandon(on_abandon, e)
+                    continue
+                if not admitted:
+                    # 磁盘空间不足：稍后重新入队 (仍计入未完成任务)，工作线程继续处理其他任务
+                    logger.warning(f"存储空间不足 (需要 {reserved} bytes)，任务 {getattr(func, '__name__', func)} 延后 {STORAGE_SPACE_POLL} 秒")
+                    item = (priority, seq, func, args, kwargs, size, on_abandon, deferred_since or time.monotonic())
+                    timer = threading.Timer(STORAGE_SPACE_POLL, q.put, args=(item,))
+                    timer.daemon = True
+                    timer.start()
+                    continue
+            if reserved:
+                self.byte_budget.acquire(reserved)
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"调度任务 {getattr(func, '__name__', func)} ({lane}) 异常: {e}")
+            finally:
+                if reserved:
+                    self.byte_budget.release(reserved)
+                    if self.disk_guard is not None:
+                        self.disk_guard.release(reserved)
+                with self._pending_cond:
+                    self._pending -= 1
+                    self._pending_cond.notify_all()
+
+    def _abandon(self, on_abandon, error):
+        try:
+            if on_abandon is not None:
+                on_abandon(error)
+        except Exception as e:
+            logger.error(f"调度任务放弃回调异常: {e}")
+        finally:
+            with self._pending_cond:
+                self._pending -= 1
+                self._pending_cond.notify_all()
+
+    def join(self):
+        '''
+        等待所有已提交的任务完成
+        '''
+        with self._pending_cond:
+            while self._pending > 0:
+                self._pending_cond.wait()
+
+    def shutdown(self):
+        '''
+        等待任务完成并停止工作线程
+        '''
+        self.join()
+        with self._start_lock:
+            if not self._started:
+                return
+            for lane in LANES:
+                for _ in range(self.workers[lane]):
+                    # 停止信号排在所有任务之后
+                    self.queues[lane].put(((float('inf'),), float('inf'), None, (), {}, 0, None, None))
+            for t in self._threads:
+                t.join()
+            self._threads = []
+            self._started = False
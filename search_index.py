@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+'''
+下载记录的进程内搜索引擎，供 json_to_web.py 的 /search 使用。
+
+- 倒排索引: Tag、作者、标题分词 (英文按单词，中日韩文字按单字和相邻两字 n-gram)
+- 范围索引: video_createTime、video_numLikes、video_size_mb (以及排序用的 local_id)，有序列表 + 二分查找
+- 增量更新: 按账本的修订号只读取上次同步之后写入的条目 (DownloadLedger.iter_changes)，代价与变化的条目数成正比
+
+Tag 查询支持布尔表达式: tags=mmd AND (dance OR "r-18") AND NOT vtuber (相邻的项默认为 AND，-tag 等同于 NOT tag)。
+'''
+import re
+import math
+import heapq
+import bisect
+import threading
+import unicodedata
+
+from archive_query import QueryError, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, _parse_bool, _parse_float, _parse_int, _normalize_date
+
+# 自由文本在各字段命中时的权重 (再乘以词的 idf)；相关度相同时按点赞数排序
+FIELD_WEIGHTS = {'title': 1.0, 'author': 2.0, 'tag': 1.5}
+SEARCH_SORT_FIELDS = ('relevance', 'local_id', 'video_numLikes', 'video_createTime', 'video_size_mb')
+
+_CJK_RANGES = r'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff' # 假名、汉字、谚文
+_TOKEN_RE = re.compile(rf'([{_CJK_RANGES}]+)|[^\W_{_CJK_RANGES}]+')
+_TAG_QUERY_RE = re.compile(r'\(|\)|"[^"]*"|[^\s()]+')
+
+def normalize_text(text) -> str:
+    return unicodedata.normalize('NFKC', str(text)).lower()
+
+def tokenize(text, unigrams=False) -> list:
+    '''
+    分词: 英文/数字按单词，中日韩文字按相邻两字 (只有一个字时为该字)
+    :param unigrams: 同时输出中日韩文字的每个单字 (建立索引时使用，以支持单字查询)
+    '''
+    tokens = []
+    for match in _TOKEN_RE.finditer(normalize_text(text or '')):
+        run = match.group(1)
+        if run is None:
+            tokens.append(match.group(0))
+            continue
+        if len(run) == 1 or unigrams:
+            tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+class _RangeIndex:
+    '''
+    数值 (或可比较的字符串) 字段的有序索引
+    '''
+    def __init__(self):
+        self.keys = [] # [(value, doc)] 有序
+        self.values = {} # doc -> value
+
+    def add(self, doc, value, bulk=False):
+        '''
+        :param bulk: 批量加载，只追加不排序 (加载完成后调用 sort)
+        '''
+        if value is None:
+            return
+        self.values[doc] = value
+        if bulk:
+            self.keys.append((value, doc))
+        else:
+            bisect.insort(self.keys, (value, doc))
+
+    def sort(self):
+        self.keys.sort()
+
+    def remove(self, doc):
+        value = self.values.pop(doc, None)
+        if value is None:
+            return
+        i = bisect.bisect_left(self.keys, (value, doc))
+        if i < len(self.keys) and self.keys[i] == (value, doc):
+            del self.keys[i]
+
+    def bounds(self, low=None, high=None) -> tuple:
+        '''
+        :return: [low, high] 范围在 keys 中的下标区间 (start, end)
+        '''
+        start = 0 if low is None else bisect.bisect_left(self.keys, (low,))
+        end = len(self.keys) if high is None else bisect.bisect_right(self.keys, (high, math.inf))
+        return start, max(start, end)
+
+    def in_range(self, doc, low=None, high=None) -> bool:
+        value = self.values.get(doc)
+        return value is not None and (low is None or value >= low) and (high is None or value <= high)
+
+def _parse_tag_query(text):
+    '''
+    解析 Tag 布尔表达式
+    :return: 语法树 ('tag', 名称) | ('not', 子树) | ('and', [子树]) | ('or', [子树])
+    '''
+    tokens = _TAG_QUERY_RE.findall(text)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def parse_or():
+        children = [parse_and()]
+        while peek() is not None and peek().upper() == 'OR':
+            take()
+            children.append(parse_and())
+        return children[0] if len(children) == 1 else ('or', children)
+
+    def parse_and():
+        children = [parse_not()]
+        while peek() is not None and peek() != ')' and peek().upper() != 'OR':
+            if peek().upper() == 'AND':
+                take()
+            children.append(parse_not())
+        return children[0] if len(children) == 1 else ('and', children)
+
+    def parse_not():
+        token = peek()
+        if token is None:
+            raise QueryError(f"Tag 表达式不完整: {text}")
+        if token.upper() == 'NOT':
+            take()
+            return ('not', parse_not())
+        if token.startswith('-') and len(token) > 1:
+            take()
+            return ('not', ('tag', normalize_text(token[1:])))
+        return parse_primary()
+
+    def parse_primary():
+        token = take()
+        if token == '(':
+            node = parse_or()
+            if peek() != ')':
+                raise QueryError(f"Tag 表达式缺少右括号: {text}")
+            take()
+            return node
+        if token == ')' or token.upper() in ('AND', 'OR'):
+            raise QueryError(f"Tag 表达式在 {token} 处有误: {text}")
+        return ('tag', normalize_text(token.strip('"')))
+
+    if not tokens:
+        raise QueryError("Tag 表达式为空")
+    tree = parse_or()
+    if position != len(tokens):
+        raise QueryError(f"Tag 表达式在 {tokens[position]} 处有误: {text}")
+    return tree
+
+class SearchIndex:
+    '''
+    账本的增量搜索索引 (线程安全)
+    '''
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self.version = None
+        self.revision = None # 已同步到的账本修订号，None 表示尚未加载
+        self._lock = threading.Lock()
+        self._docs = [] # doc -> 条目 (doc 为内部编号)
+        self._doc_ids = {} # video_id -> doc
+        self._all = set()
+        self._success = set()
+        self._tags = {} # Tag -> {doc}
+        self._authors = {} # 作者 -> {doc}
+        self._text = {'title': {}, 'author': {}} # 字段 -> 词 -> {doc}
+        self._ranges = {'local_id': _RangeIndex(), 'video_numLikes': _RangeIndex(),
+                        'video_createTime': _RangeIndex(), 'video_size_mb': _RangeIndex()}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._all)
+
+    def refresh(self) -> str:
+        '''
+        应用账本上次同步之后的变化
+        :return: 当前账本版本
+        '''
+        version = self.ledger.version()
+        if version == self.version:
+            return version
+        with self._lock:
+            if version == self.version:
+                return version
+            bulk = self.revision is None # 首次加载时范围索引最后统一排序
+            for revision, entry in self.ledger.iter_changes(self.revision):
+                self._index(entry, bulk)
+                self.revision = max(self.revision or 0, revision)
+            if bulk:
+                for index in self._ranges.values():
+                    index.sort()
+                self.revision = self.revision or 0
+            self.version = version
+        return version
+
+    # --- 索引维护 (需持有 self._lock) ---
+
+    @staticmethod
+    def _postings_add(postings, key, doc):
+        docs = postings.get(key)
+        if docs is None:
+            postings[key] = docs = set()
+        docs.add(doc)
+
+    @staticmethod
+    def _postings_remove(postings, key, doc):
+        docs = postings.get(key)
+        if docs is not None:
+            docs.discard(doc)
+            if not docs:
+                del postings[key]
+
+    @staticmethod
+    def _fields(entry) -> dict:
+        return {
+            'tags': {normalize_text(tag) for tag in entry.get('video_tagList') or []},
+            'author': normalize_text(entry.get('avatar_name') or ''),
+            'title': set(tokenize(entry.get('video_title'), unigrams=True)),
+            'author_terms': set(tokenize(entry.get('avatar_name'), unigrams=True)),
+        }
+
+    def _index(self, entry, bulk=False):
+        video_id = entry.get('video_id')
+        if not video_id:
+            return
+        doc = self._doc_ids.get(video_id)
+        if doc is None:
+            doc = self._doc_ids[video_id] = len(self._docs)
+            self._docs.append(None)
+        else:
+            self._unindex(doc)
+        self._docs[doc] = entry
+        self._all.add(doc)
+        if entry.get('success'):
+            self._success.add(doc)
+        fields = self._fields(entry)
+        for tag in fields['tags']:
+            self._postings_add(self._tags, tag, doc)
+        self._postings_add(self._authors, fields['author'], doc)
+        for field, terms in (('title', fields['title']), ('author', fields['author_terms'])):
+            for term in terms:
+                self._postings_add(self._text[field], term, doc)
+        self._ranges['local_id'].add(doc, entry.get('local_id'), bulk)
+        self._ranges['video_numLikes'].add(doc, entry.get('video_numLikes'), bulk)
+        self._ranges['video_createTime'].add(doc, _normalize_date(entry.get('video_createTime')) or None, bulk)
+        self._ranges['video_size_mb'].add(doc, entry.get('video_size_mb'), bulk)
+
+    def _unindex(self, doc):
+        fields = self._fields(self._docs[doc])
+        self._all.discard(doc)
+        self._success.discard(doc)
+        for tag in fields['tags']:
+            self._postings_remove(self._tags, tag, doc)
+        self._postings_remove(self._authors, fields['author'], doc)
+        for field, terms in (('title', fields['title']), ('author', fields['author_terms'])):
+            for term in terms:
+                self._postings_remove(self._text[field], term, doc)
+        for index in self._ranges.values():
+            index.remove(doc)
+
+    # --- 查询 (需持有 self._lock) ---
+
+    def _eval_tags(self, node) -> set:
+        kind = node[0]
+        if kind == 'tag':
+            return self._tags.get(node[1], set())
+        if kind == 'not':
+            return self._all - self._eval_tags(node[1])
+        if kind == 'or':
+            return set().union(*(self._eval_tags(child) for child in node[1]))
+        # and: 先求肯定项的交集 (从小到大)，否定项直接做差集，避免对全集求补
+        positives = [self._eval_tags(child) for child in node[1] if child[0] != 'not']
+        negatives = [self._eval_tags(child[1]) for child in node[1] if child[0] == 'not']
+        positives.sort(key=len)
+        result = positives[0].intersection(*positives[1:]) if positives else set(self._all)
+        result.difference_update(*negatives)
+        return result
+
+    def _rank_groups(self, candidates, matches, descending) -> list:
+        '''
+        按相关度把候选分组: 每个 (词, 字段) 命中加 FIELD_WEIGHTS[字段] * idf，命中情况相同的文档得分相同。
+        分组只用集合运算完成，不需要逐个文档计算得分。
+        :return: [(文档集合, 得分)]，按得分排序
+        '''
+        groups = [(candidates, 0.0)]
+        for term, fields in matches:
+            for field, docs in fields.items():
+                if not docs:
+                    continue
+                weight = FIELD_WEIGHTS[field] * math.log(1 + len(self._all) / len(docs))
+                split = []
+                for group, score in groups:
+                    inside = group & docs
+                    if inside:
+                        split.append((inside, score + weight))
+                    if len(inside) < len(group):
+                        split.append((group - inside, score))
+                groups = split
+        groups.sort(key=lambda item: item[1], reverse=descending)
+        return groups
+
+    def _order(self, candidates, sort, descending, limit) -> list:
+        '''
+        按字段排序，只取前 limit 个
+        :param candidates: 候选集合，None 表示全部
+        '''
+        index = self._ranges[sort]
+        if candidates is None:
+            keys = index.keys[::-1] if descending else index.keys
+            docs = [doc for _, doc in keys[:limit]]
+            if len(docs) < limit:
+                docs += sorted(self._all - index.values.keys())[:limit - len(docs)]
+            return docs
+        # 按索引顺序扫描约需 limit * 索引大小 / 候选数 步，候选较少时直接在候选中选出前 limit 个更快
+        if len(candidates) * len(candidates) < limit * len(index.keys):
+            present = [doc for doc in candidates if doc in index.values]
+            select = heapq.nlargest if descending else heapq.nsmallest
+            docs = select(limit, present, key=lambda doc: (index.values[doc], doc))
+        else:
+            docs = []
+            keys = reversed(index.keys) if descending else iter(index.keys)
+            for _, doc in keys:
+                if doc in candidates:
+                    docs.append(doc)
+                    if len(docs) >= limit:
+                        break
+        if len(docs) < limit:
+            docs += sorted(doc for doc in candidates if doc not in index.values)[:limit - len(docs)]
+        return docs
+
+    def search(self, args) -> dict:
+        '''
+        执行搜索
+        :param args: 查询参数 (dict 或 werkzeug MultiDict)
+            q: 自由文本 (标题、作者、Tag)，所有词都需命中，按相关度排序
+            tags: Tag 布尔表达式；author: 作者 (完整名称，不区分大小写)；success
+            created_from / created_to, min_likes / max_likes, min_size_mb / max_size_mb: 范围过滤
+            sort: relevance (有 q 时默认) | local_id (默认) | video_numLikes | video_createTime | video_size_mb
+            order: asc | desc (默认)；page (从 1 开始)；page_size
+        :return: {'total', 'page', 'page_size', 'items'}，按相关度排序时 items 中带 score
+        '''
+        terms = list(dict.fromkeys(tokenize(args.get('q'))))
+        tag_query = _parse_tag_query(args['tags']) if args.get('tags') else None
+        author = args.get('author')
+        success = _parse_bool(args.get('success'))
+        ranges = [
+            ('video_createTime', _normalize_date(args.get('created_from')) or None, _normalize_date(args.get('created_to')) or None),
+            ('video_numLikes', _parse_float('min_likes', args.get('min_likes')), _parse_float('max_likes', args.get('max_likes'))),
+            ('video_size_mb', _parse_float('min_size_mb', args.get('min_size_mb')), _parse_float('max_size_mb', args.get('max_size_mb'))),
+        ]
+        if ranges[0][2] is not None:
+            ranges[0] = (ranges[0][0], ranges[0][1], ranges[0][2] + '\uffff') # 只给出日期时包含当天
+        ranges = [r for r in ranges if r[1] is not None or r[2] is not None]
+        page = max(1, _parse_int('page', args.get('page'), 1))
+        page_size = min(MAX_PAGE_SIZE, max(1, _parse_int('page_size', args.get('page_size'), DEFAULT_PAGE_SIZE)))
+        sort = args.get('sort') or ('relevance' if terms else 'local_id')
+        if sort not in SEARCH_SORT_FIELDS:
+            raise QueryError(f"不支持的排序字段: {sort}")
+        if sort == 'relevance' and not terms:
+            raise QueryError("按相关度排序需要 q 参数")
+        order = args.get('order') or 'desc'
+        if order not in ('asc', 'desc'):
+            raise QueryError(f"order 只能是 asc 或 desc: {order}")
+
+        self.refresh()
+        with self._lock:
+            # 每个词的命中集合 (任一字段)，从小到大求交集
+            candidates = None
+            matches = []
+            for term in terms:
+                fields = {'title': self._text['title'].get(term, set()), 'author': self._text['author'].get(term, set()),
+                          'tag': self._tags.get(term, set())}
+                matches.append((term, fields))
+                docs = fields['title'] | fields['author'] | fields['tag']
+                candidates = docs if candidates is None else candidates & docs
+            sets = []
+            if tag_query is not None:
+                sets.append(self._eval_tags(tag_query))
+            if author:
+                sets.append(self._authors.get(normalize_text(author), set()))
+            if success is True:
+                sets.append(self._success)
+            for docs in sorted(sets, key=len):
+                candidates = set(docs) if candidates is None else candidates & docs
+            if success is False:
+                candidates = (self._all if candidates is None else candidates) - self._success
+            for field, low, high in ranges:
+                index = self._ranges[field]
+                start, end = index.bounds(low, high)
+                if candidates is not None and len(candidates) < end - start:
+                    candidates = {doc for doc in candidates if index.in_range(doc, low, high)}
+                else:
+                    docs = {doc for _, doc in index.keys[start:end]}
+                    candidates = docs if candidates is None else candidates & docs
+
+            total = len(self._all) if candidates is None else len(candidates)
+            limit = page * page_size
+            if sort == 'relevance':
+                ranked = []
+                for group, score in self._rank_groups(candidates, matches, order == 'desc'):
+                    ranked.extend((doc, score) for doc in self._order(group, 'video_numLikes', order == 'desc', limit - len(ranked)))
+                    if len(ranked) >= limit:
+                        break
+                items = [dict(self._docs[doc], score=round(score, 4)) for doc, score in ranked[limit - page_size:]]
+            else:
+                docs = self._order(candidates, sort, order == 'desc', limit)
+                items = [self._docs[doc] for doc in docs[limit - page_size:]]
+
+        return {'total': total, 'page': page, 'page_size': page_size, 'items': items}
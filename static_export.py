@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+'''
+下载记录的静态导出：把账本写成预先压缩的 JSON 分片，由任意静态文件服务器 (nginx 等) 提供给网页，
+请求不经过 Python。
+
+    manifest.json                       入口 (不缓存或短缓存)：各分片的文件名、条数和日期范围
+    pages/{n}.{摘要}.json               按下载顺序 (local_id) 每 EXPORT_PAGE_SIZE 条一页，新下载只会改变最后一页
+    ids.{摘要}.json                     列式的全部视频: {"video_id": [...], "local_id": [...], ...}，第 i 条在第 i // page_size 页
+    authors.{摘要}.json / tags.{摘要}.json   作者 / Tag -> {"file": 分片, "count": 条数}
+    authors/{键}.{摘要}.json            某个作者的视频ID (从新到旧)，tags/ 同理
+
+除 manifest.json 外文件名带内容摘要，内容不变则文件名不变、不重写，可以永久缓存；
+每个文件旁边有 .gz (以及安装 brotli 时的 .br)，供 gzip_static / brotli_static 直接发送。
+上一版 manifest 引用的分片保留到下一次导出，正在加载的网页不会遇到 404。
+
+用法: python static_export.py [--force]
+'''
+import os
+import sys
+import json
+import gzip
+import time
+import hashlib
+import threading
+
+try:
+    import brotli
+except ImportError: # 可选依赖，未安装时只生成 .gz
+    brotli = None
+
+from log_config import get_logger, setup_logging
+
+logger = get_logger(__name__)
+
+# 每页条数
+EXPORT_PAGE_SIZE = 200
+# 任务执行器空闲时检查账本变化并导出的最小间隔 (秒)
+STATIC_EXPORT_INTERVAL = 60
+# 压缩级别
+EXPORT_GZIP_LEVEL = 9
+EXPORT_BROTLI_QUALITY = 11
+# 列式文件中的字段
+ID_COLUMNS = ('video_id', 'local_id', 'success', 'last_update_timestamp', 'video_size_mb')
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_FORMAT = 1
+
+def _dumps(obj) -> bytes:
+    # 输出固定 (键排序、无空格)，内容不变时摘要不变
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+def _key(name) -> str:
+    '''
+    作者名 / Tag 可能包含任意字符，文件名使用其摘要
+    '''
+    return hashlib.sha1(str(name).encode('utf-8')).hexdigest()[:16]
+
+def _compressed_variants(data) -> list:
+    '''
+    :return: [(后缀, 内容), ...]，包括未压缩的原文件
+    '''
+    variants = [('', data), ('.gz', gzip.compress(data, compresslevel=EXPORT_GZIP_LEVEL, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data, quality=EXPORT_BROTLI_QUALITY)))
+    return variants
+
+def _atomic_write(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+class StaticExporter:
+    '''
+    增量导出器：只写入内容变化的分片 (线程安全)
+    '''
+    def __init__(self, ledger, export_dir, page_size=EXPORT_PAGE_SIZE):
+        '''
+        :param ledger: DownloadLedger
+        :param export_dir: 输出目录 (静态服务器的根目录)
+        :param page_size: 每页条数
+        '''
+        self.ledger = ledger
+        self.export_dir = export_dir
+        self.page_size = page_size
+        self._lock = threading.Lock()
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self.export_dir, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            return manifest if isinstance(manifest, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _shard(self, prefix, obj, stats) -> str:
+        '''
+        写入一个分片 (已存在相同内容的分片时跳过)
+        :param prefix: 相对路径前缀，如 'pages/0'
+        :return: 分片的相对路径
+        '''
+        data = _dumps(obj)
+        name = f"{prefix}.{hashlib.sha256(data).hexdigest()[:16]}.json"
+        path = os.path.join(self.export_dir, name)
+        if os.path.exists(path) and (brotli is None or os.path.exists(path + '.br')):
+            stats['unchanged'] += 1
+            return name
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写压缩文件，原文件最后写入，原文件存在即表示分片完整
+        for suffix, content in reversed(_compressed_variants(data)):
+            _atomic_write(path + suffix, content)
+        stats['written'] += 1
+        return name
+
+    def _index_shards(self, kind, groups, stats) -> str:
+        '''
+        写入作者 / Tag 分片以及它们的目录
+        :param groups: 名称 -> 视频ID 列表 (从旧到新)
+        :return: 目录分片的相对路径
+        '''
+        directory = {}
+        for name, video_ids in groups.items():
+            ids = video_ids[::-1]
+            directory[name] = {'file': self._shard(f"{kind}/{_key(name)}", {'name': name, 'ids': ids}, stats), 'count': len(ids)}
+        return self._shard(kind, directory, stats)
+
+    def export(self, force=False) -> dict | None:
+        '''
+        导出账本
+        :param force: 账本没有变化时也重新生成 (仍然只写入变化的分片)
+        :return: {'written': 写入的分片数, 'unchanged': 未变化的分片数, 'removed': 删除的文件数}；账本未变化时为 None
+        '''
+        with self._lock:
+            previous = self._read_manifest()
+            ledger_version = self.ledger.version()
+            if not force and previous.get('ledger_version') == ledger_version and previous.get('page_size') == self.page_size:
+                return None
+            started = time.monotonic()
+            stats = {'written': 0, 'unchanged': 0, 'removed': 0}
+            os.makedirs(self.export_dir, exist_ok=True)
+
+            entries = list(self.ledger.iter_entries())
+            pages = []
+            for start in range(0, len(entries), self.page_size):
+                page = entries[start:start + self.page_size]
+                pages.append({'file': self._shard(f"pages/{len(pages)}", page, stats), 'count': len(page),
+                              'from': page[0].get('download_time'), 'to': page[-1].get('download_time')})
+
+            columns = {column: [entry.get(column) for entry in entries] for column in ID_COLUMNS}
+            columns['success'] = [1 if success else 0 for success in columns['success']]
+            by_author, by_tag = {}, {}
+            for entry in entries:
+                by_author.setdefault(entry.get('avatar_name') or '', []).append(entry['video_id'])
+                for tag in entry.get('video_tagList') or []:
+                    by_tag.setdefault(tag, []).append(entry['video_id'])
+
+            manifest = {
+                'format': MANIFEST_FORMAT,
+                'ledger_version': ledger_version,
+                'generated': time.time(),
+                'total': len(entries),
+                'page_size': self.page_size,
+                'pages': pages,
+                'ids': self._shard('ids', columns, stats),
+                'authors': self._index_shards('authors', by_author, stats),
+                'tags': self._index_shards('tags', by_tag, stats),
+                'encodings': [suffix[1:] for suffix, _ in _compressed_variants(b'')[1:]],
+            }
+            manifest_path = os.path.join(self.export_dir, MANIFEST_NAME)
+            data = _dumps(manifest)
+            for suffix, content in reversed(_compressed_variants(data)):
+                _atomic_write(manifest_path + suffix, content)
+
+            stats['removed'] = self._remove_unreferenced(manifest, previous)
+            logger.info(f"静态导出 {len(entries)} 条: 写入 {stats['written']} 个分片，未变化 {stats['unchanged']} 个，"
+                        f"删除 {stats['removed']} 个文件，耗时 {time.monotonic() - started:.2f} 秒")
+            return stats
+
+    def _referenced(self, manifest) -> set:
+        names = {page['file'] for page in manifest.get('pages', [])}
+        names.update(manifest[key] for key in ('ids', 'authors', 'tags') if manifest.get(key))
+        for key in ('authors', 'tags'):
+            if not manifest.get(key):
+                continue
+            try:
+                with open(os.path.join(self.export_dir, manifest[key]), 'r', encoding='utf-8') as f:
+                    names.update(item['file'] for item in json.load(f).values())
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        return {os.path.normpath(name) for name in names}
+
+    def _remove_unreferenced(self, manifest, previous) -> int:
+        '''
+        删除当前和上一版 manifest 都没有引用的分片
+        :return: 删除的文件数
+        '''
+        keep = self._referenced(manifest) | self._referenced(previous)
+        removed = 0
+        for directory, _, files in os.walk(self.export_dir):
+            for file_name in files:
+                path = os.path.join(directory, file_name)
+                name = os.path.relpath(path, self.export_dir)
+                base = name
+                for suffix in ('.gz', '.br'):
+                    if base.endswith(suffix):
+                        base = base[:-len(suffix)]
+                if base == MANIFEST_NAME or base in keep or not base.endswith('.json'):
+                    continue
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+if __name__ == '__main__':
+    from app import get_static_exporter
+
+    setup_logging(console_level='INFO')
+    get_static_exporter().export(force='--force' in sys.argv[1:])
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+'''
+存储布局与分层。
+
+视频不再全部平铺在下载目录中，而是按布局分到子目录 (单个目录中的文件数有限，列目录和 stat 不会越来越慢)：
+
+    prefix: {根目录}/ab/abCdEf….mp4      按视频 ID 前缀 (小写) 分目录
+    date:   {根目录}/2025/04/abCdEf….mp4  按下载完成的年月分目录
+    flat:   {根目录}/abCdEf….mp4          旧版本的平铺布局
+
+存储根目录分为两种角色 (见 api_client.STORAGE_ROOTS)：
+hot 根目录 (例如 SSD) 接收新下载，未完成下载 (.part) 也平铺在其中；
+下载完成超过 HOT_RETENTION 的视频由后台迁移到剩余空间最多的 bulk 根目录 (例如 HDD)。
+后台迁移同时把旧的平铺文件移到分片目录，并更新账本中的路径。
+
+开始下载前按预计大小在 hot 根目录预留磁盘空间 (DiskSpaceGuard)，空间不足时任务延后执行，
+而不是写到一半磁盘写满；延后超过 STORAGE_SPACE_MAX_WAIT 或等待也无法满足时任务失败。
+
+用法: python storage.py migrate   立即执行一次完整迁移
+      python storage.py status    查看各根目录的空间与预留
+'''
+import os
+import sys
+import time
+import errno
+import shutil
+import threading
+
+from log_config import get_logger, setup_logging
+from retry_policy import PermanentError
+
+logger = get_logger(__name__)
+
+LAYOUT_PREFIX = 'prefix'
+LAYOUT_DATE = 'date'
+LAYOUT_FLAT = 'flat'
+# 视频文件的布局
+STORAGE_LAYOUT = LAYOUT_PREFIX
+# prefix 布局的前缀长度 (2 个字符约 1300 个目录)
+PREFIX_LENGTH = 2
+
+ROLE_HOT = 'hot'
+ROLE_BULK = 'bulk'
+
+# 下载完成后在 hot 根目录保留的时间 (秒)，之后迁移到 bulk 根目录
+HOT_RETENTION = 24 * 3600
+# 每个根目录至少保留的空闲空间 (bytes)
+STORAGE_MIN_FREE = 2 * 1024 * 1024 * 1024
+# 磁盘空间不足时任务延后执行的间隔 (秒)
+STORAGE_SPACE_POLL = 30
+# 因磁盘空间不足最多延后多久 (秒)，超过后任务失败
+STORAGE_SPACE_MAX_WAIT = 2 * 3600
+
+# 后台迁移的间隔 (秒)
+MIGRATION_INTERVAL = 600
+# 每轮最多迁移的文件数
+MIGRATION_BATCH = 500
+# 跨磁盘复制的速率上限 (bytes/s)，0 表示不限制；同一磁盘内的移动是重命名，不受限制
+MIGRATION_MAX_BANDWIDTH = 50 * 1024 * 1024
+MIGRATION_COPY_BUFFER = 1024 * 1024
+
+def shard_dir(video_id, layout=STORAGE_LAYOUT, timestamp=None) -> str:
+    '''
+    视频所在的分片子目录 (相对路径)
+    :param timestamp: date 布局使用的时间 (下载完成时间)，None 表示当前时间
+    '''
+    if layout == LAYOUT_PREFIX:
+        return video_id[:PREFIX_LENGTH].lower() or '_'
+    if layout == LAYOUT_DATE:
+        return time.strftime('%Y/%m', time.localtime(timestamp))
+    return ''
+
+def _same_path(a, b) -> bool:
+    return os.path.normpath(os.path.abspath(a)) == os.path.normpath(os.path.abspath(b))
+
+def move_file(src, dst, max_bandwidth=MIGRATION_MAX_BANDWIDTH):
+    '''
+    移动文件：同一文件系统内直接重命名；跨文件系统时限速复制到临时文件、fsync 后重命名，再删除源文件。
+    任何时刻目标路径上要么没有文件，要么是完整的文件。
+    '''
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.replace(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV: # 跨文件系统时需要复制
+            raise
+    tmp_path = dst + '.tmp'
+    try:
+        with open(src, 'rb') as fsrc, open(tmp_path, 'wb') as fdst:
+            start = time.monotonic()
+            copied = 0
+            while True:
+                chunk = fsrc.read(MIGRATION_COPY_BUFFER)
+                if not chunk:
+                    break
+                fdst.write(chunk)
+                copied += len(chunk)
+                if max_bandwidth:
+                    ahead = copied / max_bandwidth - (time.monotonic() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+        shutil.copystat(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    os.remove(src)
+
+class StorageRoot:
+    '''
+    一个存储根目录
+    '''
+    def __init__(self, path, role=ROLE_HOT, min_free=STORAGE_MIN_FREE):
+        '''
+        :param path: 目录
+        :param role: hot (新下载和未完成下载) 或 bulk (下载完成的视频)
+        :param min_free: 至少保留的空闲空间 (bytes)
+        '''
+        if role not in (ROLE_HOT, ROLE_BULK):
+            raise ValueError(f"未知的存储角色: {role}")
+        self.path = path
+        self.role = role
+        self.min_free = min_free
+
+    def contains(self, path) -> bool:
+        return os.path.abspath(path).startswith(os.path.join(os.path.abspath(self.path), ''))
+
+    def free(self) -> int:
+        '''
+        可用空间 (扣除 min_free)，目录不存在时按其所在磁盘计算
+        '''
+        path = self.path
+        while not os.path.exists(path) and os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+        try:
+            return shutil.disk_usage(path).free - self.min_free
+        except OSError:
+            return 0
+
+    def __repr__(self):
+        return f"StorageRoot({self.path!r}, role={self.role!r})"
+
+class InsufficientStorageError(PermanentError):
+    '''
+    磁盘空间不足且继续等待也无法满足 (或已等待超过上限)
+    '''
+
+class DiskSpaceGuard:
+    '''
+    磁盘空间预留：开始下载前按预计大小预留，可用空间 = 实际空闲 - 已预留 - min_free。
+    预留在下载结束后释放 (下载过程中写入的数据同时计入实际占用和预留，因此是保守的)。
+    '''
+    def __init__(self, root, max_wait=STORAGE_SPACE_MAX_WAIT):
+        '''
+        :param root: StorageRoot
+        :param max_wait: admit() 允许延后的最长时间 (秒)
+        '''
+        self.root = root
+        self.max_wait = max_wait
+        self.reserved = 0
+        self.deferred = 0 # 因空间不足而延后的次数
+        self._lock = threading.Lock()
+
+    def try_acquire(self, nbytes) -> bool:
+        '''
+        预留空间
+        :return: 空间不足时返回 False (没有预留)
+        '''
+        with self._lock:
+            if nbytes > self.root.free() - self.reserved:
+                self.deferred += 1
+                return False
+            self.reserved += nbytes
+            return True
+
+    def admit(self, nbytes, waited=0.0) -> bool:
+        '''
+        预留空间，空间不足时返回 False (调用方 STORAGE_SPACE_POLL 秒后再试)
+        :param waited: 已经因空间不足延后的秒数
+        :raise InsufficientStorageError: 没有任何预留时也放不下 (等待其他下载结束无济于事)，或延后超过 max_wait
+        '''
+        if self.try_acquire(nbytes):
+            return True
+        with self._lock:
+            free, reserved = self.root.free(), self.reserved
+        if reserved == 0 and nbytes > free:
+            raise InsufficientStorageError(f"{self.root.path} 可用空间 {free} bytes，不足以下载预计 {nbytes} bytes 的视频")
+        if waited >= self.max_wait:
+            raise InsufficientStorageError(f"{self.root.path} 空间不足 (需要 {nbytes} bytes，可用 {free - reserved} bytes)，已延后 {waited:.0f} 秒")
+        return False
+
+    def release(self, nbytes):
+        with self._lock:
+            self.reserved -= nbytes
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'path': self.root.path, 'free': self.root.free(), 'reserved': self.reserved, 'deferred': self.deferred}
+
+class StorageLayout:
+    '''
+    存储布局：决定视频文件的位置，并在各根目录之间迁移
+    '''
+    def __init__(self, roots, layout=STORAGE_LAYOUT, hot_retention=HOT_RETENTION):
+        '''
+        :param roots: StorageRoot 列表；第一个 hot 根目录接收新下载，没有 bulk 根目录时视频一直留在 hot 根目录
+        :param layout: prefix, date 或 flat
+        :param hot_retention: 下载完成后在 hot 根目录保留的时间 (秒)
+        '''
+        if layout not in (LAYOUT_PREFIX, LAYOUT_DATE, LAYOUT_FLAT):
+            raise ValueError(f"未知的存储布局: {layout}")
+        hot = [root for root in roots if root.role == ROLE_HOT]
+        if not hot:
+            raise ValueError("至少需要一个 hot 存储根目录")
+        self.roots = list(roots)
+        self.hot = hot[0]
+        self.bulk = [root for root in roots if root.role == ROLE_BULK]
+        self.layout = layout
+        self.hot_retention = hot_retention
+        self.admission = DiskSpaceGuard(self.hot)
+
+    @property
+    def partial_dir(self) -> str:
+        '''
+        未完成下载所在目录 (hot 根目录，平铺)
+        '''
+        return self.hot.path
+
+    def root_of(self, path) -> StorageRoot | None:
+        for root in self.roots:
+            if root.contains(path):
+                return root
+        return None
+
+    def path_in(self, root, video_id, file_name, timestamp=None) -> str:
+        return os.path.join(root.path, shard_dir(video_id, self.layout, timestamp), file_name)
+
+    def video_path(self, video_id, file_type) -> str:
+        '''
+        新下载的视频文件路径 (hot 根目录中的分片目录，目录不存在时创建)
+        '''
+        path = self.path_in(self.hot, video_id, f"{video_id}.{file_type}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def placement(self, video_id, path, completed_at, size, now=None) -> str:
+        '''
+        已完成视频应在的位置：保留期内在 hot 根目录，之后在 bulk 根目录 (已在某个 bulk 根目录中时不换盘)；
+        不在任何根目录中的文件 (例如手动存放的旧文件) 保持原位
+        '''
+        root = self.root_of(path)
+        if root is None:
+            return path
+        if self.bulk and root.role == ROLE_HOT and (now or time.time()) - completed_at >= self.hot_retention:
+            target = max(self.bulk, key=lambda r: r.free())
+            if target.free() >= size:
+                root = target
+        return self.path_in(root, video_id, os.path.basename(path), completed_at)
+
+    def snapshot(self) -> dict:
+        '''
+        各根目录的可用空间与下载预留，用于 /progress 和 status 命令
+        '''
+        return {'layout': self.layout,
+                'roots': [{'path': root.path, 'role': root.role, 'free': root.free()} for root in self.roots],
+                'admission': self.admission.snapshot()}
+
+class StorageMigrator:
+    '''
+    后台迁移：把不在应在位置上的视频 (旧的平铺文件、超过保留期仍在 hot 根目录的文件) 移动过去，
+    更新账本与已完成索引中的路径；旧的平铺缩略图同时移到分片目录。
+    '''
+    def __init__(self, layout, ledger, completed_index=None, thumbnails=None, is_active=None,
+                 interval=MIGRATION_INTERVAL, batch=MIGRATION_BATCH):
+        '''
+        :param layout: StorageLayout
+        :param ledger: DownloadLedger
+        :param completed_index: CompletedIndex，移动后更新路径
+        :param thumbnails: ThumbnailStore，None 时不迁移缩略图
+        :param is_active: is_active(video_id)，返回 True 的视频正在下载，不迁移
+        '''
+        self.layout = layout
+        self.ledger = ledger
+        self.completed_index = completed_index
+        self.thumbnails = thumbnails
+        self.is_active = is_active
+        self.interval = interval
+        self.batch = batch
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='storage-migrator', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"存储迁移失败: {e}")
+
+    def run_once(self, limit=None) -> dict:
+        '''
+        迁移一轮
+        :param limit: 最多移动的视频数，None 时使用 batch；0 表示不限制
+        :return: {'videos': 移动的视频数, 'bytes': 字节数, 'thumbnails': 移动的缩略图数, 'errors': 失败数}
+        '''
+        limit = self.batch if limit is None else limit
+        counts = {'videos': 0, 'bytes': 0, 'thumbnails': 0, 'errors': 0}
+        rows = self.ledger.select_fields({'video_id': '', 'video_path': '', 'thumbnail_path': '', 'last_update_timestamp': 0.0})
+        now = time.time()
+        for _, _, success, video_id, video_path, thumbnail_path, completed_at in rows:
+            if self._stop.is_set() or (limit and counts['videos'] >= limit):
+                break
+            if self.is_active is not None and self.is_active(video_id):
+                continue
+            fields = {}
+            try:
+                if success and video_path:
+                    moved = self._move_video(video_id, video_path, completed_at, now)
+                    if moved is not None:
+                        fields['video_path'], size = moved
+                        counts['videos'] += 1
+                        counts['bytes'] += size
+                if self.thumbnails is not None and thumbnail_path:
+                    new_path = self.thumbnails.relocate(video_id)
+                    if new_path is not None and not _same_path(new_path, thumbnail_path):
+                        fields['thumbnail_path'] = new_path
+                        counts['thumbnails'] += 1
+            except OSError as e:
+                logger.error(f"迁移视频 {video_id} 失败: {e}", extra={'video_id': video_id, 'stage': 'storage'})
+                counts['errors'] += 1
+            if fields:
+                self.ledger.update_entry(video_id, **fields)
+        if counts['videos'] or counts['thumbnails'] or counts['errors']:
+            logger.info(f"存储迁移: 视频 {counts['videos']} 个 ({counts['bytes'] / 2**30:.1f} GB)，"
+                        f"缩略图 {counts['thumbnails']} 个，失败 {counts['errors']} 个")
+        return counts
+
+    def _move_video(self, video_id, video_path, completed_at, now) -> tuple[str, int] | None:
+        '''
+        :return: (新路径, 大小)，不需要移动 (或文件不存在) 时为 None
+        '''
+        try:
+            size = os.path.getsize(video_path)
+        except FileNotFoundError:
+            return None
+        completed_at = completed_at or os.path.getmtime(video_path) # 旧记录没有完成时间
+        target = self.layout.placement(video_id, video_path, completed_at, size, now)
+        if _same_path(target, video_path):
+            return None
+        if os.path.exists(target):
+            # 目标位置已有同名文件 (上次迁移在删除源文件前中断)，大小一致时只删除源文件
+            if os.path.getsize(target) != size:
+                raise OSError(f"目标文件 {target} 已存在且大小不同")
+            os.remove(video_path)
+        else:
+            move_file(video_path, target)
+        logger.debug(f"移动视频 {video_path} -> {target}", extra={'video_id': video_id, 'stage': 'storage'})
+        if self.completed_index is not None:
+            self.completed_index.add(video_id, target, size)
+        return target, size
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ('migrate', 'status'):
+        print(__doc__)
+        sys.exit(2)
+    import json
+    from api_client import get_storage_layout, get_thumbnail_store
+    from app import get_ledger, get_completed_index, get_inflight_registry
+
+    setup_logging(console_level='INFO')
+    layout = get_storage_layout()
+    if sys.argv[1] == 'status':
+        print(json.dumps(layout.snapshot(), ensure_ascii=False, indent=2))
+        sys.exit(0)
+    migrator = StorageMigrator(layout, get_ledger(), get_completed_index(), get_thumbnail_store(),
+                               is_active=get_inflight_registry().is_active)
+    counts = migrator.run_once(limit=0)
+    logger.info(f"迁移完成: {counts}")
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+'''
+缩略图存储与预览图。
+
+原图和预览图按内容的 SHA-256 存放在 objects/ 目录下，内容相同的图片只存一份：
+
+    objects/ab/abcdef….jpg          原图
+    objects/ab/abcdef…-160.webp     由原图派生的预览图 (宽 160)
+
+manifests/ab/{video_id}.json 记录视频的原图和各预览帧的摘要；ab/{video_id}.jpg 是原图的硬链接，
+兼容账本中记录的缩略图路径 (ab 为视频 ID 前缀，见 storage.shard_dir；旧版本平铺的文件由 storage.py 的后台迁移移入)。预览图在进程池中生成 (需要 Pillow，未安装时只保存原图，网页直接使用原图)。
+
+用法: python thumbnails.py backfill   为旧版本下载的缩略图建立清单并生成预览图
+'''
+import os
+import sys
+import json
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image, features
+except ImportError: # 可选依赖，仅生成预览图需要
+    Image = None
+
+from file_sink import THUMBNAIL_FSYNC_POLICY, write_file
+from storage import LAYOUT_PREFIX, shard_dir
+from log_config import get_logger, setup_logging
+
+logger = get_logger(__name__)
+
+# 预览图宽度 (高度按比例)；原图比预览图小时不放大
+PREVIEW_SIZES = {'small': 160, 'medium': 320, 'large': 640}
+# 预览帧 (非封面) 只生成这些尺寸
+FRAME_PREVIEW_SIZES = ('small',)
+# 预览图格式，Pillow 不支持 WebP 时使用 jpeg
+PREVIEW_FORMAT = 'webp'
+PREVIEW_QUALITY = 80
+# 生成预览图的进程数
+PREVIEW_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+# 是否下载视频的全部预览帧 (默认只下载封面)
+THUMBNAIL_FRAMES = False
+THUMBNAIL_FRAME_COUNT = 12 # thumbnail-00.jpg ~ thumbnail-11.jpg
+THUMBNAIL_FRAME_CONCURRENCY = 4 # 单个视频同时下载的预览帧数
+
+OBJECTS_DIR_NAME = 'objects'
+MANIFESTS_DIR_NAME = 'manifests'
+
+def preview_format() -> str:
+    if Image is not None and PREVIEW_FORMAT == 'webp' and not features.check('webp'):
+        return 'jpeg'
+    return PREVIEW_FORMAT
+
+def _atomic_write(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    write_file(tmp_path, data, fsync_policy=THUMBNAIL_FSYNC_POLICY)
+    os.replace(tmp_path, path)
+
+def _render_previews(source_path, targets, image_format, quality) -> int:
+    '''
+    在子进程中生成预览图
+    :param targets: [(宽度, 输出路径), ...]
+    :return: 生成的数量
+    '''
+    with Image.open(source_path) as image:
+        width, height = image.size
+        largest = max(w for w, _ in targets)
+        if image.format == 'JPEG':
+            image.draft('RGB', (largest, max(1, height * largest // width))) # JPEG 解码时直接按比例缩小，减少解码开销
+        image = image.convert('RGB')
+        count = 0
+        for target_width, path in targets:
+            if os.path.exists(path):
+                continue
+            preview = image.copy()
+            preview.thumbnail((target_width, max(1, height * target_width // width)), Image.LANCZOS)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            preview.save(tmp_path, image_format.upper(), quality=quality)
+            os.replace(tmp_path, path)
+            count += 1
+        return count
+
+class ThumbnailStore:
+    '''
+    按内容寻址的缩略图存储 (线程安全)
+    '''
+    def __init__(self, root, preview_workers=PREVIEW_WORKERS):
+        '''
+        :param root: 缩略图目录 (THUMBNAIL_DIR)
+        :param preview_workers: 生成预览图的进程数，0 表示不生成预览图
+        '''
+        self.root = root
+        self.objects_dir = os.path.join(root, OBJECTS_DIR_NAME)
+        self.manifests_dir = os.path.join(root, MANIFESTS_DIR_NAME)
+        self.preview_workers = preview_workers if Image is not None else 0
+        self.image_format = preview_format()
+        self._lock = threading.Lock()
+        self._manifests = {}
+        self._pool = None
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def object_path(self, digest, suffix='.jpg') -> str:
+        return os.path.join(self.objects_dir, digest[:2], digest + suffix)
+
+    def preview_object_path(self, digest, width) -> str:
+        return self.object_path(digest, f"-{width}.{'jpg' if self.image_format == 'jpeg' else self.image_format}")
+
+    def legacy_path(self, video_id) -> str:
+        return os.path.join(self.root, shard_dir(video_id, LAYOUT_PREFIX), f"{video_id}.jpg")
+
+    def manifest_path(self, video_id) -> str:
+        return os.path.join(self.manifests_dir, shard_dir(video_id, LAYOUT_PREFIX), f"{video_id}.json")
+
+    def _flat_paths(self, video_id) -> tuple[str, str]:
+        '''
+        旧版本平铺的 (原图链接, 清单) 路径
+        '''
+        return os.path.join(self.root, f"{video_id}.jpg"), os.path.join(self.manifests_dir, f"{video_id}.json")
+
+    def relocate(self, video_id) -> str | None:
+        '''
+        把旧版本平铺的原图链接和清单移到分片目录
+        :return: 原图链接的当前路径，没有缩略图时为 None
+        '''
+        for flat_path, path in zip(self._flat_paths(video_id), (self.legacy_path(video_id), self.manifest_path(video_id))):
+            if os.path.exists(flat_path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(flat_path, path)
+        path = self.legacy_path(video_id)
+        return path if os.path.exists(path) else None
+
+    def put(self, data) -> str:
+        '''
+        保存一张原图 (已存在相同内容时不重复写入)
+        :return: 内容摘要
+        '''
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _atomic_write(path, data)
+        return digest
+
+    def add(self, video_id, original, frames=()) -> str:
+        '''
+        保存视频的缩略图并开始生成预览图
+        :param original: 封面原图 (bytes)
+        :param frames: 全部预览帧 (bytes 列表，可以为空)
+        :return: 封面原图路径 ({video_id}.jpg)
+        '''
+        manifest = {'original': self.put(original), 'frames': [self.put(frame) for frame in frames]}
+        manifest_path = self.manifest_path(video_id)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        _atomic_write(manifest_path, json.dumps(manifest).encode('utf-8'))
+        with self._lock:
+            self._manifests[video_id] = manifest
+
+        legacy_path = self.legacy_path(video_id)
+        os.makedirs(os.path.dirname(legacy_path), exist_ok=True)
+        tmp_path = legacy_path + '.tmp'
+        try:
+            os.link(self.object_path(manifest['original']), tmp_path)
+        except FileExistsError:
+            os.remove(tmp_path)
+            os.link(self.object_path(manifest['original']), tmp_path)
+        except OSError: # 不支持硬链接的文件系统
+            shutil.copyfile(self.object_path(manifest['original']), tmp_path)
+        os.replace(tmp_path, legacy_path)
+        for flat_path in self._flat_paths(video_id): # 重新下载时删除旧版本平铺的文件
+            if os.path.exists(flat_path):
+                os.remove(flat_path)
+
+        self.render_previews(manifest['original'], PREVIEW_SIZES.values())
+        for digest in set(manifest['frames']) - {manifest['original']}:
+            self.render_previews(digest, [PREVIEW_SIZES[size] for size in FRAME_PREVIEW_SIZES])
+        return legacy_path
+
+    def manifest(self, video_id) -> dict | None:
+        with self._lock:
+            manifest = self._manifests.get(video_id)
+        if manifest is not None:
+            return manifest
+        for path in (self.manifest_path(video_id), self._flat_paths(video_id)[1]):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+                break
+            except (OSError, ValueError):
+                continue
+        else:
+            return None
+        with self._lock:
+            self._manifests[video_id] = manifest
+        return manifest
+
+    def render_previews(self, digest, widths):
+        '''
+        在进程池中生成尚不存在的预览图 (不等待完成)
+        :return: Future，不需要生成时为 None
+        '''
+        if not self.preview_workers:
+            return None
+        targets = [(width, self.preview_object_path(digest, width)) for width in widths]
+        targets = [target for target in targets if not os.path.exists(target[1])]
+        if not targets:
+            return None
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.preview_workers)
+            future = self._pool.submit(_render_previews, self.object_path(digest), targets, self.image_format, PREVIEW_QUALITY)
+        def on_done(f):
+            if not f.cancelled() and f.exception() is not None:
+                logger.error(f"生成预览图 {digest} 失败: {f.exception()}")
+        future.add_done_callback(on_done)
+        return future
+
+    def preview_path(self, video_id, size='small', frame=None) -> str | None:
+        '''
+        网页使用的缩略图路径：预览图尚未生成 (或没有 Pillow) 时返回原图
+        :param size: PREVIEW_SIZES 中的名称，或 'original'
+        :param frame: 预览帧序号，None 表示封面
+        :return: 文件路径，没有缩略图时为 None
+        '''
+        manifest = self.manifest(video_id)
+        if manifest is None:
+            # 旧版本下载的缩略图没有清单
+            if frame is not None:
+                return None
+            for path in (self.legacy_path(video_id), self._flat_paths(video_id)[0]):
+                if os.path.exists(path):
+                    return path
+            return None
+        if frame is None:
+            digest = manifest['original']
+        elif 0 <= frame < len(manifest['frames']):
+            digest = manifest['frames'][frame]
+        else:
+            return None
+        if size in PREVIEW_SIZES:
+            path = self.preview_object_path(digest, PREVIEW_SIZES[size])
+            if os.path.exists(path):
+                return path
+        path = self.object_path(digest)
+        return path if os.path.exists(path) else None
+
+    def backfill(self) -> int:
+        '''
+        为没有清单的缩略图 ({video_id}.jpg，平铺或在分片目录中) 建立清单并生成预览图
+        :return: 处理的数量
+        '''
+        count = 0
+        paths = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith('.jpg'):
+                    paths.append(entry.path)
+                elif entry.is_dir() and entry.name not in (OBJECTS_DIR_NAME, MANIFESTS_DIR_NAME):
+                    with os.scandir(entry.path) as shard:
+                        paths.extend(e.path for e in shard if e.is_file() and e.name.endswith('.jpg'))
+        for path in paths:
+            video_id = os.path.basename(path)[:-len('.jpg')]
+            if self.manifest(video_id) is not None:
+                continue
+            with open(path, 'rb') as f:
+                self.add(video_id, f.read())
+            count += 1
+        return count
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'backfill':
+        print(__doc__)
+        sys.exit(2)
+    from api_client import get_thumbnail_store
+
+    setup_logging(console_level='INFO')
+    store = get_thumbnail_store()
+    logger.info(f"已为 {store.backfill()} 个缩略图建立清单")
+    store.close() # 等待预览图生成完成